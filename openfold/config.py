@@ -64,6 +64,7 @@ def model_config(
     low_prec=False, 
     long_sequence_inference=False,
     use_deepspeed_evoformer_attention=True,
+    cpu_inference=False,
 ):
     c = copy.deepcopy(config)
     # TRAINING PRESETS
@@ -240,6 +241,23 @@ def model_config(
     
     if use_deepspeed_evoformer_attention:
         c.globals.use_deepspeed_evo_attention = True 
+
+    if cpu_inference:
+        assert(not train)
+        # The memory-efficient kernels and offloading only exist for, or
+        # only pay off on, GPUs
+        c.globals.use_deepspeed_evo_attention = False
+        c.globals.use_flash = False
+        c.globals.use_lma = False
+        c.globals.offload_inference = False
+        c.model.template.offload_inference = False
+        # Chunking keeps the working set of the attention and triangle
+        # updates in cache. The tuner searches for the largest chunk size
+        # that fits in memory, which on CPUs just wastes trial runs
+        c.globals.chunk_size = 64
+        c.model.template.template_pair_stack.tune_chunk_size = False
+        c.model.extra_msa.extra_msa_stack.tune_chunk_size = False
+        c.model.evoformer_stack.tune_chunk_size = False
     
     if train:
         c.globals.blocks_per_ckpt = 1
@@ -278,6 +296,7 @@ eps = mlc.FieldReference(1e-8, field_type=float)
 templates_enabled = mlc.FieldReference(True, field_type=bool)
 embed_template_torsion_angles = mlc.FieldReference(True, field_type=bool)
 tune_chunk_size = mlc.FieldReference(True, field_type=bool)
+chunk_size_cache_path = mlc.FieldReference(None, field_type=str)
 
 NUM_RES = "num residues placeholder"
 NUM_MSA_SEQ = "msa placeholder"
@@ -415,6 +434,10 @@ config = mlc.ConfigDict(
                 "interface_threshold": None,
                 "supervised": False,
                 "uniform_recycling": False,
+                # Generate the features of each recycling iteration on
+                # demand instead of stacking all of them up front. Keeps
+                # feature memory independent of max_recycling_iters.
+                "lazy_recycling": False,
             },
             "eval": {
                 "fixed_size": True,
@@ -476,6 +499,9 @@ config = mlc.ConfigDict(
             # on long sequences (>1000 residues).
             "use_flash": False,
             "offload_inference": False,
+            # Path to a JSON file in which tuned chunk sizes are persisted
+            # across runs. If None, chunk sizes are re-tuned in each run
+            "chunk_size_cache_path": chunk_size_cache_path,
             "c_z": c_z,
             "c_m": c_m,
             "c_t": c_t,
@@ -531,6 +557,7 @@ config = mlc.ConfigDict(
                     "fuse_projection_weights": False,
                     "blocks_per_ckpt": blocks_per_ckpt,
                     "tune_chunk_size": tune_chunk_size,
+                    "chunk_size_cache_path": chunk_size_cache_path,
                     "inf": 1e9,
                 },
                 "template_pointwise_attention": {
@@ -581,6 +608,7 @@ config = mlc.ConfigDict(
                     "fuse_projection_weights": False,
                     "clear_cache_between_blocks": False,
                     "tune_chunk_size": tune_chunk_size,
+                    "chunk_size_cache_path": chunk_size_cache_path,
                     "inf": 1e9,
                     "eps": eps,  # 1e-10,
                     "ckpt": blocks_per_ckpt is not None,
@@ -607,6 +635,7 @@ config = mlc.ConfigDict(
                 "blocks_per_ckpt": blocks_per_ckpt,
                 "clear_cache_between_blocks": False,
                 "tune_chunk_size": tune_chunk_size,
+                "chunk_size_cache_path": chunk_size_cache_path,
                 "inf": 1e9,
                 "eps": eps,  # 1e-10,
             },
@@ -656,7 +685,28 @@ config = mlc.ConfigDict(
             # iterations. A positive value will enable early stopping if the
             # difference in pairwise distances is less than the tolerance between
             # recycling steps.
-            "recycle_early_stop_tolerance": -1.
+            "recycle_early_stop_tolerance": -1.,
+            # Further convergence criteria, see utils/recycling.py. Negative
+            # tolerances disable the corresponding criterion
+            "recycle_early_stop": {
+                # Tolerance for the CA RMSD to the previous iteration after
+                # superposition
+                "ca_rmsd_tolerance": -1.,
+                # Tolerance for the change in mean pLDDT
+                "plddt_delta_tolerance": -1.,
+                # Tolerance for the relative change in pair representation
+                "pair_delta_tolerance": -1.,
+                # Whether to stop once "all" or "any" of the enabled criteria
+                # (including recycle_early_stop_tolerance) are met
+                "rule": "all",
+                # Monomer models always run every recycling iteration unless
+                # this is set. Their metrics are still recorded
+                "monomer_early_stop": False,
+                # Record all metrics in the outputs as "recycling_metrics".
+                # Otherwise, only those used for early stopping are
+                # computed, and none are output
+                "record_metrics": False,
+            },
         },
         "relax": {
             "max_iterations": 0,  # no max
@@ -664,6 +714,15 @@ config = mlc.ConfigDict(
             "stiffness": 10.0,
             "max_outer_iterations": 20,
             "exclude_residues": [],
+            # Update the OpenMM system in place between outer iterations
+            # instead of re-cleaning the structure and rebuilding it. Faster,
+            # but doesn't re-place hydrogens, so outputs differ slightly
+            "reuse_system": False,
+            # Leave structures without violations unrelaxed
+            "relax_if_needed": False,
+            # If set, only minimize residues within this many Angstroms of
+            # residues with violations
+            "local_radius": None,
         },
         "loss": {
             "distogram": {
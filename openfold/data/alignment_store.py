@@ -0,0 +1,221 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Deduplicated storage of precomputed alignments. Chains with identical
+sequences share their alignments, either through links between per-chain
+directories or through a single directory per sequence hash, to which
+ALIGNMENT_MAP_FILENAME in the alignment directory maps the chain names.
+
+Readers should look chains up with resolve_alignment_dir and
+list_alignment_names, which fall back to one directory per chain when an
+alignment directory has no map.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Callable, Dict, List, Optional, Sequence
+
+
+logger = logging.getLogger(__name__)
+
+
+ALIGNMENT_MAP_FILENAME = "alignment_map.jsonl"
+
+DEDUP_MODES = ["copy", "hardlink", "symlink", "index"]
+
+
+def sequence_hash(seq: str) -> str:
+    return hashlib.sha256(seq.upper().encode("utf-8")).hexdigest()
+
+
+# Alignment maps by path, along with the mtime at which they were read
+_alignment_maps = {}
+
+
+def load_alignment_map(alignment_dir: str) -> Optional[Dict[str, str]]:
+    """
+        Loads the map from chain names to the directories holding their
+        alignments, relative to alignment_dir. Returns None if the directory
+        has no map. Maps are cached until the file changes.
+    """
+    path = os.path.abspath(os.path.join(alignment_dir, ALIGNMENT_MAP_FILENAME))
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    cached = _alignment_maps.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    alignment_map = {}
+    with open(path, "r") as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # An entry that is still being written
+                continue
+            alignment_map[entry["name"]] = entry["alignment"]
+
+    _alignment_maps[path] = (mtime, alignment_map)
+
+    return alignment_map
+
+
+def resolve_alignment_dir(alignment_dir: str, name: str) -> str:
+    """ Returns the directory holding the alignments of chain name """
+    alignment_map = load_alignment_map(alignment_dir)
+    if alignment_map is not None and name in alignment_map:
+        name = alignment_map[name]
+
+    return os.path.join(alignment_dir, name)
+
+
+def list_alignment_names(alignment_dir: str) -> List[str]:
+    """ Returns the names of the chains with alignments in alignment_dir """
+    names = os.listdir(alignment_dir)
+    alignment_map = load_alignment_map(alignment_dir)
+    if alignment_map is None:
+        return names
+
+    stored = set(alignment_map.values())
+    unmapped = [
+        n for n in names
+        if n not in stored and
+        n != ALIGNMENT_MAP_FILENAME and
+        not n.startswith(".")
+    ]
+
+    return list(dict.fromkeys(list(alignment_map.keys()) + unmapped))
+
+
+def link_alignment_dir(src_dir: str, dst_dir: str, mode: str = "hardlink"):
+    """
+        Populates dst_dir with the alignments in src_dir. Hardlinks fall back
+        to copies across filesystems.
+    """
+    if mode not in ["copy", "hardlink", "symlink"]:
+        raise ValueError(f"Invalid mode for linking alignments: {mode}")
+
+    os.makedirs(dst_dir, exist_ok=True)
+    for f in os.listdir(src_dir):
+        src = os.path.join(src_dir, f)
+        dst = os.path.join(dst_dir, f)
+        if mode == "hardlink":
+            try:
+                os.link(src, dst)
+                continue
+            except OSError as e:
+                logger.warning(f"Failed to hardlink {src} ({e}), copying it")
+        elif mode == "symlink":
+            os.symlink(os.path.relpath(src, dst_dir), dst)
+            continue
+
+        shutil.copyfile(src, dst)
+
+
+class AlignmentMapWriter:
+    """
+        Appends entries to the alignment map of an alignment directory. Each
+        entry is written with a single append, so that several writers may
+        share a map.
+    """
+    def __init__(self, alignment_dir: str):
+        self.path = os.path.join(alignment_dir, ALIGNMENT_MAP_FILENAME)
+        self._lock = threading.Lock()
+
+    def add(self, names: Sequence[str], alignment: str):
+        lines = "".join(
+            json.dumps({"name": n, "alignment": alignment}) + "\n"
+            for n in names
+        )
+        with self._lock, open(self.path, "a") as fp:
+            fp.write(lines)
+
+
+def store_alignments(
+    alignment_dir: str,
+    seq: str,
+    run_alignments: Callable[[str], None],
+) -> str:
+    """
+        Computes the alignments of a sequence into the directory named after
+        its hash, unless they already exist. The alignments are computed in
+        a temporary directory which is then renamed, so the hash directory
+        only ever holds complete alignments.
+
+        Args:
+            alignment_dir:
+                The alignment directory
+            seq:
+                The sequence
+            run_alignments:
+                Computes the alignments of seq into the directory it's
+                passed
+        Returns:
+            The name of the directory holding the alignments
+    """
+    key = sequence_hash(seq)
+    store_dir = os.path.join(alignment_dir, key)
+    if os.path.isdir(store_dir):
+        return key
+
+    tmp_dir = tempfile.mkdtemp(prefix=f".{key}_", dir=alignment_dir)
+    try:
+        run_alignments(tmp_dir)
+        try:
+            os.rename(tmp_dir, store_dir)
+        except OSError:
+            # Another worker aligned the same sequence first
+            if not os.path.isdir(store_dir):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return key
+
+
+def merge_seq_group(old: dict, new: dict, done: bool) -> Optional[dict]:
+    """
+        Merges the chain names of a newly added sequence group,
+        {"seq": ..., "names": [...]}, into those of the group already queued
+        for the same sequence. Returns None if there are no new names.
+
+        Names of a group whose alignments are done are recorded under
+        "linked", so that the new names can be linked to its alignments
+        instead of realigning the sequence. Other items, e.g. those of
+        whole files, are left as they are.
+    """
+    if "names" not in old or "names" not in new:
+        return None
+
+    new_names = [n for n in new["names"] if n not in old["names"]]
+    if len(new_names) == 0:
+        return None
+
+    merged = dict(old)
+    merged["names"] = old["names"] + new_names
+    if done:
+        merged["linked"] = old["names"]
+
+    return merged
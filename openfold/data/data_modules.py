@@ -17,6 +17,10 @@ from openfold.data import (
     mmcif_parsing,
     templates,
 )
+from openfold.data.alignment_store import (
+    list_alignment_names,
+    resolve_alignment_dir,
+)
 from openfold.utils.tensor_utils import dict_multimap
 from openfold.utils.tensor_utils import (
     tensor_tree_map,
@@ -116,7 +120,7 @@ class OpenFoldSingleDataset(torch.utils.data.Dataset):
         if alignment_index is not None:
             self._chain_ids = list(alignment_index.keys())
         else:
-            self._chain_ids = list(os.listdir(alignment_dir))
+            self._chain_ids = list_alignment_names(alignment_dir)
 
         if filter_path is not None:
             with open(filter_path, "r") as f:
@@ -206,7 +210,7 @@ class OpenFoldSingleDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, idx):
         name = self.idx_to_chain_id(idx)
-        alignment_dir = os.path.join(self.alignment_dir, name)
+        alignment_dir = resolve_alignment_dir(self.alignment_dir, name)
 
         alignment_index = None
         if self.alignment_index is not None:
@@ -386,7 +390,9 @@ class OpenFoldSingleMultimerDataset(torch.utils.data.Dataset):
         elif self.alignment_index is not None:
             self._mmcifs = [i.split("_")[0] for i in list(alignment_index.keys())]
         elif self.alignment_dir is not None:
-            self._mmcifs = [i.split("_")[0] for i in os.listdir(self.alignment_dir)]
+            self._mmcifs = [
+                i.split("_")[0] for i in list_alignment_names(self.alignment_dir)
+            ]
         else:
             raise ValueError("You must provide at least one of the mmcif_data_cache or alignment_dir")
 
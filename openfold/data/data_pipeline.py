@@ -24,8 +24,12 @@ from typing import Mapping, Optional, Sequence, Any, MutableMapping, Union
 import numpy as np
 import torch
 from openfold.data import templates, parsers, mmcif_parsing, msa_identifiers, msa_pairing, feature_processing_multimer
-from openfold.data.templates import get_custom_template_features, empty_template_feats
+from openfold.data.templates import empty_template_feats
+from openfold.data.alignment_store import resolve_alignment_dir
+from openfold.data.embedding_store import EmbeddingStore
+from openfold.data.msa_parsing import MsaParser
 from openfold.data.tools import jackhmmer, hhblits, hhsearch, hmmsearch
+from openfold.data.tools.utils import run_task_graph
 from openfold.np import residue_constants, protein
 
 FeatureDict = MutableMapping[str, np.ndarray]
@@ -281,6 +285,73 @@ def make_dummy_msa_feats(input_sequence) -> FeatureDict:
     return make_msa_features([msa_data_obj])
 
 
+class CustomTemplateDataPipeline:
+    """
+    Assembles the features of sequences threaded onto a single custom
+    template, without alignments, e.g. those of the variants of a mutational
+    scan.
+
+    The features of a sequence are derived from those of the last sequence
+    of the same length by updating only the residues in which they differ,
+    and the template features are shared between them.
+    """
+    def __init__(self, template_featurizer: templates.CustomTemplateFeaturizer):
+        self.template_featurizer = template_featurizer
+        self._last = {}
+
+    def _update_features(self, prev_seq, prev_features, seq, sequence):
+        features = dict(prev_features)
+        features["sequence"] = np.array(
+            [sequence.encode("utf-8")], dtype=object
+        )
+
+        diff = np.nonzero(seq != prev_seq)[0]
+        if len(diff) == 0:
+            return features
+
+        mutated = "".join(sequence[i] for i in diff)
+        aatype = prev_features["aatype"].copy()
+        aatype[diff] = residue_constants.sequence_to_onehot(
+            sequence=mutated,
+            mapping=residue_constants.restype_order_with_x,
+            map_unknown_to_x=True,
+        )
+        features["aatype"] = aatype
+
+        msa = prev_features["msa"].copy()
+        msa[0, diff] = [residue_constants.HHBLITS_AA_TO_ID[r] for r in mutated]
+        features["msa"] = msa
+
+        return features
+
+    def process_sequence(self, sequence: str) -> FeatureDict:
+        """
+        Returns the features of a sequence. They may share arrays with the
+        features of other sequences, so they mustn't be modified in place.
+        """
+        num_res = len(sequence)
+        seq = np.array(list(sequence))
+        if num_res in self._last:
+            prev_seq, prev_features = self._last[num_res]
+            features = self._update_features(
+                prev_seq, prev_features, seq, sequence
+            )
+        else:
+            features = {
+                **make_sequence_features(
+                    sequence=sequence,
+                    description=self.template_featurizer.pdb_id,
+                    num_res=num_res,
+                ),
+                **make_dummy_msa_feats(sequence),
+                **self.template_featurizer.get_features(sequence).features,
+            }
+
+        self._last[num_res] = (seq, features)
+
+        return features
+
+
 def make_sequence_features_with_custom_template(
         sequence: str,
         mmcif_path: str,
@@ -290,32 +361,15 @@ def make_sequence_features_with_custom_template(
     """
     process a single fasta file using features derived from a single template rather than an alignment
     """
-    num_res = len(sequence)
-
-    sequence_features = make_sequence_features(
-        sequence=sequence,
-        description=pdb_id,
-        num_res=num_res,
-    )
-
-    msa_data = [sequence]
-    deletion_matrix = [[0 for _ in sequence]]
-    msa_data_obj = parsers.Msa(sequences=msa_data, deletion_matrix=deletion_matrix, descriptions=None)
-
-    msa_features = make_msa_features([msa_data_obj])
-    template_features = get_custom_template_features(
+    template_featurizer = templates.CustomTemplateFeaturizer(
         mmcif_path=mmcif_path,
-        query_sequence=sequence,
         pdb_id=pdb_id,
         chain_id=chain_id,
-        kalign_binary_path=kalign_binary_path
     )
 
-    return {
-        **sequence_features,
-        **msa_features,
-        **template_features.features
-    }
+    return CustomTemplateDataPipeline(template_featurizer).process_sequence(
+        sequence
+    )
 
 
 class AlignmentRunner:
@@ -336,6 +390,7 @@ class AlignmentRunner:
         uniref_max_hits: int = 10000,
         mgnify_max_hits: int = 5000,
         uniprot_max_hits: int = 50000,
+        max_concurrent_searches: Optional[int] = None,
     ):
         """
         Args:
@@ -364,13 +419,18 @@ class AlignmentRunner:
                 in conjunction with uniref30/uniclust30 with hhblits.
             no_cpus:
                 The number of CPUs available for alignment. By default, all
-                CPUs are used.
+                CPUs are used. They are split between the database searches
+                that run concurrently.
             uniref_max_hits:
                 Max number of uniref hits
             mgnify_max_hits:
                 Max number of mgnify hits
             uniprot_max_hits:
                 Max number of uniprot hits
+            max_concurrent_searches:
+                Maximum number of database searches to run at once. By
+                default, all searches run concurrently. Set to 1 to run them
+                one after another, each with all CPUs.
         """
         db_map = {
             "jackhmmer": {
@@ -460,67 +520,132 @@ class AlignmentRunner:
             )
 
         self.template_searcher = template_searcher
+        self.max_concurrent_searches = max_concurrent_searches
+
+        self._split_cpus(no_cpus)
+
+    def _msa_runners(self):
+        """ The MSA runners that run uses """
+        # Like run, prefers the small BFD search if both are configured
+        if(self.use_small_bfd and self.jackhmmer_small_bfd_runner is not None):
+            bfd_runner = self.jackhmmer_small_bfd_runner
+        else:
+            bfd_runner = self.hhblits_bfd_unirefclust_runner
+
+        runners = [
+            self.jackhmmer_uniref90_runner,
+            self.jackhmmer_mgnify_runner,
+            bfd_runner,
+            self.jackhmmer_uniprot_runner,
+        ]
+        return [r for r in runners if r is not None]
+
+    def _split_cpus(self, no_cpus):
+        """
+        Splits the CPUs evenly between the searches that run at once. The
+        template search waits on uniref90, which is why the uniref90 search
+        receives any leftover CPUs.
+        """
+        runners = self._msa_runners()
+        if(len(runners) == 0):
+            return
+
+        no_concurrent = len(runners)
+        if(self.max_concurrent_searches is not None):
+            no_concurrent = min(no_concurrent, self.max_concurrent_searches)
+
+        n_cpu = max(no_cpus // no_concurrent, 1)
+        for runner in runners:
+            runner.n_cpu = n_cpu
+        runners[0].n_cpu += max(no_cpus - n_cpu * no_concurrent, 0)
+
+    def _search_templates(self, jackhmmer_uniref90_result, output_dir):
+        template_msa = jackhmmer_uniref90_result["sto"]
+        template_msa = parsers.deduplicate_stockholm_msa(template_msa)
+        template_msa = parsers.remove_empty_columns_from_stockholm_msa(
+            template_msa
+        )
+
+        if(self.template_searcher.input_format == "sto"):
+            pdb_templates_result = self.template_searcher.query(
+                template_msa,
+                output_dir=output_dir
+            )
+        elif(self.template_searcher.input_format == "a3m"):
+            uniref90_msa_as_a3m = parsers.convert_stockholm_to_a3m(
+                template_msa
+            )
+            pdb_templates_result = self.template_searcher.query(
+                uniref90_msa_as_a3m,
+                output_dir=output_dir
+            )
+        else:
+            fmt = self.template_searcher.input_format
+            raise ValueError(
+                f"Unrecognized template input format: {fmt}"
+            )
+
+        return pdb_templates_result
 
     def run(
         self,
         fasta_path: str,
         output_dir: str,
-    ):
-        """Runs alignment tools on a sequence"""
+    ) -> Mapping[str, float]:
+        """
+        Runs alignment tools on a sequence. Database searches run
+        concurrently, and the template search starts as soon as the uniref90
+        search it depends on has finished.
+
+        Returns:
+            The wall time in seconds of each search
+        """
+        # Maps task names to (fn, deps) pairs
+        tasks = {}
         if(self.jackhmmer_uniref90_runner is not None):
             uniref90_out_path = os.path.join(output_dir, "uniref90_hits.sto")
-
-            jackhmmer_uniref90_result = run_msa_tool(
-                msa_runner=self.jackhmmer_uniref90_runner,
-                fasta_path=fasta_path,
-                msa_out_path=uniref90_out_path,
-                msa_format='sto',
-                max_sto_sequences=self.uniref_max_hits,
-            )
-
-            template_msa = jackhmmer_uniref90_result["sto"]
-            template_msa = parsers.deduplicate_stockholm_msa(template_msa)
-            template_msa = parsers.remove_empty_columns_from_stockholm_msa(
-                template_msa
+            tasks["jackhmmer_uniref90"] = (
+                lambda: run_msa_tool(
+                    msa_runner=self.jackhmmer_uniref90_runner,
+                    fasta_path=fasta_path,
+                    msa_out_path=uniref90_out_path,
+                    msa_format='sto',
+                    max_sto_sequences=self.uniref_max_hits,
+                ),
+                [],
             )
 
             if(self.template_searcher is not None):
-                if(self.template_searcher.input_format == "sto"):
-                    pdb_templates_result = self.template_searcher.query(
-                        template_msa,
-                        output_dir=output_dir
-                    )
-                elif(self.template_searcher.input_format == "a3m"):
-                    uniref90_msa_as_a3m = parsers.convert_stockholm_to_a3m(
-                        template_msa
-                    )
-                    pdb_templates_result = self.template_searcher.query(
-                        uniref90_msa_as_a3m,
-                        output_dir=output_dir
-                    )
-                else:
-                    fmt = self.template_searcher.input_format
-                    raise ValueError(
-                        f"Unrecognized template input format: {fmt}"
-                    )
+                tasks["template_search"] = (
+                    lambda uniref90_result: self._search_templates(
+                        uniref90_result, output_dir
+                    ),
+                    ["jackhmmer_uniref90"],
+                )
 
         if(self.jackhmmer_mgnify_runner is not None):
             mgnify_out_path = os.path.join(output_dir, "mgnify_hits.sto")
-            jackhmmer_mgnify_result = run_msa_tool(
-                msa_runner=self.jackhmmer_mgnify_runner,
-                fasta_path=fasta_path,
-                msa_out_path=mgnify_out_path,
-                msa_format='sto',
-                max_sto_sequences=self.mgnify_max_hits
+            tasks["jackhmmer_mgnify"] = (
+                lambda: run_msa_tool(
+                    msa_runner=self.jackhmmer_mgnify_runner,
+                    fasta_path=fasta_path,
+                    msa_out_path=mgnify_out_path,
+                    msa_format='sto',
+                    max_sto_sequences=self.mgnify_max_hits
+                ),
+                [],
             )
 
         if(self.use_small_bfd and self.jackhmmer_small_bfd_runner is not None):
             bfd_out_path = os.path.join(output_dir, "small_bfd_hits.sto")
-            jackhmmer_small_bfd_result = run_msa_tool(
-                msa_runner=self.jackhmmer_small_bfd_runner,
-                fasta_path=fasta_path,
-                msa_out_path=bfd_out_path,
-                msa_format="sto",
+            tasks["jackhmmer_small_bfd"] = (
+                lambda: run_msa_tool(
+                    msa_runner=self.jackhmmer_small_bfd_runner,
+                    fasta_path=fasta_path,
+                    msa_out_path=bfd_out_path,
+                    msa_format="sto",
+                ),
+                [],
             )
         elif(self.hhblits_bfd_unirefclust_runner is not None):
             uni_name = "uni"
@@ -531,23 +656,35 @@ class AlignmentRunner:
                     uni_name = f"{uni_name}clust"
 
             bfd_out_path = os.path.join(output_dir, f"bfd_{uni_name}_hits.a3m")
-            hhblits_bfd_unirefclust_result = run_msa_tool(
-                msa_runner=self.hhblits_bfd_unirefclust_runner,
-                fasta_path=fasta_path,
-                msa_out_path=bfd_out_path,
-                msa_format="a3m",
+            tasks["hhblits_bfd"] = (
+                lambda: run_msa_tool(
+                    msa_runner=self.hhblits_bfd_unirefclust_runner,
+                    fasta_path=fasta_path,
+                    msa_out_path=bfd_out_path,
+                    msa_format="a3m",
+                ),
+                [],
             )
 
         if(self.jackhmmer_uniprot_runner is not None):
             uniprot_out_path = os.path.join(output_dir, 'uniprot_hits.sto')
-            result = run_msa_tool(
-                self.jackhmmer_uniprot_runner,
-                fasta_path=fasta_path,
-                msa_out_path=uniprot_out_path,
-                msa_format='sto',
-                max_sto_sequences=self.uniprot_max_hits,
+            tasks["jackhmmer_uniprot"] = (
+                lambda: run_msa_tool(
+                    self.jackhmmer_uniprot_runner,
+                    fasta_path=fasta_path,
+                    msa_out_path=uniprot_out_path,
+                    msa_format='sto',
+                    max_sto_sequences=self.uniprot_max_hits,
+                ),
+                [],
             )
 
+        _, timings = run_task_graph(
+            tasks, max_workers=self.max_concurrent_searches
+        )
+
+        return timings
+
 
 @dataclasses.dataclass(frozen=True)
 class _FastaChain:
@@ -695,60 +832,66 @@ class DataPipeline:
     def __init__(
         self,
         template_featurizer: Optional[templates.TemplateHitFeaturizer],
+        msa_parsing_workers: int = 0,
+        embedding_store: Optional[EmbeddingStore] = None,
     ):
+        """
+        Args:
+            template_featurizer:
+                Featurizer for template hits
+            msa_parsing_workers:
+                Number of processes in which to parse a target's MSA files
+                concurrently. If 0, they're parsed one after another
+            embedding_store:
+                Store from which to load sequence embeddings in seqemb
+                mode. Sequences missing from it fall back to the .pt files
+                in the alignment directory
+        """
         self.template_featurizer = template_featurizer
+        self.msa_parser = MsaParser(msa_parsing_workers)
+        self.embedding_store = embedding_store
+
+    @staticmethod
+    def _msa_format(filename, ext):
+        if ext == ".a3m":
+            return "a3m"
+        # The "hmm_output" exception is a crude way to exclude
+        # multimer template hits.
+        # Multimer "uniprot_hits" processed separately.
+        elif ext == ".sto" and filename not in ["uniprot_hits", "hmm_output"]:
+            return "sto"
+
+        return None
 
     def _parse_msa_data(
         self,
         alignment_dir: str,
         alignment_index: Optional[Any] = None
     ) -> Mapping[str, Any]:
+        # All files are submitted before any result is collected, so that
+        # they're parsed concurrently
         msa_data = {}
         if alignment_index is not None:
-            fp = open(os.path.join(alignment_dir, alignment_index["db"]), "rb")
-
-            def read_msa(start, size):
-                fp.seek(start)
-                msa = fp.read(size).decode("utf-8")
-                return msa
-
+            db_path = os.path.join(alignment_dir, alignment_index["db"])
             for (name, start, size) in alignment_index["files"]:
-                filename, ext = os.path.splitext(name)
-
-                if ext == ".a3m":
-                    msa = parsers.parse_a3m(
-                        read_msa(start, size)
-                    )
-                # The "hmm_output" exception is a crude way to exclude
-                # multimer template hits.
-                # Multimer "uniprot_hits" processed separately.
-                elif ext == ".sto" and filename not in ["uniprot_hits", "hmm_output"]:
-                    msa = parsers.parse_stockholm(read_msa(start, size))
-                else:
+                fmt = self._msa_format(*os.path.splitext(name))
+                if fmt is None:
                     continue
 
-                msa_data[name] = msa
-
-            fp.close()
+                msa_data[name] = self.msa_parser.submit(
+                    db_path, fmt, start, size
+                )
         else:
             for f in os.listdir(alignment_dir):
-                path = os.path.join(alignment_dir, f)
-                filename, ext = os.path.splitext(f)
-
-                if ext == ".a3m":
-                    with open(path, "r") as fp:
-                        msa = parsers.parse_a3m(fp.read())
-                elif ext == ".sto" and filename not in ["uniprot_hits", "hmm_output"]:
-                    with open(path, "r") as fp:
-                        msa = parsers.parse_stockholm(
-                            fp.read()
-                        )
-                else:
+                fmt = self._msa_format(*os.path.splitext(f))
+                if fmt is None:
                     continue
 
-                msa_data[f] = msa
+                msa_data[f] = self.msa_parser.submit(
+                    os.path.join(alignment_dir, f), fmt
+                )
 
-        return msa_data
+        return {k: v.result() for k, v in msa_data.items()}
 
     def _parse_template_hit_files(
         self,
@@ -835,8 +978,19 @@ class DataPipeline:
     # Load and process sequence embedding features
     def _process_seqemb_features(self,
         alignment_dir: str,
+        input_sequence: Optional[str] = None,
     ) -> Mapping[str, Any]:
         seqemb_features = {}
+        if(self.embedding_store is not None and
+           input_sequence is not None and
+           input_sequence in self.embedding_store
+        ):
+            # The store holds float16 embeddings; .pt files hold fp32 ones
+            seqemb_features["seq_embedding"] = self.embedding_store.get(
+                input_sequence
+            ).float()
+            return seqemb_features
+
         for f in os.listdir(alignment_dir):
             path = os.path.join(alignment_dir, f)
             ext = os.path.splitext(f)[-1]
@@ -889,7 +1043,7 @@ class DataPipeline:
         # If using seqemb mode, generate a dummy MSA features using just the sequence
         if seqemb_mode:
             msa_features = make_dummy_msa_feats(input_sequence)
-            sequence_embedding_features = self._process_seqemb_features(alignment_dir)
+            sequence_embedding_features = self._process_seqemb_features(alignment_dir, input_sequence)
         else:
             msa_features = self._process_msa_feats(alignment_dir, input_sequence, alignment_index)
         
@@ -939,7 +1093,7 @@ class DataPipeline:
         # If using seqemb mode, generate a dummy MSA features using just the sequence
         if seqemb_mode:
             msa_features = make_dummy_msa_feats(input_sequence)
-            sequence_embedding_features = self._process_seqemb_features(alignment_dir)
+            sequence_embedding_features = self._process_seqemb_features(alignment_dir, input_sequence)
         else:
             msa_features = self._process_msa_feats(alignment_dir, input_sequence, alignment_index)
 
@@ -996,7 +1150,7 @@ class DataPipeline:
         # If in sequence embedding mode, generate dummy MSA features using just the input sequence
         if seqemb_mode:
             msa_features = make_dummy_msa_feats(input_sequence)
-            sequence_embedding_features = self._process_seqemb_features(alignment_dir)
+            sequence_embedding_features = self._process_seqemb_features(alignment_dir, input_sequence)
         else:
             msa_features = self._process_msa_feats(alignment_dir, input_sequence, alignment_index)
 
@@ -1036,7 +1190,7 @@ class DataPipeline:
         # If in sequence embedding mode, generate dummy MSA features using just the input sequence
         if seqemb_mode:
             msa_features = make_dummy_msa_feats(input_sequence)
-            sequence_embedding_features = self._process_seqemb_features(alignment_dir)
+            sequence_embedding_features = self._process_seqemb_features(alignment_dir, input_sequence)
         else:
             msa_features = self._process_msa_feats(alignment_dir, input_sequence)
 
@@ -1079,7 +1233,7 @@ class DataPipeline:
         msa_list = []
         deletion_mat_list = []
         for seq, desc in zip(input_seqs, input_descs):
-            alignment_dir = os.path.join(
+            alignment_dir = resolve_alignment_dir(
                 super_alignment_dir, desc
             )
             msas = self._get_msas(
@@ -1115,7 +1269,7 @@ class DataPipeline:
 
         template_feature_list = []
         for seq, desc in zip(input_seqs, input_descs):
-            alignment_dir = os.path.join(
+            alignment_dir = resolve_alignment_dir(
                 super_alignment_dir, desc
             )
             hits = self._parse_template_hit_files(alignment_dir=alignment_dir,
@@ -1171,6 +1325,16 @@ class DataPipelineMultimer:
         if chain_alignment_index is None and not os.path.exists(chain_alignment_dir):
             raise ValueError(f"Alignments for {chain_id} not found...")
 
+        # We only construct the pairing features if there are 2 or more unique
+        # sequences. The uniprot MSA is parsed alongside the chain's other
+        # MSAs.
+        uniprot_msa = None
+        if not is_homomer_or_monomer:
+            uniprot_msa = self._submit_uniprot_msa(
+                chain_alignment_dir,
+                chain_alignment_index
+            )
+
         with temp_fasta_file(chain_fasta_str) as chain_fasta_path:
             chain_features = self._monomer_data_pipeline.process_fasta(
                 fasta_path=chain_fasta_path,
@@ -1178,20 +1342,42 @@ class DataPipelineMultimer:
                 alignment_index=chain_alignment_index
             )
 
-            # We only construct the pairing features if there are 2 or more unique
-            # sequences.
             if not is_homomer_or_monomer:
                 all_seq_msa_features = self._all_seq_msa_features(
                     chain_alignment_dir,
-                    chain_alignment_index
+                    chain_alignment_index,
+                    uniprot_msa=uniprot_msa.result(),
                 )
                 chain_features.update(all_seq_msa_features)
         return chain_features
 
+    def _submit_uniprot_msa(self, alignment_dir, alignment_index):
+        msa_parser = self._monomer_data_pipeline.msa_parser
+        if alignment_index is not None:
+            start, size = next(iter((start, size) for name, start, size in alignment_index["files"]
+                                    if name == 'uniprot_hits.sto'))
+
+            return msa_parser.submit(
+                os.path.join(alignment_dir, alignment_index["db"]),
+                "sto",
+                start,
+                size,
+            )
+        else:
+            uniprot_msa_path = os.path.join(alignment_dir, "uniprot_hits.sto")
+            if not os.path.exists(uniprot_msa_path):
+                chain_id = os.path.basename(os.path.normpath(alignment_dir))
+                raise ValueError(f"Missing 'uniprot_hits.sto' for {chain_id}. "
+                                 f"This is required for Multimer MSA pairing.")
+
+            return msa_parser.submit(uniprot_msa_path, "sto")
+
     @staticmethod
-    def _all_seq_msa_features(alignment_dir, alignment_index):
+    def _all_seq_msa_features(alignment_dir, alignment_index, uniprot_msa=None):
         """Get MSA features for unclustered uniprot, for pairing."""
-        if alignment_index is not None:
+        if uniprot_msa is not None:
+            msa = uniprot_msa
+        elif alignment_index is not None:
             fp = open(os.path.join(alignment_dir, alignment_index["db"]), "rb")
 
             def read_msa(start, size):
@@ -1251,7 +1437,7 @@ class DataPipelineMultimer:
                 chain_alignment_dir = alignment_dir
             else:
                 chain_alignment_index = None
-                chain_alignment_dir = os.path.join(alignment_dir, desc)
+                chain_alignment_dir = resolve_alignment_dir(alignment_dir, desc)
 
             chain_features = self._process_single_chain(
                 chain_id=desc,
@@ -1327,7 +1513,7 @@ class DataPipelineMultimer:
                 chain_alignment_dir = alignment_dir
             else:
                 chain_alignment_index = None
-                chain_alignment_dir = os.path.join(alignment_dir, desc)
+                chain_alignment_dir = resolve_alignment_dir(alignment_dir, desc)
 
             chain_features = self._process_single_chain(
                 chain_id=desc,
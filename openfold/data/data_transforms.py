@@ -42,6 +42,10 @@ MSA_FEATURE_NAMES = [
     "true_msa",
 ]
 
+# Number of extra MSA rows whose one-hot encoding is materialized at once
+# when clustering the extra MSA
+EXTRA_MSA_CHUNK_SIZE = 1024
+
 
 def cast_to_64bit_ints(protein):
     # We keep all ints as int64
@@ -287,7 +291,19 @@ def block_delete_msa(protein, config):
 
 
 @curry1
-def nearest_neighbor_clusters(protein, gap_agreement_weight=0.0):
+def nearest_neighbor_clusters(
+    protein, 
+    gap_agreement_weight=0.0, 
+    chunk_size=EXTRA_MSA_CHUNK_SIZE,
+):
+    """
+    Assign each extra MSA sequence to its nearest neighbor in the sampled
+    MSA.
+
+    Extra sequences are processed in blocks of chunk_size rows, such that
+    only one block of the one-hot extra MSA is alive at a time. A
+    chunk_size of None processes all rows at once.
+    """
     weights = torch.cat(
         [
             torch.ones(21, device=protein["msa"].device), 
@@ -300,23 +316,43 @@ def nearest_neighbor_clusters(protein, gap_agreement_weight=0.0):
     # Make agreement score as weighted Hamming distance
     msa_one_hot = make_one_hot(protein["msa"], 23)
     sample_one_hot = protein["msa_mask"][:, :, None] * msa_one_hot
-    extra_msa_one_hot = make_one_hot(protein["extra_msa"], 23)
-    extra_one_hot = protein["extra_msa_mask"][:, :, None] * extra_msa_one_hot
-
     num_seq, num_res, _ = sample_one_hot.shape
-    extra_num_seq, _, _ = extra_one_hot.shape
 
-    # Compute tf.einsum('mrc,nrc,c->mn', sample_one_hot, extra_one_hot, weights)
-    # in an optimized fashion to avoid possible memory or computation blowup.
-    agreement = torch.matmul(
-        torch.reshape(extra_one_hot, [extra_num_seq, num_res * 23]),
-        torch.reshape(
-            sample_one_hot * weights, [num_seq, num_res * 23]
-        ).transpose(0, 1),
-    )
+    # [N_res * 23, N_seq]
+    sample_weighted = torch.reshape(
+        sample_one_hot * weights, [num_seq, num_res * 23]
+    ).transpose(0, 1)
+    del msa_one_hot, sample_one_hot
+
+    extra_msa = protein["extra_msa"]
+    extra_msa_mask = protein["extra_msa_mask"]
+    extra_num_seq = extra_msa.shape[0]
+    if chunk_size is None or extra_num_seq == 0:
+        chunk_size = max(extra_num_seq, 1)
+
+    assignments = []
+    for start in range(0, max(extra_num_seq, 1), chunk_size):
+        end = start + chunk_size
+        extra_one_hot = (
+            extra_msa_mask[start:end, :, None] * 
+            make_one_hot(extra_msa[start:end], 23)
+        )
 
-    # Assign each sequence in the extra sequences to the closest MSA sample
-    protein["extra_cluster_assignment"] = torch.argmax(agreement, dim=1).to(
+        # Compute tf.einsum('mrc,nrc,c->mn', sample_one_hot, extra_one_hot, 
+        # weights) in an optimized fashion to avoid possible memory or 
+        # computation blowup.
+        agreement = torch.matmul(
+            torch.reshape(extra_one_hot, [-1, num_res * 23]),
+            sample_weighted,
+        )
+        del extra_one_hot
+
+        # Assign each sequence in the extra sequences to the closest MSA 
+        # sample
+        assignments.append(torch.argmax(agreement, dim=1))
+        del agreement
+
+    protein["extra_cluster_assignment"] = torch.cat(assignments).to(
         torch.int64
     )
     
@@ -351,20 +387,33 @@ def unsorted_segment_sum(data, segment_ids, num_segments):
 
 
 @curry1
-def summarize_clusters(protein):
-    """Produce profile and deletion_matrix_mean within each cluster."""
+def summarize_clusters(protein, chunk_size=EXTRA_MSA_CHUNK_SIZE):
+    """
+    Produce profile and deletion_matrix_mean within each cluster.
+
+    Cluster statistics are accumulated over blocks of chunk_size extra MSA
+    rows. A chunk_size of None processes all rows at once.
+    """
     num_seq = protein["msa"].shape[0]
 
-    def csum(x):
-        return unsorted_segment_sum(
-            x, protein["extra_cluster_assignment"], num_seq
-        )
+    def csum(x, segment_ids=protein["extra_cluster_assignment"]):
+        return unsorted_segment_sum(x, segment_ids, num_seq)
 
     mask = protein["extra_msa_mask"]
     mask_counts = 1e-6 + protein["msa_mask"] + csum(mask)  # Include center
 
-    msa_sum = csum(mask[:, :, None] * make_one_hot(protein["extra_msa"], 23))
-    msa_sum += make_one_hot(protein["msa"], 23)  # Original sequence
+    extra_msa = protein["extra_msa"]
+    extra_num_seq = extra_msa.shape[0]
+    if chunk_size is None or extra_num_seq == 0:
+        chunk_size = max(extra_num_seq, 1)
+
+    msa_sum = make_one_hot(protein["msa"], 23)  # Original sequence
+    for start in range(0, extra_num_seq, chunk_size):
+        end = start + chunk_size
+        msa_sum += csum(
+            mask[start:end, :, None] * make_one_hot(extra_msa[start:end], 23),
+            protein["extra_cluster_assignment"][start:end],
+        )
     protein["cluster_profile"] = msa_sum / mask_counts[:, :, None]
     del msa_sum
 
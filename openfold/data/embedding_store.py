@@ -0,0 +1,169 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A single-file store of the sequence embeddings used by the single sequence
+(soloseq) models, as an alternative to one .pt file per sequence.
+
+Embeddings are appended as float16 rows to EMBEDDINGS_FILENAME and
+indexed by sequence hash in INDEX_FILENAME, so identical sequences are
+embedded once. Readers memory-map the embeddings and slice them without
+copying.
+"""
+import json
+import os
+from typing import Sequence
+
+import numpy as np
+import torch
+
+from openfold.data.alignment_store import sequence_hash
+
+
+EMBEDDINGS_FILENAME = "embeddings.bin"
+INDEX_FILENAME = "index.jsonl"
+META_FILENAME = "meta.json"
+
+
+class EmbeddingStore:
+    def __init__(self, path: str):
+        """
+            Args:
+                path:
+                    Directory of the store. Created on the first write
+        """
+        self.path = path
+        self.dim = None
+        self._index = {}
+        self._index_size = 0
+        self._embeddings = None
+
+        meta_path = os.path.join(path, META_FILENAME)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as fp:
+                self.dim = json.load(fp)["dim"]
+
+    def _refresh(self):
+        """ Picks up entries that other processes appended """
+        index_path = os.path.join(self.path, INDEX_FILENAME)
+        if not os.path.exists(index_path):
+            return
+
+        with open(index_path, "rb") as fp:
+            fp.seek(self._index_size)
+            for line in fp:
+                # Skips an entry that is still being written
+                if not line.endswith(b"\n"):
+                    break
+                entry = json.loads(line)
+                self._index[entry["key"]] = (entry["offset"], entry["length"])
+                self._index_size += len(line)
+
+        if self.dim is None and len(self._index) > 0:
+            with open(os.path.join(self.path, META_FILENAME), "r") as fp:
+                self.dim = json.load(fp)["dim"]
+
+    def __contains__(self, seq: str) -> bool:
+        key = sequence_hash(seq)
+        if key not in self._index:
+            self._refresh()
+        return key in self._index
+
+    def __len__(self) -> int:
+        self._refresh()
+        return len(self._index)
+
+    def get(self, seq: str) -> torch.Tensor:
+        """
+            Returns the [N_res, C] float16 embedding of a sequence. It's a
+            view of the memory-mapped store, copied only when written to.
+        """
+        if seq not in self:
+            raise KeyError(f"No embedding for sequence {seq}")
+
+        offset, length = self._index[sequence_hash(seq)]
+        if(self._embeddings is None or
+           offset + length > self._embeddings.shape[0]):
+            # The store grew since it was mapped
+            self._embeddings = np.memmap(
+                os.path.join(self.path, EMBEDDINGS_FILENAME),
+                dtype=np.float16,
+                mode="c",
+            ).reshape(-1, self.dim)
+
+        return torch.from_numpy(self._embeddings[offset:offset + length])
+
+    def add(
+        self,
+        seqs: Sequence[str],
+        embeddings: Sequence[torch.Tensor],
+    ):
+        """
+            Appends the [N_res, C] embeddings of sequences that aren't in the
+            store yet. Only one process may write to a store at a time.
+        """
+        self._refresh()
+        os.makedirs(self.path, exist_ok=True)
+
+        rows = []
+        entries = []
+        embeddings_path = os.path.join(self.path, EMBEDDINGS_FILENAME)
+        offset = 0
+        if os.path.exists(embeddings_path):
+            offset = os.path.getsize(embeddings_path) // (2 * self.dim)
+
+        new_keys = set()
+        for seq, emb in zip(seqs, embeddings):
+            key = sequence_hash(seq)
+            if key in self._index or key in new_keys:
+                continue
+            new_keys.add(key)
+
+            emb = emb.detach().to(device="cpu", dtype=torch.float16).numpy()
+            if self.dim is None:
+                self.dim = emb.shape[-1]
+                with open(os.path.join(self.path, META_FILENAME), "w") as fp:
+                    json.dump({"dim": self.dim, "dtype": "float16"}, fp)
+            elif emb.shape[-1] != self.dim:
+                raise ValueError(
+                    f"Embedding dimension {emb.shape[-1]} doesn't match the "
+                    f"store's ({self.dim})"
+                )
+
+            rows.append(emb)
+            entries.append(
+                {"key": key, "offset": offset, "length": emb.shape[0]}
+            )
+            offset += emb.shape[0]
+
+        if len(rows) == 0:
+            return
+
+        # The embeddings are written before the index entries pointing to
+        # them
+        with open(embeddings_path, "ab") as fp:
+            for emb in rows:
+                fp.write(np.ascontiguousarray(emb).tobytes())
+        with open(os.path.join(self.path, INDEX_FILENAME), "a") as fp:
+            fp.write("".join(json.dumps(e) + "\n" for e in entries))
+
+        self._refresh()
+
+    def missing(self, seqs: Sequence[str]) -> Sequence[str]:
+        """ Returns the distinct sequences that aren't in the store yet """
+        self._refresh()
+        return list(dict.fromkeys(
+            s for s in seqs if sequence_hash(s) not in self._index
+        ))
+
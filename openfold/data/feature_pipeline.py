@@ -119,6 +119,12 @@ def np_example_to_features(
             fill_value=use_clamped_fape_value,
             dtype=torch.float32,
         )
+    elif isinstance(features, input_pipeline.LazyRecyclingBatch):
+        # Features of a lazy batch don't carry a recycling dimension
+        features.static_feats["use_clamped_fape"] = torch.tensor(
+            0.0, dtype=torch.float32
+        )
+        return features
     else:
         features["use_clamped_fape"] = torch.full(
             size=[cfg.common.max_recycling_iters + 1],
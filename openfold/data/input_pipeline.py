@@ -155,7 +155,13 @@ def ensembled_transform_fns(common_cfg, mode_cfg, ensemble_seed):
 
 
 def process_tensors_from_config(tensors, common_cfg, mode_cfg):
-    """Based on the config, apply filters and transformations to the data."""
+    """
+    Based on the config, apply filters and transformations to the data.
+
+    If mode_cfg.lazy_recycling is set, the recycling dimension is not
+    materialized. A LazyRecyclingBatch is returned instead, which generates
+    the features of each recycling iteration on demand.
+    """
 
     ensemble_seed = random.randint(0, torch.iinfo(torch.int32).max)
 
@@ -187,6 +193,11 @@ def process_tensors_from_config(tensors, common_cfg, mode_cfg):
     else:
         num_recycling = common_cfg.max_recycling_iters
 
+    if mode_cfg.get("lazy_recycling", False):
+        return LazyRecyclingBatch(
+            tensors, wrap_ensemble_fn, num_recycling + 1, ensemble_seed,
+        )
+
     tensors = map_fn(
         lambda x: wrap_ensemble_fn(tensors, x), torch.arange(num_recycling + 1)
     )
@@ -210,3 +221,108 @@ def map_fn(fun, x):
             [dict_i[feat] for dict_i in ensembles], dim=-1
         )
     return ensembled_dict
+
+
+class LazyRecyclingBatch:
+    """
+    Feature batch whose recycling dimension is generated on demand.
+
+    Instead of stacking the ensembled features of every recycling iteration
+    along a trailing dimension, only the non-ensembled features are kept
+    and the sampled/masked features of a given iteration are computed when
+    that iteration is requested. The random state of each iteration is
+    derived from a fixed seed, so that an iteration can be regenerated
+    deterministically. Feature memory is therefore independent of the
+    number of recycling iterations.
+
+    Features returned by get_cycle have no recycling dimension. The most
+    recently generated iteration is cached, so that hooks running during
+    the same iteration don't regenerate it.
+    """
+    def __init__(self, tensors, ensemble_fn, no_cycles, seed):
+        """
+        Args:
+            tensors:
+                Dictionary of non-ensembled feature tensors
+            ensemble_fn:
+                Function mapping (tensors, cycle_no) to the features of
+                that recycling iteration
+            no_cycles:
+                Number of recycling iterations (incl. the first pass)
+            seed:
+                Base seed. Iteration i is generated with seed + i
+        """
+        self.tensors = tensors
+        self.ensemble_fn = ensemble_fn
+        self.no_cycles = no_cycles
+        self.seed = seed
+        self.static_feats = {}
+        self.device = None
+
+        self._cached_cycle_no = None
+        self._cached_feats = None
+
+    def __len__(self):
+        return self.no_cycles
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def keys(self):
+        cycle_no = self._cached_cycle_no
+        if cycle_no is None:
+            cycle_no = 0
+        return self.get_cycle(cycle_no).keys()
+
+    def to(self, device):
+        """Sets the device to which generated features are moved."""
+        self.device = device
+        if self._cached_feats is not None:
+            self._cached_feats = {
+                k: v.to(device) for k, v in self._cached_feats.items()
+            }
+        return self
+
+    def get_cycle(self, cycle_no):
+        """
+        Args:
+            cycle_no:
+                Index of the recycling iteration. Negative indices count
+                from the last iteration
+        Returns:
+            Dictionary of the features of that iteration, without the
+            recycling dimension
+        """
+        if cycle_no < 0:
+            cycle_no += self.no_cycles
+        if not 0 <= cycle_no < self.no_cycles:
+            raise IndexError(
+                f"Recycling iteration {cycle_no} out of range "
+                f"({self.no_cycles} iterations)"
+            )
+
+        if cycle_no == self._cached_cycle_no:
+            return self._cached_feats
+
+        # Drop the previous iteration before generating the next one
+        self._cached_cycle_no = None
+        self._cached_feats = None
+
+        with torch.no_grad(), torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed + cycle_no)
+            feats = self.ensemble_fn(self.tensors, cycle_no)
+
+        feats.update(self.static_feats)
+        if self.device is not None:
+            feats = {k: v.to(self.device) for k, v in feats.items()}
+
+        self._cached_cycle_no = cycle_no
+        self._cached_feats = feats
+
+        return feats
+
+    def last(self):
+        return self.get_cycle(-1)
@@ -20,6 +20,7 @@ from openfold.data import (
     data_transforms,
     data_transforms_multimer,
 )
+from openfold.data.input_pipeline import LazyRecyclingBatch
 
 
 def groundtruth_transforms_fns():
@@ -125,7 +126,11 @@ def prepare_ground_truth_features(tensors):
 
 
 def process_tensors_from_config(tensors, common_cfg, mode_cfg):
-    """Based on the config, apply filters and transformations to the data."""
+    """
+    Based on the config, apply filters and transformations to the data.
+
+    See input_pipeline.process_tensors_from_config for lazy_recycling.
+    """
 
     process_gt_feats = mode_cfg.supervised
     gt_tensors = {}
@@ -153,6 +158,15 @@ def process_tensors_from_config(tensors, common_cfg, mode_cfg):
         d["ensemble_index"] = i
         return fn(d)
 
+    if mode_cfg.get("lazy_recycling", False):
+        if process_gt_feats:
+            raise ValueError(
+                "lazy_recycling is not supported for supervised modes"
+            )
+        return LazyRecyclingBatch(
+            tensors, wrap_ensemble_fn, num_recycling + 1, ensemble_seed,
+        )
+
     tensors = map_fn(
         lambda x: wrap_ensemble_fn(tensors, x), torch.arange(num_recycling + 1)
     )
@@ -0,0 +1,305 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Parsing of the MSA files of an alignment directory in a pool of worker
+processes, so that a target's MSAs are parsed in the time of the largest one.
+
+Workers hand parsed MSAs back through shared memory: the aligned sequences as
+a uint8 array of their characters and the deletion matrix as an int32 array.
+This avoids pickling MSAs as lists of strings and lists of lists of ints,
+which for deep MSAs takes about as long as parsing them.
+"""
+import concurrent.futures
+import multiprocessing
+import os
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional
+
+import numpy as np
+
+from openfold.data import parsers
+
+
+def read_alignment(
+    path: str,
+    start: Optional[int] = None,
+    size: Optional[int] = None,
+) -> str:
+    """ Reads an alignment file, or a slice of an alignment database """
+    if start is None:
+        with open(path, "r") as fp:
+            return fp.read()
+
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        return fp.read(size).decode("utf-8")
+
+
+def parse_msa_string(msa_string: str, fmt: str) -> parsers.Msa:
+    if fmt == "a3m":
+        return parsers.parse_a3m(msa_string)
+    elif fmt == "sto":
+        return parsers.parse_stockholm(msa_string)
+
+    raise ValueError(f"Unrecognized MSA format: {fmt}")
+
+
+def _as_uint8(sequences):
+    try:
+        return np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8)
+    except UnicodeEncodeError:
+        return None
+
+
+def _a3m_arrays(a3m_string):
+    """
+        Vectorized parsers.parse_a3m, returning the aligned sequences as a
+        uint8 array. Returns None for MSAs it can't represent as arrays.
+    """
+    sequences, descriptions = parsers.parse_fasta(a3m_string)
+    raw = _as_uint8(sequences)
+    lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+    if raw is None or len(sequences) == 0 or np.any(lengths == 0):
+        return None
+
+    # Lowercase residues are insertions relative to the query
+    lower = (raw >= ord("a")) & (raw <= ord("z"))
+    starts = np.cumsum(lengths) - lengths
+    no_aligned = np.add.reduceat(~lower, starts)
+    no_res = no_aligned[0]
+    if no_res == 0 or np.any(no_aligned != no_res):
+        return None
+
+    # Deletions before an aligned residue are the insertions since the
+    # previous one, or since the start of its sequence
+    insertions = np.cumsum(lower, dtype=np.int64)
+    row_base = np.where(starts > 0, insertions[starts - 1], 0)
+    insertions = insertions[~lower].reshape(len(sequences), no_res)
+    deletion_matrix = np.diff(insertions, axis=1, prepend=row_base[:, None])
+
+    aligned = raw[~lower].reshape(len(sequences), no_res)
+
+    return aligned, deletion_matrix, descriptions
+
+
+def _stockholm_arrays(stockholm_string):
+    """ Vectorized parsers.parse_stockholm. See _a3m_arrays """
+    name_to_sequence = parsers.stockholm_sequences(stockholm_string)
+    sequences = list(name_to_sequence.values())
+    raw = _as_uint8(sequences)
+    if raw is None or len(sequences) == 0:
+        return None
+
+    no_cols = len(sequences[0])
+    if no_cols == 0 or any(len(s) != no_cols for s in sequences):
+        return None
+    raw = raw.reshape(len(sequences), no_cols)
+
+    # Columns with gaps in the query are removed, and residues in them count
+    # as deletions
+    gap = ord("-")
+    keep = raw[0] != gap
+    if not np.any(keep):
+        return None
+    insertions = np.cumsum((raw != gap) & ~keep[None], axis=1, dtype=np.int64)
+    insertions = insertions[:, keep]
+    deletion_matrix = np.diff(insertions, axis=1, prepend=0)
+
+    aligned = np.ascontiguousarray(raw[:, keep])
+
+    return aligned, deletion_matrix, list(name_to_sequence.keys())
+
+
+def _deletion_offset(no_seqs, no_res):
+    # Keeps the int32 deletion matrix aligned
+    return -(-(no_seqs * no_res) // 8) * 8
+
+
+def _parse_to_shared_memory(path, fmt, start, size):
+    """ Runs in the workers """
+    msa_string = read_alignment(path, start, size)
+    if fmt == "a3m":
+        arrays = _a3m_arrays(msa_string)
+    elif fmt == "sto":
+        arrays = _stockholm_arrays(msa_string)
+    else:
+        raise ValueError(f"Unrecognized MSA format: {fmt}")
+
+    if arrays is None:
+        return parse_msa_string(msa_string, fmt)
+
+    aligned, deletion_matrix, descriptions = arrays
+    no_seqs, no_res = aligned.shape
+
+    offset = _deletion_offset(no_seqs, no_res)
+    nbytes = offset + no_seqs * no_res * 4
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    try:
+        np.ndarray(
+            (no_seqs, no_res), dtype=np.uint8, buffer=shm.buf
+        )[:] = aligned
+        np.ndarray(
+            (no_seqs, no_res), dtype=np.int32, buffer=shm.buf, offset=offset
+        )[:] = deletion_matrix
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+
+    shm.close()
+
+    # The parent process takes ownership of the segment and unlinks it
+    resource_tracker.unregister(shm._name, "shared_memory")
+
+    return shm.name, no_seqs, no_res, descriptions
+
+
+def _msa_from_shared_memory(result) -> parsers.Msa:
+    if isinstance(result, parsers.Msa):
+        return result
+
+    name, no_seqs, no_res, descriptions = result
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        seq_str = bytes(shm.buf[:no_seqs * no_res]).decode("ascii")
+        sequences = [
+            seq_str[i * no_res: (i + 1) * no_res] for i in range(no_seqs)
+        ]
+        # Lists of lists, like those of parsers.parse_a3m and
+        # parse_stockholm
+        deletion_matrix = np.ndarray(
+            (no_seqs, no_res),
+            dtype=np.int32,
+            buffer=shm.buf,
+            offset=_deletion_offset(no_seqs, no_res),
+        ).tolist()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return parsers.Msa(
+        sequences=sequences,
+        deletion_matrix=deletion_matrix,
+        descriptions=descriptions,
+    )
+
+
+class _ParsedMsa:
+    """ Future-like wrapper that unpacks a worker's result on demand """
+    def __init__(self, future):
+        self._future = future
+        self._msa = None
+
+    def result(self) -> parsers.Msa:
+        if self._msa is None:
+            self._msa = _msa_from_shared_memory(self._future.result())
+        return self._msa
+
+    def __del__(self):
+        # Frees the shared memory of results that were never collected
+        if self._msa is None:
+            try:
+                result = self._future.result()
+                if not isinstance(result, parsers.Msa):
+                    shm = shared_memory.SharedMemory(name=result[0])
+                    shm.close()
+                    shm.unlink()
+            except Exception:
+                pass
+
+
+class _SerialMsa:
+    def __init__(self, path, fmt, start, size):
+        self._msa = parse_msa_string(read_alignment(path, start, size), fmt)
+
+    def result(self) -> parsers.Msa:
+        return self._msa
+
+
+class MsaParser:
+    """
+        Parses MSA files, in a pool of no_workers processes if no_workers is
+        positive. Submitted files are parsed concurrently, and each call to
+        submit returns an object whose result() method returns the parsed
+        parsers.Msa, the same whether or not it was parsed in the pool.
+
+        Processes that can't have children, like DataLoader workers, parse
+        serially.
+    """
+    def __init__(self, no_workers: int = 0):
+        self.no_workers = no_workers
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        if(self.no_workers <= 0 or
+           multiprocessing.current_process().daemon):
+            return None
+
+        # Pools don't survive forks, e.g. into DataLoader workers
+        if self._executor is None or self._pid != os.getpid():
+            # Forking a process that has initialized CUDA or torch's
+            # threads can deadlock the children
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context("forkserver")
+            else:
+                mp_context = multiprocessing.get_context("spawn")
+
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.no_workers,
+                mp_context=mp_context,
+            )
+            self._pid = os.getpid()
+
+        return self._executor
+
+    def submit(
+        self,
+        path: str,
+        fmt: str,
+        start: Optional[int] = None,
+        size: Optional[int] = None,
+    ):
+        """
+            Args:
+                path:
+                    Path of the MSA file, or of the alignment database
+                    holding it
+                fmt:
+                    "a3m" or "sto"
+                start:
+                    Offset of the MSA in the alignment database
+                size:
+                    Size of the MSA in the alignment database
+        """
+        executor = self._get_executor()
+        if executor is None:
+            return _SerialMsa(path, fmt, start, size)
+
+        return _ParsedMsa(
+            executor.submit(_parse_to_shared_memory, path, fmt, start, size)
+        )
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown()
+        self._executor = None
+
+    def __getstate__(self):
+        # The pool stays with the process that created it
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_pid"] = None
+        return state
@@ -98,6 +98,21 @@ def parse_fasta(fasta_string: str) -> Tuple[Sequence[str], Sequence[str]]:
     return sequences, descriptions
 
 
+def stockholm_sequences(stockholm_string: str) -> Dict[str, str]:
+    """Returns the (unprocessed) sequences of a stockholm file by name."""
+    name_to_sequence = collections.OrderedDict()
+    for line in stockholm_string.splitlines():
+        line = line.strip()
+        if not line or line.startswith(("#", "//")):
+            continue
+        name, sequence = line.split()
+        if name not in name_to_sequence:
+            name_to_sequence[name] = ""
+        name_to_sequence[name] += sequence
+
+    return name_to_sequence
+
+
 def parse_stockholm(stockholm_string: str) -> Msa:
     """Parses sequences and deletion matrix from stockholm format alignment.
 
@@ -115,15 +130,7 @@ def parse_stockholm(stockholm_string: str) -> Msa:
             * The names of the targets matched, including the jackhmmer subsequence
                 suffix.
     """
-    name_to_sequence = collections.OrderedDict()
-    for line in stockholm_string.splitlines():
-        line = line.strip()
-        if not line or line.startswith(("#", "//")):
-            continue
-        name, sequence = line.split()
-        if name not in name_to_sequence:
-            name_to_sequence[name] = ""
-        name_to_sequence[name] += sequence
+    name_to_sequence = stockholm_sequences(stockholm_string)
 
     msa = []
     deletion_matrix = []
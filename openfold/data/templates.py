@@ -946,54 +946,118 @@ def _process_single_hit(
         return SingleHitResult(features=None, error=error, warning=None)
 
 
-def get_custom_template_features(
+class CustomTemplateFeaturizer:
+    """
+    Featurizes a single chain of a structure as the template of any number
+    of queries threaded onto it residue by residue, i.e. with query residue
+    i aligned to template residue i.
+
+    The mmCIF file is parsed and the chain's atom positions are extracted
+    once. Since the alignment only depends on the length of the query, the
+    features of each query length are computed once as well, and queries of
+    the same length share them. Callers mustn't modify them in place.
+    """
+    def __init__(
+        self,
         mmcif_path: str,
-        query_sequence: str,
         pdb_id: str,
         chain_id: str,
-        kalign_binary_path: str):
+    ):
+        with open(mmcif_path, "r") as fp:
+            cif_string = fp.read()
+
+        mmcif_object = mmcif_parsing.parse(
+            file_id=pdb_id, mmcif_string=cif_string
+        ).mmcif_object
+        if mmcif_object is None or not mmcif_object.chain_to_seqres:
+            raise NoChainsError(
+                "No chains in PDB: %s_%s" % (pdb_id, chain_id)
+            )
 
-    with open(mmcif_path, "r") as mmcif_path:
-        cif_string = mmcif_path.read()
+        self.pdb_id = pdb_id
+        self.template_sequence = mmcif_object.chain_to_seqres[chain_id]
+        seqres, self.chain_id, self.mapping_offset = _find_template_in_pdb(
+            template_chain_id=chain_id,
+            template_sequence=self.template_sequence,
+            mmcif_object=mmcif_object,
+        )
 
-    mmcif_parse_result = mmcif_parsing.parse(
-        file_id=pdb_id, mmcif_string=cif_string
-    )
-    template_sequence = mmcif_parse_result.mmcif_object.chain_to_seqres[chain_id]
+        try:
+            # Essentially set to infinity - we don't want to reject templates
+            # unless they're really really bad.
+            self.all_atom_positions, self.all_atom_mask = _get_atom_positions(
+                mmcif_object,
+                self.chain_id,
+                max_ca_ca_distance=150.0,
+                _zero_center_positions=True,
+            )
+        except (CaDistanceError, KeyError) as ex:
+            raise NoAtomDataInTemplateError(
+                "Could not get atom data (%s_%s): %s"
+                % (pdb_id, self.chain_id, str(ex))
+            ) from ex
 
+        self._features = {}
 
-    mapping = {x:x for x, _ in enumerate(query_sequence)}
+    def _make_features(self, num_res: int) -> Dict[str, Any]:
+        start = self.mapping_offset
+        if start + num_res > self.all_atom_positions.shape[0]:
+            raise QueryToTemplateAlignError(
+                "Query of length %d is longer than template %s_%s"
+                % (num_res, self.pdb_id, self.chain_id)
+            )
 
+        positions = self.all_atom_positions[start:start + num_res]
+        mask = self.all_atom_mask[start:start + num_res]
 
-    features, warnings = _extract_template_features(
-        mmcif_object=mmcif_parse_result.mmcif_object,
-        pdb_id=pdb_id,
-        mapping=mapping,
-        template_sequence=template_sequence,
-        query_sequence=query_sequence,
-        template_chain_id=chain_id,
-        kalign_binary_path=kalign_binary_path,
-        _zero_center_positions=True
-    )
-    features["template_sum_probs"] = [1.0]
+        # Alanine (AA with the lowest number of atoms) has 5 atoms (C, CA, CB, N, O).
+        if np.sum(mask) < 5:
+            raise TemplateAtomMaskAllZerosError(
+                "Template all atom mask was all zeros: %s_%s. Residue range: %d-%d"
+                % (self.pdb_id, self.chain_id, start, start + num_res - 1)
+            )
+
+        template_sequence = self.template_sequence[:num_res]
+        features = {
+            "template_all_atom_positions": positions,
+            "template_all_atom_mask": mask,
+            "template_sequence": template_sequence.encode(),
+            "template_aatype": residue_constants.sequence_to_onehot(
+                template_sequence, residue_constants.HHBLITS_AA_TO_ID
+            ),
+            "template_domain_names":
+                f"{self.pdb_id.lower()}_{self.chain_id}".encode(),
+            "template_sum_probs": [1.0],
+        }
 
-    # TODO: clean up this logic
-    template_features = {}
-    for template_feature_name in TEMPLATE_FEATURES:
-        template_features[template_feature_name] = []
+        return {
+            name: np.stack([features[name]], axis=0).astype(dtype)
+            for name, dtype in TEMPLATE_FEATURES.items()
+        }
 
-    for k in template_features:
-        template_features[k].append(features[k])
+    def get_features(self, query_sequence: str) -> "TemplateSearchResult":
+        num_res = len(query_sequence)
+        if num_res not in self._features:
+            self._features[num_res] = self._make_features(num_res)
 
-    for name in template_features:
-        template_features[name] = np.stack(
-            template_features[name], axis=0
-        ).astype(TEMPLATE_FEATURES[name])
+        return TemplateSearchResult(
+            features=self._features[num_res], errors=None, warnings=None
+        )
 
-    return TemplateSearchResult(
-        features=template_features, errors=None, warnings=warnings
-    )
 
+def get_custom_template_features(
+        mmcif_path: str,
+        query_sequence: str,
+        pdb_id: str,
+        chain_id: str,
+        kalign_binary_path: str):
+    # The template is the chain's own SEQRES sequence, so it's never
+    # realigned with kalign
+    return CustomTemplateFeaturizer(
+        mmcif_path=mmcif_path,
+        pdb_id=pdb_id,
+        chain_id=chain_id,
+    ).get_features(query_sequence)
 
 
 @dataclasses.dataclass(frozen=True)
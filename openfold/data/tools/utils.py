@@ -14,13 +14,14 @@
 # limitations under the License.
 
 """Common utilities for data pipeline tools."""
+import concurrent.futures
 import contextlib
 import datetime
 import logging
 import shutil
 import tempfile
 import time
-from typing import Optional
+from typing import Any, Callable, Dict, Mapping, Optional, Sequence, Tuple
 
 
 @contextlib.contextmanager
@@ -46,3 +47,68 @@ def to_date(s: str):
     return datetime.datetime(
         year=int(s[:4]), month=int(s[5:7]), day=int(s[8:10])
     )
+
+
+def run_task_graph(
+    tasks: Mapping[str, Tuple[Callable[..., Any], Sequence[str]]],
+    max_workers: Optional[int] = None,
+) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """
+    Runs a DAG of tasks in a thread pool, starting each task as soon as the
+    tasks it depends on have finished.
+
+    Args:
+        tasks:
+            Maps task names to (fn, deps) pairs. fn is called with the
+            results of the tasks named in deps, in order
+        max_workers:
+            Maximum number of tasks to run at once. Defaults to the number
+            of tasks
+    Returns:
+        The results and wall times in seconds of the tasks, by name
+    """
+    for name, (_, deps) in tasks.items():
+        for dep in deps:
+            if dep not in tasks:
+                raise ValueError(f"Task {name} depends on unknown task {dep}")
+
+    results = {}
+    timings = {}
+
+    def run_timed(name, fn, *args):
+        tic = time.perf_counter()
+        with timing(name):
+            out = fn(*args)
+        timings[name] = time.perf_counter() - tic
+        return out
+
+    if max_workers is None:
+        max_workers = len(tasks)
+
+    pending = dict(tasks)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(max_workers, 1)
+    ) as executor:
+        while pending or running:
+            for name, (fn, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    del pending[name]
+                    args = [results[dep] for dep in deps]
+                    future = executor.submit(run_timed, name, fn, *args)
+                    running[future] = name
+
+            if not running:
+                raise ValueError(
+                    f"Tasks {list(pending.keys())} have cyclic dependencies"
+                )
+
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                # Re-raises the first failure. Tasks that are already
+                # running finish before the pool shuts down
+                results[running.pop(future)] = future.result()
+
+    return results, timings
@@ -2,12 +2,23 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 import logging
+
+from openfold.doctor.utils import chain_callbacks, to_numpy
+from openfold.utils.profiler import profiled
+
 logger = logging.getLogger(__file__)
 logger.setLevel(level=logging.DEBUG)
 
 class AttnExporter:
-    def __init__(self, model, args, output_dir, avg_only=False):
+    def __init__(self, model, args, output_dir, avg_only=False, batch_index=None, num_res=None):
+        """
+        For batched inference, batch_index is the index of the target in
+        the batch and num_res its unpadded residue count. The exporters of
+        the targets of a batch share the attention modules' callbacks.
+        """
         self.model = model
+        self.batch_index = batch_index
+        self.num_res = num_res
         self.args = args
         self.output_dir = output_dir
         self.avg_only = avg_only
@@ -19,11 +30,74 @@ class AttnExporter:
         os.makedirs(self.row_dir, exist_ok=True)
 
         # set callbacks
+        self.handles = []
+        for block in self.model.evoformer.blocks:
+            self._set_callback(block.msa_att_row.mha, self._attn_row_callback)
         for block in self.model.evoformer.blocks:
-            block.msa_att_row.mha.save_attn_callback = self._attn_row_callback
+            if not block.no_column_attention:
+                self._set_callback(block.msa_att_col._msa_att.mha, self._attn_col_callback)
+
+        if batch_index is not None:
+            # The attention weights of chunked attention arrive in chunks of
+            # the flattened batch dimensions. These hooks record where each
+            # target's rows are: MSA sequences for row attention and
+            # residues for column attention
+            self._rows = {}
+            for block in self.model.evoformer.blocks:
+                self.handles.append(block.msa_att_row.register_forward_pre_hook(
+                    lambda module, input: self._start_rows("row", input[0].shape[-3])
+                ))
+                if not block.no_column_attention:
+                    self.handles.append(block.msa_att_col.register_forward_pre_hook(
+                        lambda module, input: self._start_rows("col", input[0].shape[-2])
+                    ))
+
+    def _set_callback(self, mha, callback):
+        if self.batch_index is None:
+            mha.save_attn_callback = callback
+        else:
+            mha.save_attn_callback = chain_callbacks(
+                mha.save_attn_callback, callback
+            )
+
+    def remove(self):
+        """
+        Removes the callbacks, including those of other targets of a batch
+        """
         for block in self.model.evoformer.blocks:
+            block.msa_att_row.mha.save_attn_callback = None
             if not block.no_column_attention:
-                block.msa_att_col._msa_att.mha.save_attn_callback = self._attn_col_callback 
+                block.msa_att_col._msa_att.mha.save_attn_callback = None
+        for handle in self.handles:
+            handle.remove()
+
+    def _start_rows(self, kind, rows_per_target):
+        # [rows per target, offset of the next chunk]
+        self._rows[kind] = [rows_per_target, 0]
+
+    def _target_rows(self, kind, a):
+        """
+        Returns the rows of the [*, H, Q, K] attention weights a that belong
+        to the target, or None if there are none
+        """
+        a = a.reshape(-1, *a.shape[-3:])
+        rows_per_target, offset = self._rows[kind]
+        self._rows[kind][1] += a.shape[0]
+
+        # Index of the chunk's first row among the target's rows
+        first = offset - self.batch_index * rows_per_target
+        start = max(-first, 0)
+        end = min(rows_per_target - first, a.shape[0])
+        if kind == "col":
+            # Rows past the target's length are padding residues
+            end = min(self.num_res - first, end)
+        else:
+            a = a[..., :self.num_res, :self.num_res]
+
+        if start >= end:
+            return None
+
+        return a[start:end]
 
     def _attn_col_hook(self, attn_block, input, output):
         logger.debug("col hook")
@@ -31,11 +105,16 @@ class AttnExporter:
 
     def _attn_row_hook(self, attn_block, input, output):
         logger.debug("row hook")
-        _m = output.detach().cpu().numpy()
+        _m = to_numpy(output)
         logger.debug(f"m: {_m.shape}")
 
+    @profiled("doctor_export")
     def _attn_col_callback(self, a):
-        _a = a.detach().cpu().numpy()
+        if self.batch_index is not None:
+            a = self._target_rows("col", a)
+            if a is None:
+                return
+        _a = to_numpy(a)
         logger.debug(f"a_col: {_a.shape}")
         num_channels = 32
         num_residues, num_heads, x_dim, y_dim = _a.shape
@@ -53,8 +132,13 @@ class AttnExporter:
                         self._save_heatmap(_a[res_id, head, :num_channels, :num_channels], title, filename)
         self.col_calls += 1
 
+    @profiled("doctor_export")
     def _attn_row_callback(self, a):
-        _a = a.detach().cpu().numpy()
+        if self.batch_index is not None:
+            a = self._target_rows("row", a)
+            if a is None:
+                return
+        _a = to_numpy(a)
         logger.debug(f"a_row: {_a.shape}")
         slice_dim, num_heads, x_dim, y_dim = _a.shape
         num_residues = x_dim  # == y_dim
@@ -2,8 +2,9 @@ import logging
 import os
 import numpy as np
 
+from openfold.doctor.utils import to_numpy
 from openfold.np import protein
-from openfold.utils.tensor_utils import tensor_tree_map
+from openfold.utils.script_utils import prep_output_metadata
 from openfold.utils.feats import atom14_to_atom37
 
 
@@ -37,6 +38,9 @@ class Doctor(metaclass=Singleton):
         self.feats = None
         self.inplace_safe = None
         self.num = 0
+        # prep_output_metadata of self.feats
+        self.metadata = None
+        self.metadata_src = None
 
 
     def evoformer_output(self, m, z, linear):
@@ -70,7 +74,10 @@ class Doctor(metaclass=Singleton):
         #self.cycle_no += 1
         #self.feats = tensor_tree_map(lambda x: np.array(x.cpu()), batch)
 
-        _out = tensor_tree_map(lambda x: np.array(x.cpu()), out)
+        _out = {
+            k: to_numpy(out[k])
+            for k in ["final_atom_positions", "final_atom_mask"]
+        }
 
         unrelaxed_protein = self.prep_intermediate_output(_out)
 
@@ -103,54 +110,30 @@ class Doctor(metaclass=Singleton):
 
 
     def prep_intermediate_output(self, out):
-        # Prep protein metadata
-        template_domain_names = []
-        template_chain_index = None
-        if self.feature_processor.config.common.use_templates and "template_domain_names" in self.feature_dict:
-            template_domain_names = [
-                t.decode("utf-8") for t in self.feature_dict["template_domain_names"]
-            ]
-
-            # This works because templates are not shuffled during inference
-            template_domain_names = template_domain_names[
-                                    :self.feature_processor.config.predict.max_templates
-                                    ]
-
-            if "template_chain_index" in self.feature_dict:
-                template_chain_index = self.feature_dict["template_chain_index"]
-                template_chain_index = template_chain_index[
-                                       :self.feature_processor.config.predict.max_templates
-                                       ]
-
-        no_recycling = self.feature_processor.config.common.max_recycling_iters
-        remark = ', '.join([
-            f"no_recycling={no_recycling}",
-            f"max_templates={self.feature_processor.config.predict.max_templates}",
-            f"config_preset={self.config_preset}",
-        ])
-
-        # For multi-chain FASTAs
-        ri = self.feature_dict["residue_index"]
-        chain_index = (ri - np.arange(ri.shape[0])) / self.multimer_ri_gap
-        chain_index = chain_index.astype(np.int64)
-        cur_chain = 0
-        prev_chain_max = 0
-        batch = tensor_tree_map(lambda x: np.array(x.cpu()), self.feats)
-        for i, c in enumerate(chain_index):
-            if c != cur_chain:
-                cur_chain = c
-                prev_chain_max = i + cur_chain * self.multimer_ri_gap
-
-            batch["residue_index"][i] -= prev_chain_max
+        # Static features are copied to the host once per self.feats
+        if self.metadata_src is not self.feats:
+            static_feats = {
+                k: to_numpy(self.feats[k])
+                for k in ["aatype", "residue_index", "asym_id"] 
+                if k in self.feats
+            }
+            self.metadata = prep_output_metadata(
+                static_feats,
+                self.feature_dict,
+                self.feature_processor,
+                self.config_preset,
+                self.multimer_ri_gap,
+            )
+            self.metadata_src = self.feats
 
         unrelaxed_protein = protein.from_prediction(
-            features=batch,
+            features=self.metadata["features"],
             result=out,
             remove_leading_feature_dimension=False,
             #b_factors=None,
-            #remark=remark,
-            #parents=template_domain_names,
-            #parents_chain_index=template_chain_index,
+            #remark=self.metadata["remark"],
+            #parents=self.metadata["parents"],
+            #parents_chain_index=self.metadata["parents_chain_index"],
         )
 
         return unrelaxed_protein
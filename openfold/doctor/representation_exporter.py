@@ -6,12 +6,23 @@ import logging
 import subprocess
 import numpy as np
 
+from openfold.doctor.utils import chain_callbacks, to_numpy
+from openfold.utils.batch_utils import OUTPUT_RESIDUE_DIMS, crop_num_res
+from openfold.utils.profiler import profiled
+
 logger = logging.getLogger(__file__)
 logger.setLevel(level=logging.DEBUG)
 
 class RepresentationExporter:
-    def __init__(self, model, output_dir="heatmaps", export_msa=True, export_pair=True):
+    def __init__(self, model, output_dir="heatmaps", export_msa=True, export_pair=True, batch_index=None, num_res=None):
+        """
+        For batched inference, batch_index is the index of the target in
+        the batch and num_res its unpadded residue count. The exporters of
+        the targets of a batch share the model's hook.
+        """
         self.model = model
+        self.batch_index = batch_index
+        self.num_res = num_res
         self.output_dir = output_dir
         self.export_msa = export_msa
         self.export_pair = export_pair
@@ -22,9 +33,31 @@ class RepresentationExporter:
         os.makedirs(os.path.join(self.output_dir, "pair"), exist_ok=True)
 
         # set callback
-        self.model.representation_hook = self._representation_hook
+        if batch_index is None:
+            self.model.representation_hook = self._representation_hook
+        else:
+            self.model.representation_hook = chain_callbacks(
+                self.model.representation_hook, self._representation_hook
+            )
+
+    def remove(self):
+        """ Removes the hook, including those of other targets of a batch """
+        self.model.representation_hook = None
 
+    @profiled("doctor_export")
     def _representation_hook(self, msa_representation, pair_representation, stage, iteration):
+        if self.batch_index is not None:
+            msa_representation = crop_num_res(
+                msa_representation[self.batch_index],
+                OUTPUT_RESIDUE_DIMS["msa"],
+                self.num_res,
+            )
+            pair_representation = crop_num_res(
+                pair_representation[self.batch_index],
+                OUTPUT_RESIDUE_DIMS["pair"],
+                self.num_res,
+            )
+
         if self.export_msa:
             self._heatmap(msa_representation, stage, iteration, "msa")
 
@@ -37,7 +70,7 @@ class RepresentationExporter:
             return
 
         if isinstance(data, torch.Tensor):
-            data = data.detach().cpu().numpy()
+            data = to_numpy(data)
         
         stage_num = 0 if stage == "before" else 1
         frame_number = iteration * 2 + (0 if stage == "before" else 1)
@@ -2,20 +2,43 @@ import os
 import logging
 import numpy as np
 
+from openfold.utils.batch_utils import OUTPUT_RESIDUE_DIMS, crop_num_res
+from openfold.utils.profiler import profiled
+
 logger = logging.getLogger(__file__)
 logger.setLevel(level=logging.DEBUG)
 
 class MSAExporter:
-    def __init__(self, model, args, output_dir):
+    def __init__(self, model, args, output_dir, batch_index=None, num_res=None):
+        """
+        For batched inference, batch_index is the index of the target in
+        the batch and num_res its unpadded residue count.
+        """
         self.model = model
         self.args = args
         self.output_dir = output_dir
+        self.batch_index = batch_index
+        self.num_res = num_res
 
         # set callback
-        [block.register_forward_hook(self._export_msa) for block in self.model.evoformer.blocks]
+        self.handles = [block.register_forward_hook(self._export_msa) for block in self.model.evoformer.blocks]
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
 
+    @profiled("doctor_export")
     def _export_msa(self, module, input, output):
+        if self.batch_index is not None:
+            m, z = output
+            output = (
+                crop_num_res(
+                    m[self.batch_index], OUTPUT_RESIDUE_DIMS["msa"], self.num_res
+                ),
+                crop_num_res(
+                    z[self.batch_index], OUTPUT_RESIDUE_DIMS["pair"], self.num_res
+                ),
+            )
         logger.debug(f"type input {type(input)}, type ouput {type(output)}")
         logger.debug(f"input {input}")
         logger.debug(f"output {output}")
-
@@ -4,18 +4,33 @@ import os
 import torch
 import logging
 import numpy as np
+from openfold.data.input_pipeline import LazyRecyclingBatch
+from openfold.utils.batch_utils import OUTPUT_RESIDUE_DIMS, crop_num_res
 from openfold.utils.tensor_utils import tensor_tree_map
 from openfold.utils.feats import atom14_to_atom37
-from openfold.utils.script_utils import prep_output
+from openfold.utils.profiler import profiled
+from openfold.utils.script_utils import (
+    prep_output,
+    prep_output_metadata,
+    save_recycling_metrics,
+)
 from openfold.np import protein
 from openfold.doctor.movie import ProteinMovieMaker
+from openfold.doctor.utils import to_numpy
 
 logger = logging.getLogger(__file__)
 logger.setLevel(level=logging.DEBUG)
 
 class PDBExporter:
-    def __init__(self, model, feature_dict, feature_processor, args, output_dir):
+    def __init__(self, model, feature_dict, feature_processor, args, output_dir, batch_index=None, num_res=None):
+        """
+        For batched inference, batch_index is the index of the target in
+        the batch and num_res its unpadded residue count. Only its
+        structures are exported.
+        """
         self.model = model
+        self.batch_index = batch_index
+        self.num_res = num_res
         self.feature_dict = feature_dict
         self.feature_processor = feature_processor
         self.args = args
@@ -23,31 +38,53 @@ class PDBExporter:
         self.output_dir = output_dir
         self.total_block_calls = 0
         self.no_blocks = 48
+        # Per-residue features and atom masks don't change across blocks
+        # and recycling iterations, so they're copied to the host only once
+        self.metadata = None
+        self.atom_mask = None
         os.makedirs(self.output_dir, exist_ok=True)
 
         # set callback
-        self.model.register_forward_pre_hook(self._batch_hook)
-        [block.register_forward_hook(self._structure_hook) for block in self.model.evoformer.blocks]
+        self.handles = [self.model.register_forward_pre_hook(self._batch_hook)]
+        self.handles.extend([block.register_forward_hook(self._structure_hook) for block in self.model.evoformer.blocks])
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
 
     def _batch_hook(self, module, input):
         self.batch = input
 
+    @profiled("doctor_export")
     def _structure_hook(self, module, input, output):
         m, z = output
         m = m.detach()
         z = z.detach()
+        if self.batch_index is not None:
+            m = m[self.batch_index]
+            z = z[self.batch_index]
         s = self.model.evoformer.linear(m[..., 0, :, :]).detach()
 
         # cycle_no = self.total_block_calls // self.no_blocks
         cycle_no = self.model._cycle_no
         # iter_num = self.model.iter_num
-        try:
-            fetch_cur_batch = lambda t: t[..., cycle_no]
-            feats = tensor_tree_map(fetch_cur_batch, self.batch)[0]  # altrimenti è una tupla; bah...
-        except:
-            logger.error(f"There is something fishy here... total block calls: {self.total_block_calls}")
-            fetch_cur_batch = lambda t: t[..., -1]
-            feats = tensor_tree_map(fetch_cur_batch, self.batch)[0]  # altrimenti è una tupla; bah...
+        is_lazy = isinstance(self.batch[0], LazyRecyclingBatch)
+        if is_lazy:
+            # The model has just generated this iteration, so it's cached
+            feats = self.batch[0].get_cycle(cycle_no)
+        else:
+            try:
+                fetch_cur_batch = lambda t: t[..., cycle_no]
+                feats = tensor_tree_map(fetch_cur_batch, self.batch)[0]  # altrimenti è una tupla; bah...
+            except:
+                logger.error(f"There is something fishy here... total block calls: {self.total_block_calls}")
+                fetch_cur_batch = lambda t: t[..., -1]
+                feats = tensor_tree_map(fetch_cur_batch, self.batch)[0]  # altrimenti è una tupla; bah...
+
+        if self.batch_index is not None:
+            # The structure module runs on the padded target, whose padding
+            # is masked, and its outputs are cropped below
+            feats = tensor_tree_map(lambda t: t[self.batch_index], feats)
 
         # logger.debug(f"feats: {feats}")
 
@@ -88,23 +125,49 @@ class PDBExporter:
         # Run auxiliary heads
         outputs.update(self.model.aux_heads(outputs))
 
-        # run_pretrained_openfold.py: ~378-393
-        # Toss out the recycling dimensions --- we don't need them anymore
-        processed_feature_dict = tensor_tree_map(
-            lambda x: np.array(x[..., -1].cpu()),
-            self.batch
-        )[0]  # altrimenti è una tupla; bah...
-        # logger.debug(f"processed feature dict: {processed_feature_dict}")
-        outputs = tensor_tree_map(lambda x: np.array(x.cpu()), outputs)
+        if self.batch_index is not None:
+            crop = lambda t, dims: crop_num_res(t, dims, self.num_res)
+            feats = {
+                k: crop(feats[k], (-1,))
+                for k in ["aatype", "residue_index", "asym_id"] if k in feats
+            }
+            outputs = {
+                k: crop(outputs[k], OUTPUT_RESIDUE_DIMS[k])
+                for k in ["final_atom_positions", "final_atom_mask", "plddt"]
+            }
+
+        if self.metadata is None:
+            static_feats = {
+                k: to_numpy(feats[k])
+                for k in ["aatype", "residue_index", "asym_id"] if k in feats
+            }
+            self.metadata = prep_output_metadata(
+                static_feats,
+                self.feature_dict,
+                self.feature_processor,
+                self.args.config_preset,
+                self.args.multimer_ri_gap,
+            )
+            self.atom_mask = to_numpy(outputs["final_atom_mask"])
+
+        # Only copy what changes from block to block
+        outputs = {
+            "final_atom_positions": to_numpy(
+                outputs["final_atom_positions"]
+            ),
+            "final_atom_mask": self.atom_mask,
+            "plddt": to_numpy(outputs["plddt"]),
+        }
 
         the_protein = prep_output(
             outputs,
-            processed_feature_dict,
+            None,
             self.feature_dict,
             self.feature_processor,
             self.args.config_preset,
             self.args.multimer_ri_gap,
-            self.args.subtract_plddt
+            self.args.subtract_plddt,
+            metadata=self.metadata,
         )
 
         self._save_structure(the_protein)
@@ -124,11 +187,22 @@ class PDBExporter:
 
         with open(output_path, 'w') as fp:
             if self.args.cif_output:
-                fp.write(protein.to_modelcif(the_protein))
+                # The ModelCIF metadata is too slow to build once per block
+                fp.write(protein.to_mmcif_atom_site(the_protein))
             else:
                 fp.write(protein.to_pdb(the_protein))
         logger.info(f"Output written to {output_path}...")
 
+    def save_recycling_metrics(self, recycling_metrics):
+        # Lets the exported structures of each recycling iteration be
+        # matched up with how much that iteration changed the prediction
+        output_path = os.path.join(self.output_dir, "recycling_metrics.json")
+        save_recycling_metrics(
+            tensor_tree_map(to_numpy, recycling_metrics),
+            output_path,
+        )
+        logger.info(f"Recycling metrics written to {output_path}...")
+
     def make_movie(self):
         mmaker = ProteinMovieMaker(
             input_directory=self.output_dir,
@@ -1,3 +1,6 @@
+import torch
+
+
 # https://stackoverflow.com/a/71112312
 def ranged_type(value_type, min_value, max_value):
     """
@@ -32,3 +35,26 @@ def ranged_type(value_type, min_value, max_value):
 
     # Return function handle to checking function
     return range_checker
+
+
+def chain_callbacks(first, second):
+    """ Returns a callback that calls first, if set, and then second """
+    if first is None:
+        return second
+
+    def chained(*args, **kwargs):
+        first(*args, **kwargs)
+        second(*args, **kwargs)
+
+    return chained
+
+
+def to_numpy(t):
+    """
+    Copies a tensor to a NumPy array. NumPy has no bfloat16, which
+    intermediate tensors are in under CPU autocast, so those are upcast
+    """
+    t = t.detach()
+    if t.dtype == torch.bfloat16:
+        t = t.float()
+    return t.cpu().numpy()
@@ -41,7 +41,11 @@ from openfold.model.triangular_multiplicative_update import (
     FusedTriangleMultiplicationOutgoing
 )
 from openfold.utils.checkpointing import checkpoint_blocks, get_checkpoint_fn
-from openfold.utils.chunk_utils import chunk_layer, ChunkSizeTuner
+from openfold.utils.chunk_utils import (
+    chunk_layer,
+    ChunkSizeTuner,
+    module_signature,
+)
 from openfold.utils.tensor_utils import add
 
 import logging
@@ -782,6 +786,7 @@ class EvoformerStack(nn.Module):
         eps: float,
         clear_cache_between_blocks: bool = False, 
         tune_chunk_size: bool = False,
+        chunk_size_cache_path: Optional[str] = None,
         **kwargs,
     ):
         """
@@ -830,6 +835,9 @@ class EvoformerStack(nn.Module):
                 stack. Slows down each block but can reduce fragmentation
             tune_chunk_size:
                 Whether to dynamically tune the module's chunk size
+            chunk_size_cache_path:
+                Path to a file in which tuned chunk sizes are persisted
+                across runs
         """
         super(EvoformerStack, self).__init__()
 
@@ -865,7 +873,13 @@ class EvoformerStack(nn.Module):
         self.tune_chunk_size = tune_chunk_size
         self.chunk_size_tuner = None
         if(tune_chunk_size):
-            self.chunk_size_tuner = ChunkSizeTuner()
+            self.chunk_size_tuner = ChunkSizeTuner(
+                cache_path=chunk_size_cache_path,
+                module_id=(
+                    f"{type(self).__name__}:"
+                    f"{module_signature(self.blocks[0])}"
+                ),
+            )
 
     def _prep_blocks(self, 
         m: torch.Tensor, 
@@ -1057,6 +1071,7 @@ class ExtraMSAStack(nn.Module):
         ckpt: bool,
         clear_cache_between_blocks: bool = False,
         tune_chunk_size: bool = False,
+        chunk_size_cache_path: Optional[str] = None,
         **kwargs,
     ):
         super(ExtraMSAStack, self).__init__()
@@ -1088,7 +1103,13 @@ class ExtraMSAStack(nn.Module):
         self.tune_chunk_size = tune_chunk_size
         self.chunk_size_tuner = None
         if(tune_chunk_size):
-            self.chunk_size_tuner = ChunkSizeTuner()
+            self.chunk_size_tuner = ChunkSizeTuner(
+                cache_path=chunk_size_cache_path,
+                module_id=(
+                    f"{type(self).__name__}:"
+                    f"{module_signature(self.blocks[0])}"
+                ),
+            )
 
     def _prep_blocks(self, 
         m: torch.Tensor, 
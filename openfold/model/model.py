@@ -19,13 +19,13 @@ import torch
 import torch.nn as nn
 
 from openfold.data import data_transforms_multimer
+from openfold.data.input_pipeline import LazyRecyclingBatch
 from openfold.utils.feats import (
     pseudo_beta_fn,
     build_extra_msa_feat,
     dgram_from_positions,
     atom14_to_atom37,
 )
-from openfold.utils.tensor_utils import masked_mean
 from openfold.model.embedders import (
     InputEmbedder,
     InputEmbedderMultimer,
@@ -55,6 +55,7 @@ from openfold.utils.feats import (
 from openfold.utils.loss import (
     compute_plddt,
 )
+from openfold.utils.recycling import RecyclingMonitor
 from openfold.utils.tensor_utils import (
     add,
     dict_multimap,
@@ -133,6 +134,8 @@ class AlphaFold(nn.Module):
             is_multimer=self.globals.is_multimer,
             **self.config["structure_module"],
         )
+        self.recycling_monitor = RecyclingMonitor(self.config)
+
         self.aux_heads = AuxiliaryHeads(
             self.config["heads"],
         )
@@ -182,34 +185,6 @@ class AlphaFold(nn.Module):
 
         return template_embeds
 
-    def tolerance_reached(self, prev_pos, next_pos, mask, eps=1e-8) -> bool:
-        """
-        Early stopping criteria based on criteria used in
-        AF2Complex: https://www.nature.com/articles/s41467-022-29394-2
-        Args:
-          prev_pos: Previous atom positions in atom37/14 representation
-          next_pos: Current atom positions in atom37/14 representation
-          mask: 1-D sequence mask
-          eps: Epsilon used in square root calculation
-        Returns:
-          Whether to stop recycling early based on the desired tolerance.
-        """
-
-        def distances(points):
-            """Compute all pairwise distances for a set of points."""
-            d = points[..., None, :] - points[..., None, :, :]
-            return torch.sqrt(torch.sum(d ** 2, dim=-1))
-
-        if self.config.recycle_early_stop_tolerance < 0:
-            return False
-
-        ca_idx = residue_constants.atom_order['CA']
-        sq_diff = (distances(prev_pos[..., ca_idx, :]) - distances(next_pos[..., ca_idx, :])) ** 2
-        mask = mask[..., None] * mask[..., None, :]
-        sq_diff = masked_mean(mask=mask, value=sq_diff, dim=list(range(len(mask.shape))))
-        diff = torch.sqrt(sq_diff + eps).item()
-        return diff <= self.config.recycle_early_stop_tolerance
-
     def iteration(self, feats, prevs, _recycle=True):
         self.iter_num += 1  # starts at -1
     
@@ -473,9 +448,16 @@ class AlphaFold(nn.Module):
         # [*, N, N, C_z]
         z_prev = outputs["pair"]
 
-        early_stop = False
-        if self.globals.is_multimer:
-            early_stop = self.tolerance_reached(x_prev, outputs["final_atom_positions"], seq_mask)
+        early_stop = self.recycling_monitor.update(
+            outputs,
+            seq_mask,
+            plddt_fn=lambda o: compute_plddt(
+                self.aux_heads.plddt(o["sm"]["single"])
+            ),
+        )
+        if not (self.globals.is_multimer or
+                self.config.recycle_early_stop.monomer_early_stop):
+            early_stop = False
 
         del x_prev
 
@@ -511,7 +493,9 @@ class AlphaFold(nn.Module):
                 supplement subsection 1.2.9.
 
                 The final dimension of each input must have length equal to
-                the number of recycling iterations.
+                the number of recycling iterations. Alternatively, a
+                LazyRecyclingBatch generating the features of each
+                recycling iteration on demand may be passed.
 
                 Features (without the recycling dimension):
 
@@ -560,14 +544,22 @@ class AlphaFold(nn.Module):
         is_grad_enabled = torch.is_grad_enabled()
 
         # Main recycling loop
-        num_iters = batch["aatype"].shape[-1]
+        is_lazy = isinstance(batch, LazyRecyclingBatch)
+        if is_lazy:
+            num_iters = len(batch)
+        else:
+            num_iters = batch["aatype"].shape[-1]
         early_stop = False
         num_recycles = 0
+        self.recycling_monitor.reset()
         for cycle_no in range(num_iters):
             self._cycle_no = cycle_no
             # Select the features for the current recycling cycle
-            fetch_cur_batch = lambda t: t[..., cycle_no]
-            feats = tensor_tree_map(fetch_cur_batch, batch)
+            if is_lazy:
+                feats = batch.get_cycle(cycle_no)
+            else:
+                fetch_cur_batch = lambda t: t[..., cycle_no]
+                feats = tensor_tree_map(fetch_cur_batch, batch)
 
             # Enable grad iff we're training and it's the final recycling layer
             is_final_iter = cycle_no == (num_iters - 1) or early_stop
@@ -595,7 +587,13 @@ class AlphaFold(nn.Module):
 
         outputs["num_recycles"] = torch.tensor(num_recycles, device=feats["aatype"].device)
 
-        if "asym_id" in batch:
+        # Metrics are only output when asked for, not whenever early
+        # stopping computes them
+        if self.recycling_monitor.record_metrics:
+            outputs["recycling_metrics"] = self.recycling_monitor.trajectory()
+        self.recycling_monitor.reset()
+
+        if "asym_id" in feats:
             outputs["asym_id"] = feats["asym_id"]
 
         # Run auxiliary heads
@@ -40,6 +40,7 @@ from openfold.utils.checkpointing import checkpoint_blocks
 from openfold.utils.chunk_utils import (
     chunk_layer,
     ChunkSizeTuner,
+    module_signature,
 )
 from openfold.utils.feats import (
     build_template_angle_feat,
@@ -360,6 +361,7 @@ class TemplatePairStack(nn.Module):
         fuse_projection_weights,
         blocks_per_ckpt,
         tune_chunk_size: bool = False,
+        chunk_size_cache_path: Optional[str] = None,
         inf=1e9,
         **kwargs,
     ):
@@ -380,6 +382,11 @@ class TemplatePairStack(nn.Module):
             blocks_per_ckpt:
                 Number of blocks per activation checkpoint. None disables
                 activation checkpointing
+            tune_chunk_size:
+                Whether to dynamically tune the module's chunk size
+            chunk_size_cache_path:
+                Path to a file in which tuned chunk sizes are persisted
+                across runs
         """
         super(TemplatePairStack, self).__init__()
 
@@ -405,7 +412,13 @@ class TemplatePairStack(nn.Module):
         self.tune_chunk_size = tune_chunk_size
         self.chunk_size_tuner = None
         if tune_chunk_size:
-            self.chunk_size_tuner = ChunkSizeTuner()
+            self.chunk_size_tuner = ChunkSizeTuner(
+                cache_path=chunk_size_cache_path,
+                module_id=(
+                    f"{type(self).__name__}:"
+                    f"{module_signature(self.blocks[0])}"
+                ),
+            )
 
     def forward(
         self,
@@ -318,6 +318,153 @@ def add_pdb_headers(prot: Protein, pdb_str: str) -> str:
     return '\n'.join(out_pdb_lines)
 
 
+def _format_fixed_width(values: np.ndarray, width: int, decimals: int = 0):
+    """Formats numbers as f"{v:>{width}.{decimals}f}" would, all at once.
+
+    Integer arrays are formatted as f"{v:>{width}}".
+
+    Args:
+      values: [N] array of numbers.
+      width: Number of characters per value.
+      decimals: Number of digits after the decimal point.
+
+    Returns:
+      [N, width] uint8 array of ASCII codes, or None if any of the values
+      doesn't fit into width characters.
+    """
+    values = np.asarray(values)
+    n = values.shape[0]
+    if decimals == 0:
+        negative = values < 0
+        ints = np.abs(values.astype(np.int64))
+    else:
+        values = values.astype(np.float64)
+        if not np.all(np.isfinite(values)):
+            return None
+        negative = np.signbit(values)
+        scaled = np.abs(values) * 10 ** decimals
+        ints = np.round(scaled)
+        # Python rounds the exact decimal expansion of each value, which
+        # the scaled value can misrepresent near ties
+        near_ties = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+        for i in np.flatnonzero(near_ties):
+            ints[i] = int(f"{abs(values[i]):.{decimals}f}".replace(".", ""))
+        ints = ints.astype(np.int64)
+
+    int_part = ints // 10 ** decimals
+    no_digits = np.ones(n, dtype=np.int64)
+    bound = 10
+    while np.any(int_part >= bound):
+        no_digits += int_part >= bound
+        bound *= 10
+
+    length = no_digits + negative + (decimals + 1 if decimals > 0 else 0)
+    if n > 0 and length.max() > width:
+        return None
+
+    out = np.full((n, width), ord(" "), dtype=np.uint8)
+    col = width - 1
+    for _ in range(decimals):
+        out[:, col] = ord("0") + ints % 10
+        ints = ints // 10
+        col -= 1
+    if decimals > 0:
+        out[:, col] = ord(".")
+        col -= 1
+
+    for k in range(no_digits.max() if n > 0 else 0):
+        has_digit = k < no_digits
+        out[has_digit, col - k] = ord("0") + (int_part[has_digit] // 10 ** k) % 10
+
+    rows = np.flatnonzero(negative)
+    out[rows, col - no_digits[rows]] = ord("-")
+
+    return out
+
+
+def _text_table(strings: Sequence[str], width: int, align: str = ">"):
+    """[len(strings), width] uint8 array of the formatted strings"""
+    return np.array(
+        [list(f"{s:{align}{width}}".encode("ascii")) for s in strings],
+        dtype=np.uint8,
+    ).reshape(len(strings), width)
+
+
+def _join_columns(columns: Sequence[np.ndarray]) -> np.ndarray:
+    """Lays out [N, w_i] ASCII columns side by side, as newline-terminated 
+    rows of a [N, sum(w_i) + 1] array."""
+    n = columns[0].shape[0]
+    newline = np.full((n, 1), ord("\n"), dtype=np.uint8)
+    return np.concatenate(list(columns) + [newline], axis=-1)
+
+
+def _pdb_atom_records(
+    serial: np.ndarray,
+    atom_type: np.ndarray,
+    aatype: np.ndarray,
+    chain_index: np.ndarray,
+    residue_index: np.ndarray,
+    positions: np.ndarray,
+    b_factors: np.ndarray,
+):
+    """Builds fixed-width PDB ATOM records, one per atom.
+
+    Returns:
+      [N_atom, 81] uint8 array of newline-terminated records, or None if
+      some field overflows its columns.
+    """
+    numeric = [
+        _format_fixed_width(serial, 5),
+        _format_fixed_width(residue_index, 4),
+        _format_fixed_width(positions[:, 0], 8, 3),
+        _format_fixed_width(positions[:, 1], 8, 3),
+        _format_fixed_width(positions[:, 2], 8, 3),
+        _format_fixed_width(b_factors, 6, 2),
+    ]
+    if any(c is None for c in numeric):
+        return None
+    serial, residue_index, x, y, z, b_factors = numeric
+
+    restypes = residue_constants.restypes + ["X"]
+    res_names = _text_table(
+        [residue_constants.restype_1to3.get(r, "UNK") for r in restypes], 3
+    )
+    atom_names = _text_table(
+        [a if len(a) == 4 else f" {a}" for a in residue_constants.atom_types],
+        4,
+        align="<",
+    )
+    # Protein supports only C, N, O, S, this works.
+    elements = _text_table([a[0] for a in residue_constants.atom_types], 2)
+    chain_tags = _text_table(list(string.ascii_uppercase), 1)
+
+    n = serial.shape[0]
+    text = lambda s: np.tile(
+        np.frombuffer(s.encode("ascii"), dtype=np.uint8), (n, 1)
+    )
+
+    return _join_columns([
+        text("ATOM  "),
+        serial,
+        text(" "),
+        atom_names[atom_type],
+        text(" "),
+        res_names[aatype],
+        text(" "),
+        chain_tags[chain_index],
+        residue_index,
+        text("    "),
+        x,
+        y,
+        z,
+        text("  1.00"),
+        b_factors,
+        text(" " * 10),
+        elements[atom_type],
+        text("  "),
+    ])
+
+
 def to_pdb(prot: Protein) -> str:
     """Converts a `Protein` instance to a PDB string.
 
@@ -331,8 +478,6 @@ def to_pdb(prot: Protein) -> str:
     res_1to3 = lambda r: residue_constants.restype_1to3.get(restypes[r], "UNK")
     atom_types = residue_constants.atom_types
 
-    pdb_lines = []
-
     atom_mask = prot.atom_mask
     aatype = prot.aatype
     atom_positions = prot.atom_positions
@@ -352,72 +497,43 @@ def to_pdb(prot: Protein) -> str:
             )
         chain_ids[i] = PDB_CHAIN_IDS[i]
 
-    headers = get_pdb_headers(prot)
-    if (len(headers) > 0):
-        pdb_lines.extend(headers)
-
-    pdb_lines.append("MODEL     1")
     n = aatype.shape[0]
+    chain_tags = string.ascii_uppercase
+
+    atom_exists = atom_mask >= 0.5
+    no_atoms = atom_exists.sum(axis=-1)
+    atom_offsets = np.concatenate([[0], np.cumsum(no_atoms)])
+
+    # Lay out the chain terminations and per-chain headers. The ATOM 
+    # records in between are formatted all at once below. Atom indices
+    # increase at TER records, too.
+    lines_before = {}
+    lines_after = {}
+    first_atom_index = np.zeros(n, dtype=np.int64)
     atom_index = 1
     last_chain_index = chain_index[0]
     prev_chain_index = 0
-    chain_tags = string.ascii_uppercase
-
-    # Add all atom sites.
-    for i in range(aatype.shape[0]):
+    for i in range(n):
         # Close the previous chain if in a multichain PDB.
         if last_chain_index != chain_index[i]:
-            pdb_lines.append(
+            lines_before[i] = [
                 _chain_end(
                     atom_index, 
                     res_1to3(aatype[i - 1]), 
                     chain_ids[chain_index[i - 1]], 
                     residue_index[i - 1]
                 )
-            )
+            ]
             last_chain_index = chain_index[i]
             atom_index += 1 # Atom index increases at the TER symbol.
 
-        res_name_3 = res_1to3(aatype[i])
-        for atom_name, pos, mask, b_factor in zip(
-            atom_types, atom_positions[i], atom_mask[i], b_factors[i]
-        ):
-            if mask < 0.5:
-                continue
-
-            record_type = "ATOM"
-            name = atom_name if len(atom_name) == 4 else f" {atom_name}"
-            alt_loc = ""
-            insertion_code = ""
-            occupancy = 1.00
-            element = atom_name[
-                0
-            ]  # Protein supports only C, N, O, S, this works.
-            charge = ""
-
-            chain_tag = "A"
-            if(chain_index is not None):
-                chain_tag = chain_tags[chain_index[i]]
-
-            # PDB is a columnar format, every space matters here!
-            atom_line = (
-                f"{record_type:<6}{atom_index:>5} {name:<4}{alt_loc:>1}"
-                #TODO: check this refactor, chose main branch version
-                #f"{res_name_3:>3} {chain_ids[chain_index[i]]:>1}"
-                f"{res_name_3:>3} {chain_tag:>1}"
-                f"{residue_index[i]:>4}{insertion_code:>1}   "
-                f"{pos[0]:>8.3f}{pos[1]:>8.3f}{pos[2]:>8.3f}"
-                f"{occupancy:>6.2f}{b_factor:>6.2f}          "
-                f"{element:>2}{charge:>2}"
-            )
-            pdb_lines.append(atom_line)
-            atom_index += 1
+        first_atom_index[i] = atom_index
+        atom_index += no_atoms[i]
 
         should_terminate = (i == n - 1)
-        if(chain_index is not None):
-            if(i != n - 1 and chain_index[i + 1] != prev_chain_index):
-                should_terminate = True
-                prev_chain_index = chain_index[i + 1]
+        if(i != n - 1 and chain_index[i + 1] != prev_chain_index):
+            should_terminate = True
+            prev_chain_index = chain_index[i + 1]
 
         if(should_terminate):
             # Close the chain.
@@ -425,22 +541,188 @@ def to_pdb(prot: Protein) -> str:
             chain_termination_line = (
                 f"{chain_end:<6}{atom_index:>5}      "
                 f"{res_1to3(aatype[i]):>3} "
-                f"{chain_tag:>1}{residue_index[i]:>4}"
+                f"{chain_tags[chain_index[i]]:>1}{residue_index[i]:>4}"
             )
-            pdb_lines.append(chain_termination_line)
+            lines_after[i] = [chain_termination_line]
             atom_index += 1
 
             if(i != n - 1):
                 # "prev" is a misnomer here. This happens at the beginning of
                 # each new chain.
-                pdb_lines.extend(get_pdb_headers(prot, prev_chain_index))
+                lines_after[i].extend(get_pdb_headers(prot, prev_chain_index))
+
+    # Add all atom sites.
+    res, atom_type = np.nonzero(atom_exists)
+    serial = (
+        first_atom_index[res] + np.arange(res.shape[0]) - atom_offsets[res]
+    )
+    records = _pdb_atom_records(
+        serial,
+        atom_type,
+        aatype[res],
+        chain_index[res],
+        residue_index[res],
+        atom_positions[res, atom_type],
+        b_factors[res, atom_type],
+    )
+    if records is not None:
+        atom_block = lambda a, b: records[a:b].tobytes().decode("ascii")
+    else:
+        # Some fields overflow their columns. Widen them like the PDB writers
+        # of old did
+        atom_lines = []
+        for k, (i, a) in enumerate(zip(res, atom_type)):
+            atom_name = atom_types[a]
+            name = atom_name if len(atom_name) == 4 else f" {atom_name}"
+            pos = atom_positions[i, a]
+            atom_line = (
+                f"{'ATOM':<6}{serial[k]:>5} {name:<4}{'':>1}"
+                f"{res_1to3(aatype[i]):>3} {chain_tags[chain_index[i]]:>1}"
+                f"{residue_index[i]:>4}{'':>1}   "
+                f"{pos[0]:>8.3f}{pos[1]:>8.3f}{pos[2]:>8.3f}"
+                f"{1.00:>6.2f}{b_factors[i, a]:>6.2f}          "
+                f"{atom_name[0]:>2}{'':>2}"
+            )
+            atom_lines.append(atom_line.ljust(80) + "\n")
+        atom_block = lambda a, b: "".join(atom_lines[a:b])
+
+    # Pad all other lines to 80 characters
+    pad = lambda lines: [line.ljust(80) + "\n" for line in lines]
+
+    pdb_lines = []
+    pdb_lines.extend(pad(get_pdb_headers(prot)))
+    pdb_lines.extend(pad(["MODEL     1"]))
+    block_start = 0
+    for i in sorted(set(lines_before) | set(lines_after)):
+        if i in lines_before:
+            pdb_lines.append(atom_block(block_start, atom_offsets[i]))
+            pdb_lines.extend(pad(lines_before[i]))
+            block_start = atom_offsets[i]
+        if i in lines_after:
+            pdb_lines.append(atom_block(block_start, atom_offsets[i + 1]))
+            pdb_lines.extend(pad(lines_after[i]))
+            block_start = atom_offsets[i + 1]
+    pdb_lines.append(atom_block(block_start, atom_offsets[n]))
+    pdb_lines.extend(pad(["ENDMDL", "END"]))
+
+    return "".join(pdb_lines)
+
+
+def to_mmcif_atom_site(prot: Protein, name: str = "openfold") -> str:
+    """Converts a `Protein` instance to an mmCIF string with just the
+    atom_site table.
+
+    Much cheaper to produce than to_modelcif, at the cost of all of the
+    ModelCIF metadata. Meant for intermediate structures.
+
+    Args:
+      prot: The protein to convert to mmCIF.
+      name: Name of the data block.
+
+    Returns:
+      mmCIF string.
+    """
+    aatype = prot.aatype
+    residue_index = prot.residue_index.astype(np.int32)
+    chain_index = prot.chain_index
+    if chain_index is None:
+        chain_index = np.zeros_like(aatype)
+    chain_index = chain_index.astype(np.int32)
+
+    if np.any(aatype > residue_constants.restype_num):
+        raise ValueError("Invalid aatypes.")
+    if np.any(chain_index >= len(string.ascii_uppercase)):
+        raise ValueError(
+            f"At most {len(string.ascii_uppercase)} chains are supported."
+        )
 
-    pdb_lines.append("ENDMDL")
-    pdb_lines.append("END")
+    res, atom_type = np.nonzero(prot.atom_mask >= 0.5)
+    positions = prot.atom_positions[res, atom_type]
+    res_chain_index = chain_index[res]
+    seq_id = _format_fixed_width(residue_index[res], 6)
+    numeric = [
+        _format_fixed_width(np.arange(1, res.shape[0] + 1), 8),
+        _format_fixed_width(res_chain_index + 1, 3),
+        seq_id,
+        _format_fixed_width(positions[:, 0], 12, 3),
+        _format_fixed_width(positions[:, 1], 12, 3),
+        _format_fixed_width(positions[:, 2], 12, 3),
+        _format_fixed_width(prot.b_factors[res, atom_type], 8, 2),
+    ]
+    if any(c is None for c in numeric):
+        raise ValueError("Atom sites out of range for mmCIF output")
+    atom_id, entity_id, seq_id, x, y, z, b_factors = numeric
 
-    # Pad all lines to 80 characters
-    pdb_lines = [line.ljust(80) for line in pdb_lines]
-    return '\n'.join(pdb_lines) + '\n' # Add terminating newline.
+    restypes = residue_constants.restypes + ["X"]
+    res_names = _text_table(
+        [residue_constants.restype_1to3.get(r, "UNK") for r in restypes], 3
+    )
+    atom_types = residue_constants.atom_types
+    atom_names = _text_table(atom_types, 4, align="<")
+    elements = _text_table([a[0] for a in atom_types], 1)
+    chain_tags = _text_table(list(string.ascii_uppercase), 1)
+    chain_tag = chain_tags[res_chain_index]
+
+    n = res.shape[0]
+    text = lambda s: np.tile(
+        np.frombuffer(s.encode("ascii"), dtype=np.uint8), (n, 1)
+    )
+    records = _join_columns([
+        text("ATOM "),
+        atom_id,
+        text(" "),
+        elements[atom_type],
+        text(" "),
+        atom_names[atom_type],
+        text(" . "),
+        res_names[aatype[res]],
+        text(" "),
+        chain_tag,
+        text(" "),
+        entity_id,
+        text(" "),
+        seq_id,
+        text(" ? "),
+        x,
+        y,
+        z,
+        text(" 1.00 "),
+        b_factors,
+        text(" "),
+        seq_id,
+        text(" "),
+        chain_tag,
+        text(" 1"),
+    ])
+
+    fields = [
+        "group_PDB",
+        "id",
+        "type_symbol",
+        "label_atom_id",
+        "label_alt_id",
+        "label_comp_id",
+        "label_asym_id",
+        "label_entity_id",
+        "label_seq_id",
+        "pdbx_PDB_ins_code",
+        "Cartn_x",
+        "Cartn_y",
+        "Cartn_z",
+        "occupancy",
+        "B_iso_or_equiv",
+        "auth_seq_id",
+        "auth_asym_id",
+        "pdbx_PDB_model_num",
+    ]
+    header = [f"data_{name}", "#", "loop_"]
+    header.extend([f"_atom_site.{f}" for f in fields])
+
+    return (
+        "\n".join(header) + "\n" + 
+        records.tobytes().decode("ascii") + 
+        "#\n"
+    )
 
 
 def to_modelcif(prot: Protein) -> str:
@@ -15,6 +15,7 @@
 
 """Restrained Amber Minimization of a structure."""
 
+import functools
 import io
 import time
 from typing import Collection, Optional, Sequence
@@ -76,6 +77,75 @@ def _add_restraints(
     system.addForce(force)
 
 
+def _freeze_residues(
+    system: openmm.System,
+    topology: openmm_app.Topology,
+    frozen_residues: Collection[int],
+):
+    """Holds the atoms of the given residues in place during minimization.
+
+    OpenMM's minimizer leaves massless particles where they are.
+    """
+    if not frozen_residues:
+        return
+
+    for atom in topology.atoms():
+        if atom.residue.index in frozen_residues:
+            system.setParticleMass(atom.index, 0.)
+
+    # Constraints between two massless particles are not allowed
+    is_massless = lambda i: (
+        system.getParticleMass(i).value_in_unit(unit.dalton) == 0.
+    )
+    for i in reversed(range(system.getNumConstraints())):
+        p1, p2, _ = system.getConstraintParameters(i)
+        if is_massless(p1) and is_massless(p2):
+            system.removeConstraint(i)
+
+    logging.info("Freezing %d residues.", len(frozen_residues))
+
+
+def residues_near_violations(
+    prot: protein.Protein,
+    violation_mask: np.ndarray,
+    radius: float,
+    block_size: int = 16,
+) -> np.ndarray:
+    """Finds the residues within some distance of violating residues.
+
+    Args:
+      prot: A protein.
+      violation_mask: [N_res] mask of residues with structural violations.
+      radius: Angstroms. Residues with any atom this close to any atom of a
+        violating residue are included, as are the violating residues.
+      block_size: Number of violating atoms processed at once.
+
+    Returns:
+      The sorted, zero-indexed residues near violations.
+    """
+    atom_mask = prot.atom_mask > 0.5
+    violating = np.flatnonzero(violation_mask)
+    violating_pos = prot.atom_positions[violating][atom_mask[violating]]
+
+    near = np.zeros(prot.aatype.shape[0], dtype=bool)
+    for i in range(0, violating_pos.shape[0], block_size):
+        block = violating_pos[i:i + block_size]
+        d = np.sqrt(np.sum(
+            (prot.atom_positions[:, :, None] - block[None, None]) ** 2,
+            axis=-1,
+        ))
+        near |= np.any((d < radius) & atom_mask[..., None], axis=(-1, -2))
+
+    near[violating] = True
+    return np.flatnonzero(near)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_force_field() -> openmm_app.ForceField:
+    """Returns the Amber force field, which is parsed once per process."""
+    return openmm_app.ForceField("amber99sb.xml")
+
+
 def _openmm_minimize(
     pdb_str: str,
     max_iterations: int,
@@ -84,17 +154,19 @@ def _openmm_minimize(
     restraint_set: str,
     exclude_residues: Sequence[int],
     use_gpu: bool,
+    frozen_residues: Collection[int] = (),
 ):
     """Minimize energy via openmm."""
 
     pdb_file = io.StringIO(pdb_str)
     pdb = openmm_app.PDBFile(pdb_file)
 
-    force_field = openmm_app.ForceField("amber99sb.xml")
+    force_field = _get_force_field()
     constraints = openmm_app.HBonds
     system = force_field.createSystem(pdb.topology, constraints=constraints)
     if stiffness > 0 * ENERGY / (LENGTH ** 2):
         _add_restraints(system, pdb, stiffness, restraint_set, exclude_residues)
+    _freeze_residues(system, pdb.topology, frozen_residues)
 
     integrator = openmm.LangevinIntegrator(0, 0.01, 0.0)
     platform = openmm.Platform.getPlatformByName("CUDA" if use_gpu else "CPU")
@@ -115,6 +187,109 @@ def _openmm_minimize(
     return ret
 
 
+class RestrainedMinimizer:
+    """Repeated restrained minimization of one cleaned structure.
+
+    The force field system and the OpenMM context are built once. Every
+    atom in the restraint set gets a restraint whose per-particle
+    parameters hold its target position and a weight, such that successive
+    minimizations only update those parameters and the positions in place.
+    """
+
+    def __init__(
+        self,
+        pdb_str: str,
+        stiffness: unit.Unit,
+        restraint_set: str,
+        use_gpu: bool,
+        frozen_residues: Collection[int] = (),
+    ):
+        assert restraint_set in ["non_hydrogen", "c_alpha"]
+
+        pdb = openmm_app.PDBFile(io.StringIO(pdb_str))
+        self.topology = pdb.topology
+        self.positions = pdb.positions
+
+        system = _get_force_field().createSystem(
+            pdb.topology, constraints=openmm_app.HBonds
+        )
+
+        # (force particle index, atom index, residue index)
+        self._restrained = []
+        self._force = None
+        if stiffness > 0 * ENERGY / (LENGTH ** 2):
+            force = openmm.CustomExternalForce(
+                "0.5 * k * w * ((x-x0)^2 + (y-y0)^2 + (z-z0)^2)"
+            )
+            force.addGlobalParameter("k", stiffness)
+            for p in ["x0", "y0", "z0", "w"]:
+                force.addPerParticleParameter(p)
+
+            for i, atom in enumerate(pdb.topology.atoms()):
+                if will_restrain(atom, restraint_set):
+                    particle = force.addParticle(i, [0., 0., 0., 0.])
+                    self._restrained.append((particle, i, atom.residue.index))
+
+            system.addForce(force)
+            self._force = force
+
+        _freeze_residues(system, pdb.topology, frozen_residues)
+
+        integrator = openmm.LangevinIntegrator(0, 0.01, 0.0)
+        platform = openmm.Platform.getPlatformByName(
+            "CUDA" if use_gpu else "CPU"
+        )
+        self.simulation = openmm_app.Simulation(
+            pdb.topology, system, integrator, platform
+        )
+
+    def _update_restraints(self, exclude_residues: Collection[int]):
+        """Restrains atoms to the current positions, minus exclusions."""
+        no_restrained = 0
+        for particle, i, residue_index in self._restrained:
+            x0 = self.positions[i].value_in_unit(unit.nanometers)
+            w = 0. if residue_index in exclude_residues else 1.
+            self._force.setParticleParameters(
+                particle, i, [x0[0], x0[1], x0[2], w]
+            )
+            no_restrained += int(w)
+
+        self._force.updateParametersInContext(self.simulation.context)
+        logging.info(
+            "Restraining %d / %d particles.",
+            no_restrained,
+            self.simulation.system.getNumParticles(),
+        )
+
+    def minimize(
+        self,
+        max_iterations: int,
+        tolerance: unit.Unit,
+        exclude_residues: Collection[int],
+    ):
+        """Minimizes from, and restrained to, the last minimized positions."""
+        context = self.simulation.context
+        context.setPositions(self.positions)
+        if self._force is not None:
+            self._update_restraints(exclude_residues)
+
+        ret = {}
+        state = context.getState(getEnergy=True, getPositions=True)
+        ret["einit"] = state.getPotentialEnergy().value_in_unit(ENERGY)
+        ret["posinit"] = state.getPositions(asNumpy=True).value_in_unit(LENGTH)
+        self.simulation.minimizeEnergy(
+            maxIterations=max_iterations, tolerance=tolerance
+        )
+        state = context.getState(getEnergy=True, getPositions=True)
+        ret["efinal"] = state.getPotentialEnergy().value_in_unit(ENERGY)
+        ret["pos"] = state.getPositions(asNumpy=True).value_in_unit(LENGTH)
+        ret["min_pdb"] = _get_pdb_string(self.topology, state.getPositions())
+
+        # Only advance on success, so that failed attempts restart cleanly
+        self.positions = state.getPositions()
+        return ret
+
+
 def _get_pdb_string(topology: openmm_app.Topology, positions: unit.Quantity):
     """Returns a pdb string provided OpenMM topology and positions."""
     with io.StringIO() as f:
@@ -418,6 +593,8 @@ def _run_one_iteration(
     max_attempts: int,
     exclude_residues: Optional[Collection[int]] = None,
     use_gpu: bool,
+    minimizer: Optional[RestrainedMinimizer] = None,
+    frozen_residues: Collection[int] = (),
 ):
     """Runs the minimization pipeline.
 
@@ -433,6 +610,10 @@ def _run_one_iteration(
       exclude_residues: An optional list of zero-indexed residues to exclude from
           restraints.
       use_gpu: Whether to run relaxation on GPU
+      minimizer: An optional `RestrainedMinimizer` to minimize with, in which
+          case pdb_string, stiffness, restraint_set, use_gpu and
+          frozen_residues are ignored.
+      frozen_residues: Zero-indexed residues whose atoms are held in place.
     Returns:
       A `dict` of minimization info.
     """
@@ -451,15 +632,23 @@ def _run_one_iteration(
             logging.info(
                 "Minimizing protein, attempt %d of %d.", attempts, max_attempts
             )
-            ret = _openmm_minimize(
-                pdb_string,
-                max_iterations=max_iterations,
-                tolerance=tolerance,
-                stiffness=stiffness,
-                restraint_set=restraint_set,
-                exclude_residues=exclude_residues,
-                use_gpu=use_gpu,
-            )
+            if minimizer is not None:
+                ret = minimizer.minimize(
+                    max_iterations=max_iterations,
+                    tolerance=tolerance,
+                    exclude_residues=exclude_residues,
+                )
+            else:
+                ret = _openmm_minimize(
+                    pdb_string,
+                    max_iterations=max_iterations,
+                    tolerance=tolerance,
+                    stiffness=stiffness,
+                    restraint_set=restraint_set,
+                    exclude_residues=exclude_residues,
+                    use_gpu=use_gpu,
+                    frozen_residues=frozen_residues,
+                )
             minimized = True
         except Exception as e:  # pylint: disable=broad-except
             print(e)
@@ -483,6 +672,8 @@ def run_pipeline(
     max_attempts: int = 100,
     checks: bool = True,
     exclude_residues: Optional[Sequence[int]] = None,
+    reuse_system: bool = False,
+    mobile_residues: Optional[Collection[int]] = None,
 ):
     """Run iterative amber relax.
 
@@ -506,6 +697,12 @@ def run_pipeline(
       checks: Whether to perform cleaning checks.
       exclude_residues: An optional list of zero-indexed residues to exclude from
           restraints.
+      reuse_system: Whether to build the OpenMM system once and update it in
+          place between iterations. Each iteration then starts from the
+          previous one's minimized positions, hydrogens included, and
+          place_hydrogens_every_iteration is ignored.
+      mobile_residues: An optional list of zero-indexed residues to minimize.
+          If given, all other residues are held in place.
 
     Returns:
       out: A dictionary of output values.
@@ -521,6 +718,22 @@ def run_pipeline(
     violations = np.inf
     iteration = 0
 
+    frozen_residues = set()
+    if mobile_residues is not None:
+        frozen_residues = (
+            set(range(prot.aatype.shape[0])) - set(mobile_residues)
+        )
+
+    minimizer = None
+    if reuse_system:
+        minimizer = RestrainedMinimizer(
+            pdb_string,
+            stiffness=stiffness * ENERGY / (LENGTH ** 2),
+            restraint_set=restraint_set,
+            use_gpu=use_gpu,
+            frozen_residues=frozen_residues,
+        )
+
     while violations > 0 and iteration < max_outer_iterations:
         ret = _run_one_iteration(
             pdb_string=pdb_string,
@@ -531,6 +744,8 @@ def run_pipeline(
             restraint_set=restraint_set,
             max_attempts=max_attempts,
             use_gpu=use_gpu,
+            minimizer=minimizer,
+            frozen_residues=frozen_residues,
         )
         
         headers = protein.get_pdb_headers(prot)    
@@ -538,7 +753,10 @@ def run_pipeline(
             ret["min_pdb"] = '\n'.join(['\n'.join(headers), ret["min_pdb"]])
         
         prot = protein.from_pdb_string(ret["min_pdb"])
-        if place_hydrogens_every_iteration:
+        if minimizer is not None:
+            # The minimizer carries its positions over by itself
+            pdb_string = None
+        elif place_hydrogens_every_iteration:
             pdb_string = clean_protein(prot, checks=True)
         else:
             pdb_string = ret["min_pdb"]
@@ -14,7 +14,7 @@
 # limitations under the License.
 
 """Amber relaxation."""
-from typing import Any, Dict, Sequence, Tuple
+from typing import Any, Dict, Optional, Sequence, Tuple
 from openfold.np import protein
 from openfold.np.relax import amber_minimize, utils
 import numpy as np
@@ -31,6 +31,9 @@ class AmberRelaxation(object):
         exclude_residues: Sequence[int],
         max_outer_iterations: int,
         use_gpu: bool,
+        reuse_system: bool = False,
+        relax_if_needed: bool = False,
+        local_radius: Optional[float] = None,
     ):
         """Initialize Amber Relaxer.
 
@@ -47,6 +50,14 @@ class AmberRelaxation(object):
            as soon as there are no violations, hence in most cases this causes no
            slowdown. In the worst case we do 20 outer iterations.
           use_gpu: Whether to run on GPU
+          reuse_system: Whether to build the OpenMM system once per structure
+            and update its restraints in place between outer iterations,
+            rather than rebuilding it every iteration.
+          relax_if_needed: Whether to return structures without structural
+            violations as they are, without minimizing them.
+          local_radius: Angstroms. If set, only residues within this
+            distance of a residue with structural violations are minimized,
+            and the rest are held in place.
         """
 
         self._max_iterations = max_iterations
@@ -55,11 +66,27 @@ class AmberRelaxation(object):
         self._exclude_residues = exclude_residues
         self._max_outer_iterations = max_outer_iterations
         self._use_gpu = use_gpu
+        self._reuse_system = reuse_system
+        self._relax_if_needed = relax_if_needed
+        self._local_radius = local_radius
 
     def process(
         self, *, prot: protein.Protein, cif_output: bool = False
     ) -> Tuple[str, Dict[str, Any], np.ndarray]:
         """Runs Amber relax on a prediction, adds hydrogens, returns PDB string."""
+        mobile_residues = None
+        if self._relax_if_needed or self._local_radius is not None:
+            violations, _ = amber_minimize.find_violations(prot)
+            violations = violations["total_per_residue_violations_mask"]
+
+            if self._relax_if_needed and not np.any(violations):
+                return self._skip(prot, cif_output, violations)
+
+            if self._local_radius is not None:
+                mobile_residues = amber_minimize.residues_near_violations(
+                    prot, violations, self._local_radius
+                )
+
         out = amber_minimize.run_pipeline(
             prot=prot,
             max_iterations=self._max_iterations,
@@ -68,6 +95,8 @@ class AmberRelaxation(object):
             exclude_residues=self._exclude_residues,
             max_outer_iterations=self._max_outer_iterations,
             use_gpu=self._use_gpu,
+            reuse_system=self._reuse_system,
+            mobile_residues=mobile_residues,
         )
         min_pos = out["pos"]
         start_pos = out["posinit"]
@@ -77,6 +106,10 @@ class AmberRelaxation(object):
             "final_energy": out["efinal"],
             "attempts": out["min_attempts"],
             "rmsd": rmsd,
+            "relaxed_residues": (
+                len(mobile_residues) if mobile_residues is not None
+                else prot.aatype.shape[0]
+            ),
         }
         pdb_str = amber_minimize.clean_protein(prot)
         min_pdb = utils.overwrite_pdb_coordinates(pdb_str, min_pos)
@@ -97,3 +130,21 @@ class AmberRelaxation(object):
             output_str = protein.to_modelcif(final_prot)
 
         return output_str, debug_data, violations
+
+    def _skip(
+        self, prot: protein.Protein, cif_output: bool, violations: np.ndarray
+    ) -> Tuple[str, Dict[str, Any], np.ndarray]:
+        """Returns an unminimized structure in the format of process."""
+        debug_data = {
+            "initial_energy": None,
+            "final_energy": None,
+            "attempts": 0,
+            "rmsd": 0.,
+            "relaxed_residues": 0,
+        }
+        if cif_output:
+            output_str = protein.to_modelcif(prot)
+        else:
+            output_str = protein.to_pdb(prot)
+
+        return output_str, debug_data, violations
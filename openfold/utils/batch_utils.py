@@ -0,0 +1,214 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Utilities for running inference on several targets in one forward pass.
+
+Processed feature dicts of similar-length targets are padded to a common
+residue count, with zeros and hence zero masks, as during training, and
+stacked along a new leading batch dimension. Model outputs are then split
+back up and cropped to each target's length.
+"""
+from typing import Callable, Dict, List, Sequence
+
+import torch
+
+from openfold.config import NUM_RES
+from openfold.utils.loss import compute_predicted_aligned_error, compute_tm
+
+
+# Residue dimensions of unbatched model outputs
+OUTPUT_RESIDUE_DIMS = {
+    "msa": (-2,),
+    "pair": (-3, -2),
+    "single": (-2,),
+    "final_atom_positions": (-3,),
+    "final_atom_mask": (-2,),
+    "final_affine_tensor": (-2,),
+    "lddt_logits": (-2,),
+    "plddt": (-1,),
+    "distogram_logits": (-3, -2),
+    "masked_msa_logits": (-2,),
+    "experimentally_resolved_logits": (-2,),
+    "tm_logits": (-3, -2),
+    "asym_id": (-1,),
+}
+
+# Residue dimensions of unbatched structure module outputs. All but "single"
+# have an additional leading dimension for the structure module's blocks
+STRUCTURE_MODULE_RESIDUE_DIMS = {
+    "frames": (-2,),
+    "sidechain_frames": (-4,),
+    "unnormalized_angles": (-3,),
+    "angles": (-3,),
+    "positions": (-3,),
+    "states": (-2,),
+    "single": (-2,),
+}
+
+
+def bucket_targets(
+    lengths: Sequence[int],
+    batch_size: int,
+    bucket_fn: Callable[[int], int],
+) -> List[List[int]]:
+    """
+        Groups targets into batches of at most batch_size targets that
+        share a bucket, i.e. a padded residue count.
+
+        Args:
+            lengths:
+                Number of residues of each target
+            batch_size:
+                Maximum number of targets per batch
+            bucket_fn:
+                Maps a residue count to the residue count to pad to
+        Returns:
+            Lists of target indices, in order of increasing bucket size
+    """
+    buckets = {}
+    for i, l in enumerate(lengths):
+        buckets.setdefault(bucket_fn(l), []).append(i)
+
+    batches = []
+    for bucket in sorted(buckets):
+        idx = buckets[bucket]
+        for j in range(0, len(idx), batch_size):
+            batches.append(idx[j:j + batch_size])
+
+    return batches
+
+
+def pad_features_num_res(
+    feats: Dict[str, torch.Tensor],
+    num_res: int,
+    shape_schema: Dict[str, Sequence],
+) -> Dict[str, torch.Tensor]:
+    """
+        Zero-pads the residue dimensions of a processed feature dict.
+
+        Args:
+            feats:
+                Processed features, with a trailing recycling dimension
+            num_res:
+                Residue count to pad to
+            shape_schema:
+                The data.common.feat config, which lists the dimensions of
+                each feature sans the recycling dimension
+        Returns:
+            The padded feature dict
+    """
+    padded = {}
+    for k, v in feats.items():
+        schema = shape_schema.get(k, None)
+        if schema is None or NUM_RES not in schema:
+            padded[k] = v
+            continue
+
+        padding = []
+        for i, s in enumerate(schema):
+            pad = num_res - v.shape[i] if s == NUM_RES else 0
+            padding.append((0, pad))
+        # The recycling dimension
+        padding.append((0, 0))
+
+        padding.reverse()
+        padding = [p for pair in padding for p in pair]
+        padded[k] = torch.nn.functional.pad(v, padding)
+
+    return padded
+
+
+def stack_features(
+    feats: Sequence[Dict[str, torch.Tensor]]
+) -> Dict[str, torch.Tensor]:
+    """ Stacks equally shaped feature dicts along a new batch dimension """
+    return {k: torch.stack([f[k] for f in feats]) for k in feats[0]}
+
+
+def crop_num_res(t: torch.Tensor, dims: Sequence[int], num_res: int):
+    """
+        Crops the residue dimensions dims of t, given as negative indices,
+        to num_res
+    """
+    for d in dims:
+        t = t.narrow(d, 0, num_res)
+    return t
+
+
+def unbatch_outputs(
+    out: dict,
+    index: int,
+    num_res: int,
+    tm_config: dict = None,
+) -> dict:
+    """
+        Extracts the outputs of one target from the outputs of a batched
+        forward pass.
+
+        Args:
+            out:
+                Outputs of the batched forward pass
+            index:
+                Index of the target in the batch
+            num_res:
+                Unpadded residue count of the target
+            tm_config:
+                The model.heads.tm config. If the TM head is enabled, the
+                pTM, ipTM and PAE outputs, which depend on all residues, are
+                recomputed from the cropped logits
+        Returns:
+            The target's outputs. Entries with a residue dimension that
+            isn't listed in OUTPUT_RESIDUE_DIMS are left padded.
+    """
+    target_out = {}
+    for k, v in out.items():
+        if k == "sm":
+            sm_out = {}
+            for sm_k, sm_v in v.items():
+                sm_v = sm_v[index] if sm_k == "single" else sm_v[:, index]
+                dims = STRUCTURE_MODULE_RESIDUE_DIMS.get(sm_k, ())
+                sm_out[sm_k] = crop_num_res(sm_v, dims, num_res)
+            target_out[k] = sm_out
+        elif k == "recycling_metrics":
+            target_out[k] = {
+                metric_k: metric_v[index] for metric_k, metric_v in v.items()
+            }
+        elif v.dim() == 0:
+            # Scalars like the number of recycling iterations apply to
+            # the whole batch
+            target_out[k] = v
+        else:
+            v = v[index]
+            target_out[k] = crop_num_res(
+                v, OUTPUT_RESIDUE_DIMS.get(k, ()), num_res
+            )
+
+    if tm_config is not None and tm_config["enabled"] and "tm_logits" in out:
+        tm_logits = target_out["tm_logits"]
+        target_out["ptm_score"] = compute_tm(tm_logits, **tm_config)
+        asym_id = target_out.get("asym_id")
+        if asym_id is not None:
+            target_out["iptm_score"] = compute_tm(
+                tm_logits, asym_id=asym_id, interface=True, **tm_config
+            )
+            target_out["weighted_ptm_score"] = (
+                tm_config["iptm_weight"] * target_out["iptm_score"] +
+                tm_config["ptm_weight"] * target_out["ptm_score"]
+            )
+        target_out.update(
+            compute_predicted_aligned_error(tm_logits, **tm_config)
+        )
+
+    return target_out
@@ -12,12 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from functools import partial
+import hashlib
+import json
 import logging
 import math
+import os
+import tempfile
 from typing import Tuple, List, Callable, Any, Dict, Sequence, Optional
 
 import torch
 
+from openfold.utils.profiler import suspend_module_stages
 from openfold.utils.tensor_utils import (
     tree_map,
     tensor_tree_map,
@@ -339,16 +344,152 @@ def chunk_layer(
     return out
 
 
+# Bump to invalidate existing on-disk chunk size caches
+CHUNK_SIZE_CACHE_VERSION = 1
+
+# Granularity of the shape and free memory buckets of the on-disk cache
+SHAPE_BUCKET_SIZE = 64
+FREE_MEMORY_BUCKET_GB = 2
+
+
+def module_signature(module: torch.nn.Module) -> str:
+    """Short hash of a module's parameter names and shapes."""
+    h = hashlib.sha1()
+    for name, p in module.named_parameters():
+        h.update(f"{name}:{tuple(p.shape)};".encode())
+    return h.hexdigest()[:12]
+
+
+class ChunkSizeCache:
+    """
+    On-disk cache of tuned chunk sizes, shared across runs and processes.
+
+    Entries are invalidated wholesale whenever CHUNK_SIZE_CACHE_VERSION or 
+    the torch version changes. Writes merge with the current contents of
+    the file, so that concurrent jobs sharing a cache don't clobber each 
+    other's entries.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.version = f"{CHUNK_SIZE_CACHE_VERSION}:{torch.__version__}"
+        self.entries = self._load()
+
+    def _load(self) -> Dict[str, int]:
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, "r") as fp:
+                cache = json.load(fp)
+        except (OSError, json.JSONDecodeError):
+            logging.warning(
+                f"Ignoring unreadable chunk size cache at {self.path}"
+            )
+            return {}
+
+        if cache.get("version") != self.version:
+            logging.info(
+                f"Discarding chunk size cache at {self.path} from another "
+                f"version"
+            )
+            return {}
+
+        return cache.get("entries", {})
+
+    def get(self, key: str) -> Optional[int]:
+        return self.entries.get(key, None)
+
+    def put(self, key: str, chunk_size: int):
+        entries = self._load()
+        entries.update(self.entries)
+        entries[key] = chunk_size
+        self.entries = entries
+
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(
+                {"version": self.version, "entries": entries}, fp, indent=4
+            )
+        os.replace(tmp_path, self.path)
+
+
+def _bucket(d: int) -> int:
+    return int(math.ceil(d / SHAPE_BUCKET_SIZE)) * SHAPE_BUCKET_SIZE
+
+
+def _device_key(device: torch.device) -> Tuple[str, int]:
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        free += torch.cuda.memory_allocated(device)
+        name = torch.cuda.get_device_name(device)
+    else:
+        free = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        name = "cpu"
+
+    free_bucket = (
+        int(free // (FREE_MEMORY_BUCKET_GB * 1024 ** 3)) * 
+        FREE_MEMORY_BUCKET_GB
+    )
+    return name, free_bucket
+
+
+def _fn_options(fn: Callable) -> Dict[str, Any]:
+    """Non-tensor keyword arguments bound to a (nested) partial."""
+    options = {}
+    while isinstance(fn, partial):
+        for k, v in fn.keywords.items():
+            if type(v) is torch.Tensor:
+                v = tuple(_bucket(d) for d in v.shape)
+            options.setdefault(k, v)
+        fn = fn.func if len(fn.args) == 0 else fn.args[0]
+
+    return options
+
+
 class ChunkSizeTuner:
     def __init__(self, 
         # Heuristically, runtimes for most of the modules in the network 
         # plateau earlier than this on all GPUs I've run the model on.
         max_chunk_size=512,
+        cache_path: Optional[str] = None,
+        module_id: Optional[str] = None,
     ):
+        """
+        Args:
+            max_chunk_size:
+                Largest chunk size considered
+            cache_path:
+                Path to a JSON file in which tuned chunk sizes are persisted
+                across runs. If None, they are only cached in memory
+            module_id:
+                Identifier of the tuned module in the on-disk cache
+        """
         self.max_chunk_size = max_chunk_size
         self.cached_chunk_size = None
         self.cached_arg_data = None
 
+        self.module_id = module_id
+        self.disk_cache = None
+        if cache_path is not None:
+            self.disk_cache = ChunkSizeCache(cache_path)
+
+    def _disk_cache_key(self, representative_fn, args, min_chunk_size):
+        tensors = [a for a in args if type(a) is torch.Tensor]
+        device_name, free_bucket = _device_key(tensors[0].device)
+        shapes = [tuple(_bucket(d) for d in t.shape) for t in tensors]
+        options = sorted(_fn_options(representative_fn).items())
+        return "|".join([
+            device_name,
+            f"{free_bucket}GB",
+            str(self.module_id),
+            str(shapes),
+            str(options),
+            f"min={min_chunk_size}",
+            f"max={self.max_chunk_size}",
+        ])
+
     def _determine_favorable_chunk_size(self, fn, args, min_chunk_size):
         logging.info("Tuning chunk size...")
         
@@ -362,7 +503,8 @@ class ChunkSizeTuner:
     
         def test_chunk_size(chunk_size):
             try:
-                with torch.no_grad():
+                # Trial runs aren't profiled as the module's stages
+                with torch.no_grad(), suspend_module_stages():
                     fn(*args, chunk_size=chunk_size)
                 return True
             except RuntimeError:
@@ -418,11 +560,26 @@ class ChunkSizeTuner:
             consistent = False
 
         if(not consistent):
-            self.cached_chunk_size = self._determine_favorable_chunk_size(
-                representative_fn,
-                args,
-                min_chunk_size,
-            )
+            disk_key = None
+            chunk_size = None
+            if(self.disk_cache is not None):
+                disk_key = self._disk_cache_key(
+                    representative_fn, args, min_chunk_size,
+                )
+                chunk_size = self.disk_cache.get(disk_key)
+
+            if(chunk_size is None):
+                chunk_size = self._determine_favorable_chunk_size(
+                    representative_fn,
+                    args,
+                    min_chunk_size,
+                )
+                if(disk_key is not None):
+                    self.disk_cache.put(disk_key, chunk_size)
+            else:
+                logging.info(f"Using cached chunk size {chunk_size}")
+
+            self.cached_chunk_size = chunk_size
             self.cached_arg_data = arg_data
 
         return self.cached_chunk_size
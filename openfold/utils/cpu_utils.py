@@ -0,0 +1,147 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers for running inference on CPUs. See the cpu_inference option of
+model_config for the corresponding config changes.
+"""
+import functools
+import logging
+import os
+from typing import List, Optional
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+# Submodules kept in fp32 under bfloat16 autocast. Their outputs are the
+# coordinates and confidences, which are sensitive to the reduced mantissa
+FP32_MODULES = ["structure_module", "aux_heads"]
+
+
+def parse_core_list(cores: str) -> List[int]:
+    """ Parses a list of cores like "0-3,8,10-11" """
+    parsed = []
+    for part in cores.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-")
+            parsed.extend(range(int(start), int(end) + 1))
+        elif part:
+            parsed.append(int(part))
+    return parsed
+
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def configure_cpu_threads(
+    threads: Optional[int] = None,
+    interop_threads: Optional[int] = None,
+    cores: Optional[List[int]] = None,
+) -> int:
+    """
+        Pins the process to a set of cores and sizes PyTorch's thread pools
+        accordingly. Must be called before PyTorch runs any parallel work.
+
+        Args:
+            threads:
+                Number of intra-op threads. Defaults to the number of cores
+                the process may run on
+            interop_threads:
+                Number of inter-op threads. The model rarely runs ops
+                concurrently, so a small number suffices
+            cores:
+                Cores to pin the process to
+        Returns:
+            The number of intra-op threads
+    """
+    if cores is not None:
+        if not hasattr(os, "sched_setaffinity"):
+            raise ValueError("Pinning to cores isn't supported on this platform")
+        os.sched_setaffinity(0, cores)
+
+    if threads is None:
+        threads = len(available_cores())
+
+    torch.set_num_threads(threads)
+    if interop_threads is not None:
+        torch.set_num_interop_threads(interop_threads)
+
+    return threads
+
+
+def cpu_supports_bf16() -> bool:
+    """
+        Whether the CPU has native bfloat16 instructions. Without them,
+        bfloat16 matmuls are emulated and slower than fp32 ones.
+    """
+    try:
+        with open("/proc/cpuinfo", "r") as fp:
+            cpuinfo = fp.read()
+    except OSError:
+        return False
+
+    flags = set()
+    for line in cpuinfo.split("\n"):
+        if line.startswith("flags"):
+            flags.update(line.split(":", 1)[1].split())
+
+    return len({"avx512_bf16", "amx_bf16"} & flags) > 0
+
+
+def _to_fp32(x):
+    if isinstance(x, torch.Tensor) and x.dtype == torch.bfloat16:
+        return x.float()
+    elif isinstance(x, dict):
+        return {k: _to_fp32(v) for k, v in x.items()}
+    return x
+
+
+def _fp32_forward(forward):
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        with torch.autocast("cpu", enabled=False):
+            args = [_to_fp32(a) for a in args]
+            kwargs = {k: _to_fp32(v) for k, v in kwargs.items()}
+            return forward(*args, **kwargs)
+    return wrapper
+
+
+def keep_fp32_(model):
+    """
+        Excludes the FP32_MODULES of an AlphaFold model from CPU autocast,
+        casting their bfloat16 inputs back to fp32. Only the evoformer and
+        the stacks before it then run in bfloat16.
+    """
+    for name in FP32_MODULES:
+        module = getattr(model, name)
+        module.forward = _fp32_forward(module.forward)
+
+
+def compile_evoformer_blocks_(model):
+    """
+        Compiles each evoformer block with torch.compile. Shapes differ
+        between targets, so the blocks are compiled for dynamic shapes.
+    """
+    if not hasattr(torch, "compile"):
+        raise ValueError("torch.compile requires PyTorch 2.0 or later")
+
+    for block in model.evoformer.blocks:
+        block.forward = torch.compile(block.forward, dynamic=True)
@@ -0,0 +1,425 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Ranking of decoy structures by how confidently the model reproduces them
+when they're given as its only template, as in AF2Rank.
+
+The target's features are computed once, decoys are run through the model
+in batches, and predictions are compared to the decoys and to the native
+structure in-process, on the model's device.
+"""
+import dataclasses
+import json
+import os
+from typing import Iterable, Iterator, Optional, Sequence
+
+import numpy as np
+import torch
+
+from openfold.data import feature_pipeline
+from openfold.np import protein, residue_constants
+from openfold.utils.batch_utils import stack_features, unbatch_outputs
+from openfold.utils.tensor_utils import tensor_tree_map
+from openfold.utils.validation_metrics import compare_structures, tm_score
+
+
+@dataclasses.dataclass
+class Decoy:
+    decoy_id: str
+    # None for a prediction without templates
+    protein: Optional[protein.Protein]
+
+
+def _place_residues(prot: protein.Protein, num_res: int):
+    """
+        Scatters the atoms of a structure into arrays of the target's length,
+        by residue index, which starts at 1
+    """
+    idx = prot.residue_index - 1
+    pos = np.zeros((num_res, residue_constants.atom_type_num, 3))
+    mask = np.zeros((num_res, residue_constants.atom_type_num))
+    pos[idx] = prot.atom_positions
+    mask[idx] = prot.atom_mask
+    return pos, mask
+
+
+def _extend(a, b, c, length, angle, dihedral):
+    """
+        Places the atom at the given bond length, angle and dihedral to the
+        atoms a, b and c, e.g. a C-beta from the C, N and CA atoms
+    """
+    def normalize(x):
+        return x / np.sqrt(np.square(x).sum(-1, keepdims=True) + 1e-8)
+
+    bc = normalize(b - c)
+    n = normalize(np.cross(b - a, bc))
+    m = [bc, np.cross(n, bc), n]
+    d = [
+        length * np.cos(angle),
+        length * np.sin(angle) * np.cos(dihedral),
+        -length * np.sin(angle) * np.sin(dihedral),
+    ]
+    return c + sum([m_i * d_i for m_i, d_i in zip(m, d)])
+
+
+def empty_template_features(num_res: int) -> dict:
+    return {
+        "template_aatype": np.zeros(
+            (0, num_res, len(residue_constants.restypes_with_x_and_gap)),
+            dtype=np.int64,
+        ),
+        "template_all_atom_mask": np.zeros(
+            (0, num_res, residue_constants.atom_type_num), dtype=np.float32
+        ),
+        "template_all_atom_positions": np.zeros(
+            (0, num_res, residue_constants.atom_type_num, 3), dtype=np.float32
+        ),
+        "template_domain_names": np.zeros([0], dtype=object),
+        "template_sum_probs": np.zeros([0, 1], dtype=np.float32),
+    }
+
+
+def decoy_template_features(
+    target_seq: str,
+    decoy: protein.Protein,
+    seq_replacement: str = "",
+    mask_sidechains: bool = False,
+    add_cb: bool = False,
+):
+    """
+        Builds the features of a decoy as the only template of its target.
+
+        Args:
+            target_seq:
+                Sequence of the target
+            decoy:
+                The decoy, whose residue indices, starting at 1, index into
+                the target sequence
+            seq_replacement:
+                Amino acid to fill the template sequence with. By default,
+                it's the target sequence
+            mask_sidechains:
+                Whether to mask out the side chain atoms beyond C-beta
+            add_cb:
+                Whether to also place C-betas on residues without one, e.g.
+                glycines. Implies mask_sidechains
+        Returns:
+            The template features, and whether the decoy's sequence differs
+            from the target's, i.e. is missing residues
+    """
+    decoy_seq = "".join([residue_constants.restypes[x] for x in decoy.aatype])
+    idx = decoy.residue_index - 1
+    mismatch = decoy_seq != target_seq
+    if mismatch:
+        if "".join(target_seq[i] for i in idx) != decoy_seq:
+            raise ValueError(
+                "The decoy sequence doesn't match the target sequence"
+            )
+    elif np.any(idx != np.arange(len(target_seq))):
+        raise ValueError("The decoy residue indices aren't consecutive")
+
+    num_res = len(target_seq)
+    if len(seq_replacement) == 1:
+        template_seq = seq_replacement * num_res
+    else:
+        template_seq = target_seq
+
+    pos, mask = _place_residues(decoy, num_res)
+    if mask_sidechains or add_cb:
+        pos[:, 5:] = 0
+        mask[:, 5:] = 0
+
+    if add_cb:
+        # Residues with N, CA and C but no C-beta
+        projected_cb = np.all(mask[:, :3] == 1, axis=-1) & (mask[:, 3] == 0)
+        cb = _extend(pos[:, 2], pos[:, 0], pos[:, 1], 1.522, 1.927, -2.143)
+        pos[projected_cb, 3] = cb[projected_cb]
+        mask[projected_cb, 3] = 1
+
+    features = {
+        "template_aatype": residue_constants.sequence_to_onehot(
+            template_seq, residue_constants.HHBLITS_AA_TO_ID
+        )[None],
+        "template_all_atom_mask": mask[None].astype(np.float32),
+        "template_all_atom_positions": pos[None].astype(np.float32),
+        "template_domain_names": np.asarray(["None"]),
+        "template_sum_probs": np.ones([1, 1], dtype=np.float32),
+    }
+
+    return features, mismatch
+
+
+def load_results(results_path: str) -> dict:
+    """
+        Loads the checkpointed results of a ranking run, by decoy ID. A
+        result that was being written when the run died is removed from the
+        file, so that new results can be appended to it.
+    """
+    results = {}
+    if not os.path.exists(results_path):
+        return results
+
+    size = 0
+    with open(results_path, "rb") as fp:
+        for line in fp:
+            if not line.endswith(b"\n"):
+                break
+            result = json.loads(line)
+            results[result["decoy_id"]] = result
+            size += len(line)
+
+    if size != os.path.getsize(results_path):
+        os.truncate(results_path, size)
+
+    return results
+
+
+class DecoyRanker:
+    """
+        Scores the decoys of one target.
+
+        The target's features are processed with each decoy as its only
+        template, and up to batch_size decoys are run through the model at
+        once. Each prediction is compared to its decoy and, if given, to the
+        native structure. Comparisons are batched and run on the model's
+        device.
+    """
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        feature_processor: feature_pipeline.FeaturePipeline,
+        feature_dict: dict,
+        native: Optional[protein.Protein] = None,
+        batch_size: int = 1,
+        device: str = "cpu",
+        seq_replacement: str = "",
+        mask_sidechains: bool = False,
+        add_cb: bool = False,
+    ):
+        """
+            Args:
+                model:
+                    The model, in eval mode
+                feature_processor:
+                    Feature pipeline of the model's config
+                feature_dict:
+                    The target's sequence and MSA features, and its sequence
+                    embedding for single sequence models, without templates
+                native:
+                    The native structure to compare predictions to
+                batch_size:
+                    Maximum number of decoys per forward pass
+                seq_replacement, mask_sidechains, add_cb:
+                    See decoy_template_features
+        """
+        self.model = model
+        self.feature_processor = feature_processor
+        self.feature_dict = feature_dict
+        self.batch_size = batch_size
+        self.device = device
+        self.template_kwargs = {
+            "seq_replacement": seq_replacement,
+            "mask_sidechains": mask_sidechains,
+            "add_cb": add_cb,
+        }
+
+        self.target_seq = feature_dict["sequence"][0].decode("utf-8")
+        self.num_res = len(self.target_seq)
+
+        self.native = None
+        if native is not None:
+            pos, mask = _place_residues(native, self.num_res)
+            self.native = (
+                torch.tensor(pos, dtype=torch.float32, device=device),
+                torch.tensor(mask, dtype=torch.float32, device=device),
+            )
+
+    def _process_features(self, decoy: Decoy):
+        mismatch = False
+        if decoy.protein is None:
+            template_feats = empty_template_features(self.num_res)
+        else:
+            template_feats, mismatch = decoy_template_features(
+                self.target_seq, decoy.protein, **self.template_kwargs
+            )
+
+        processed_feature_dict = self.feature_processor.process_features(
+            {**self.feature_dict, **template_feats}, mode="predict",
+        )
+        processed_feature_dict = {
+            k: torch.as_tensor(v)
+            for k, v in processed_feature_dict.items()
+        }
+
+        return processed_feature_dict, template_feats, mismatch
+
+    def _compare(self, pred_pos, template_feats):
+        """
+            Compares a batch of predictions to their decoys and the native
+            structure
+
+            Args:
+                pred_pos:
+                    [B, N, 37, 3] predicted atom positions
+                template_feats:
+                    Template features of the decoys, or None for predictions
+                    without templates
+        """
+        ca = residue_constants.atom_order["CA"]
+        pred_ca = pred_pos[..., ca, :]
+        no_res = torch.tensor(float(self.num_res), device=pred_pos.device)
+
+        metrics = {}
+        decoy_pos = torch.stack([
+            torch.as_tensor(
+                t["template_all_atom_positions"][0] if t is not None
+                else np.zeros(pred_pos.shape[-3:], dtype=np.float32)
+            )
+            for t in template_feats
+        ]).to(pred_pos.device)
+        decoy_mask = torch.stack([
+            torch.as_tensor(
+                t["template_all_atom_mask"][0] if t is not None
+                else np.zeros(pred_pos.shape[-3:-1], dtype=np.float32)
+            )
+            for t in template_feats
+        ]).to(pred_pos.device)
+
+        # Normalized by the length of the prediction, like TMscore with the
+        # decoy as the model and the prediction as the reference
+        metrics["tm_decoy"] = tm_score(
+            decoy_pos[..., ca, :], pred_ca, decoy_mask[..., ca], length=no_res,
+        )
+
+        if self.native is not None:
+            native_pos, native_mask = self.native
+            native_metrics = compare_structures(
+                pred_ca,
+                native_pos[..., ca, :].expand(pred_ca.shape),
+                native_mask[..., ca].expand(pred_ca.shape[:-1]),
+            )
+            for k in ["tm_score", "rmsd", "gdt_ts", "lddt"]:
+                name = "tm" if k == "tm_score" else k
+                metrics[f"{name}_native"] = native_metrics[k]
+
+        return {k: v.cpu().numpy() for k, v in metrics.items()}
+
+    def _run_batch(self, decoys: Sequence[Decoy]):
+        feats, template_feats, mismatches = zip(
+            *[self._process_features(d) for d in decoys]
+        )
+
+        batch = stack_features(feats)
+        batch = tensor_tree_map(lambda t: t.to(self.device), batch)
+        with torch.no_grad():
+            out = self.model(batch)
+
+        target_outs = []
+        for j in range(len(decoys)):
+            target_out = unbatch_outputs(
+                out, j, self.num_res, self.model.config.heads.tm
+            )
+            target_outs.append(target_out)
+
+        pred_pos = torch.stack(
+            [o["final_atom_positions"] for o in target_outs]
+        ).to(torch.float32)
+        metrics = self._compare(
+            pred_pos,
+            [t if d.protein is not None else None
+             for d, t in zip(decoys, template_feats)],
+        )
+
+        results = []
+        for j, (decoy, target_out) in enumerate(zip(decoys, target_outs)):
+            target_out = tensor_tree_map(
+                lambda x: np.array(x.float().cpu()), target_out
+            )
+            features = tensor_tree_map(
+                lambda x: np.array(x[..., -1].cpu()), feats[j]
+            )
+
+            plddt = target_out["plddt"]
+            result = {
+                "decoy_id": decoy.decoy_id,
+                "mismatch": mismatches[j],
+                "plddt": float(np.mean(plddt)),
+                "ptm": float(target_out.get("ptm_score", -1)),
+            }
+            for k, v in metrics.items():
+                result[k] = float(v[j])
+            if decoy.protein is None:
+                result["tm_decoy"] = -1.
+
+            result["protein"] = protein.from_prediction(
+                features,
+                target_out,
+                b_factors=plddt[:, None] * target_out["final_atom_mask"],
+                remove_leading_feature_dimension=False,
+            )
+            results.append(result)
+
+        return results
+
+    def rank(
+        self,
+        decoys: Iterable[Decoy],
+        results_path: Optional[str] = None,
+    ) -> Iterator[dict]:
+        """
+            Scores decoys, yielding a result per decoy as its batch finishes.
+
+            Args:
+                decoys:
+                    The decoys. May be a generator that loads them lazily
+                results_path:
+                    JSON lines file to which results are checkpointed. The
+                    results of decoys already in it are yielded, without
+                    "protein" entries, instead of being recomputed
+            Yields:
+                Dicts of the decoy ID, the mean pLDDT, the pTM (-1 without a
+                TM head), whether the decoy is missing residues, the
+                TM-score of the prediction to the decoy ("tm_decoy", -1
+                without a template), and its TM-score, RMSD, GDT-TS and
+                lDDT to the native ("tm_native", "rmsd_native",
+                "gdt_ts_native", "lddt_native"), as well as the predicted
+                structure as "protein"
+        """
+        done = {}
+        if results_path is not None:
+            done = load_results(results_path)
+
+        decoys = iter(decoys)
+        while True:
+            batch = []
+            for decoy in decoys:
+                if decoy.decoy_id in done:
+                    yield done[decoy.decoy_id]
+                    continue
+                batch.append(decoy)
+                if len(batch) == self.batch_size:
+                    break
+
+            if len(batch) == 0:
+                return
+
+            results = self._run_batch(batch)
+            if results_path is not None:
+                with open(results_path, "a") as fp:
+                    for r in results:
+                        r = {k: v for k, v in r.items() if k != "protein"}
+                        fp.write(json.dumps(r) + "\n")
+
+            yield from results
@@ -34,6 +34,10 @@ class ExponentialMovingAverage:
         self.decay = decay
         self.device = next(model.parameters()).device
 
+        # Set while the stored parameters are swapped into a model
+        self._swapped = None
+        self._swap_buffers = {}
+
     def to(self, device):
         self.params = tensor_tree_map(lambda t: t.to(device), self.params)
         self.device = device
@@ -57,15 +61,69 @@ class ExponentialMovingAverage:
         """
         self._update_state_dict_(model.state_dict(), self.params)
 
+    def swap(self, model: torch.nn.Module) -> None:
+        """
+        Swaps the stored parameters with those of the model, e.g. to
+        evaluate the model with the averaged parameters. Calling it again
+        swaps them back.
+
+        Tensors of the same shape, dtype and device are swapped by reference,
+        without copying. Others, e.g. the parameters of a model trained in
+        half precision, are copied, and the model's own are backed up in
+        buffers that are reused across swaps. The stored parameters
+        themselves are never cast.
+        """
+        with torch.no_grad():
+            if self._swapped is None:
+                tensors = dict(model.named_parameters())
+                tensors.update(model.named_buffers())
+                swapped = {}
+                for k, t in tensors.items():
+                    stored = self.params.get(k)
+                    if stored is None:
+                        continue
+                    if(stored.shape == t.shape and
+                       stored.dtype == t.dtype and
+                       stored.device == t.device):
+                        t.data, self.params[k] = stored, t.data
+                        swapped[k] = (t, True)
+                    else:
+                        backup = self._swap_buffers.get(k)
+                        if backup is None or backup.device != t.device:
+                            backup = torch.empty_like(t.data)
+                            self._swap_buffers[k] = backup
+                        backup.copy_(t.data)
+                        t.data.copy_(stored)
+                        swapped[k] = (t, False)
+                self._swapped = swapped
+            else:
+                for k, (t, by_reference) in self._swapped.items():
+                    if by_reference:
+                        t.data, self.params[k] = self.params[k], t.data
+                    else:
+                        t.data.copy_(self._swap_buffers[k])
+                self._swapped = None
+
     def load_state_dict(self, state_dict: OrderedDict) -> None:
         for k in state_dict["params"].keys():
-            self.params[k] = state_dict["params"][k].clone()
+            # Stays on the device the averages are kept on
+            self.params[k] = state_dict["params"][k].to(
+                device=self.device, copy=True
+            )
         self.decay = state_dict["decay"]
 
     def state_dict(self) -> OrderedDict:
+        params = self.params
+        if self._swapped is not None:
+            # Parameters swapped by reference are in the model
+            params = OrderedDict(params)
+            for k, (t, by_reference) in self._swapped.items():
+                if by_reference:
+                    params[k] = t.data
+
         return OrderedDict(
             {
-                "params": self.params,
+                "params": params,
                 "decay": self.decay,
             }
         )
@@ -0,0 +1,448 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-target inference memory planning.
+
+Predicts the peak device memory of each major module from the target's
+dimensions and picks the fastest combination of chunk size, attention
+implementation, offloading and precision that fits in the available
+memory.
+"""
+import dataclasses
+import importlib
+import json
+import logging
+import os
+from typing import Dict, Optional, Sequence
+
+import torch
+
+from openfold.model.primitives import (
+    DEFAULT_LMA_Q_CHUNK_SIZE,
+    DEFAULT_LMA_KV_CHUNK_SIZE,
+)
+
+logger = logging.getLogger(__file__)
+
+GB = 1024 ** 3
+
+CHUNK_SIZE_CANDIDATES = [None, 256, 128, 64, 32, 16, 8, 4]
+
+# Relative runtimes of the various options. Rough, but only their order
+# matters for the choice between candidates that fit.
+ATTN_TIME_FACTORS = {
+    "default": 1.0,
+    "deepspeed": 0.8,
+    "lma": 1.5,
+}
+OFFLOAD_TIME_FACTOR = 1.25
+PRECISION_TIME_FACTORS = {
+    "cuda": {"fp32": 1.0, "bf16": 0.6},
+    "cpu": {"fp32": 1.0, "bf16": 0.9},
+}
+DTYPE_BYTES = {"fp32": 4, "bf16": 2}
+
+# Fraction of the available memory the plan may use. Leaves room for
+# allocator fragmentation and the CUDA context
+DEFAULT_SAFETY_MARGIN = 0.9
+
+# Parameter count of the monomer model
+DEFAULT_NO_PARAMS = 93_000_000
+
+MODULES = [
+    "features",
+    "weights",
+    "input_embedder",
+    "template_stack",
+    "extra_msa_stack",
+    "evoformer",
+    "structure_module",
+    "aux_heads",
+]
+
+
+@dataclasses.dataclass(frozen=True)
+class TargetDims:
+    n_res: int
+    n_seq: int
+    n_extra: int
+    n_templ: int
+
+
+@dataclasses.dataclass(frozen=True)
+class MemoryPlan:
+    """A memory configuration and its predicted cost."""
+    chunk_size: Optional[int]
+    attention: str
+    offload_inference: bool
+    precision: str
+    # Predicted peak device memory of each module, in bytes
+    module_peaks: Dict[str, int]
+    peak_bytes: int
+    budget_bytes: int
+    relative_runtime: float
+    fits: bool
+
+    def to_dict(self):
+        d = dataclasses.asdict(self)
+        d["peak_gb"] = round(self.peak_bytes / GB, 3)
+        d["budget_gb"] = round(self.budget_bytes / GB, 3)
+        return d
+
+
+def feature_dims(feats) -> TargetDims:
+    """
+    Args:
+        feats:
+            Processed feature dictionary of a single recycling iteration
+            (i.e. without the recycling dimension)
+    """
+    n_res = feats["aatype"].shape[-1]
+    n_seq = feats["msa_feat"].shape[-3]
+    n_extra = 0
+    if "extra_msa" in feats:
+        n_extra = feats["extra_msa"].shape[-2]
+    n_templ = 0
+    if "template_aatype" in feats:
+        n_templ = feats["template_aatype"].shape[-2]
+
+    return TargetDims(
+        n_res=int(n_res),
+        n_seq=int(n_seq),
+        n_extra=int(n_extra),
+        n_templ=int(n_templ),
+    )
+
+
+def available_memory(device) -> int:
+    """
+    Memory available to this process on the given device, in bytes.
+    Includes memory already held by its tensors (e.g. the model weights),
+    since the cost model accounts for those.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_allocated(device)
+
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def load_calibration(path: Optional[str]) -> Dict[str, float]:
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
+def save_calibration(calibration: Dict[str, float], path: str):
+    with open(path, "w") as fp:
+        json.dump(calibration, fp, indent=4)
+
+
+class MemoryPlanner:
+    """
+    Chooses memory-related inference settings per target.
+
+    The cost model is analytic: the size of the largest intermediate of
+    each module is derived from the target dimensions and the model config.
+    Each module estimate is multiplied by a calibration factor, which can
+    be refined from measured peaks with calibrate().
+    """
+    def __init__(
+        self,
+        config,
+        device: str = "cuda",
+        calibration: Optional[Dict[str, float]] = None,
+        allow_low_precision: bool = False,
+        doctor_exports: Sequence[str] = (),
+        safety_margin: float = DEFAULT_SAFETY_MARGIN,
+        no_params: int = DEFAULT_NO_PARAMS,
+    ):
+        """
+        Args:
+            config:
+                A model config (like the one in config.py)
+            device:
+                Device on which the model is run
+            calibration:
+                Dictionary of per-module correction factors
+            allow_low_precision:
+                Whether bfloat16 autocast may be chosen
+            doctor_exports:
+                Active doctor exports. Any of "attention", "structures",
+                "representations"
+            safety_margin:
+                Fraction of the available memory the plan may use
+            no_params:
+                Number of model parameters
+        """
+        self.config = config
+        self.device_type = torch.device(device).type
+        self.calibration = dict(calibration or {})
+        self.allow_low_precision = allow_low_precision
+        self.doctor_exports = set(doctor_exports)
+        self.safety_margin = safety_margin
+        self.no_params = no_params
+
+    def _attention_options(self):
+        # The attention exporter needs the attention weights, which only
+        # the default implementation materializes
+        if "attention" in self.doctor_exports:
+            return ["default"]
+
+        options = ["default", "lma"]
+        ds4s_is_installed = (
+            self.device_type == "cuda" and
+            importlib.util.find_spec("deepspeed") is not None and
+            importlib.util.find_spec("deepspeed.ops.deepspeed4science")
+            is not None
+        )
+        if ds4s_is_installed:
+            options.append("deepspeed")
+
+        return options
+
+    def _attn_logits(self, rows, heads, n_q, n_k, c_hidden, attention, b):
+        # Logits and softmax output for the given number of rows
+        if attention == "lma":
+            n_q = min(n_q, DEFAULT_LMA_Q_CHUNK_SIZE)
+            n_k = min(n_k, DEFAULT_LMA_KV_CHUNK_SIZE)
+        elif attention == "deepspeed":
+            # Fused kernel. Only q, k, v and the output are materialized
+            return 4 * rows * heads * n_q * c_hidden * b
+
+        return 2 * rows * heads * n_q * n_k * b
+
+    def estimate(
+        self,
+        dims: TargetDims,
+        chunk_size: Optional[int],
+        attention: str,
+        offload_inference: bool,
+        precision: str,
+    ) -> Dict[str, int]:
+        """Predicted peak device memory of each module, in bytes."""
+        c = self.config.model
+        b = DTYPE_BYTES[precision]
+        n = dims.n_res
+        chunk = lambda rows: rows if chunk_size is None else min(chunk_size, rows)
+
+        evo = c.evoformer_stack
+        c_m, c_z = evo.c_m, evo.c_z
+
+        templates_enabled = c.template.enabled and dims.n_templ > 0
+        n_s = dims.n_seq
+        if templates_enabled and not self.config.globals.is_multimer:
+            # Template torsion angle embeddings are appended to the MSA
+            n_s += dims.n_templ
+
+        # Pair representation, its recycled copy, MSA and single reps
+        pair = n * n * c_z * b
+        state = 2 * pair + n_s * n * c_m * b + n * c_m * b
+        if offload_inference:
+            # The recycled pair representation is kept on the host
+            state -= pair
+
+        peaks = {}
+
+        # Input features are kept in fp32 on the device
+        feat_bytes = (
+            n_s * n * c.input_embedder.msa_dim +
+            dims.n_extra * n * 4 +
+            dims.n_templ * n * 37 * 4
+        ) * 4
+        peaks["features"] = feat_bytes
+
+        peaks["weights"] = self.no_params * b
+
+        # relpos one-hot and outer sum
+        peaks["input_embedder"] = (
+            state + n * n * (2 * c.input_embedder.relpos_k + 1) * 4
+        )
+
+        if templates_enabled:
+            tps = c.template.template_pair_stack
+            t_state = n * n * tps.c_t * b
+            if not (
+                c.template.offload_templates or c.template.average_templates
+                or offload_inference
+            ):
+                # All templates are embedded before the pointwise attention
+                t_state *= dims.n_templ
+            t_attn = self._attn_logits(
+                chunk(n), tps.no_heads, n, n, tps.c_hidden_tri_att,
+                attention, b,
+            )
+            t_mul = 2 * n * n * tps.c_hidden_tri_mul * b
+            peaks["template_stack"] = state + t_state + max(t_attn, t_mul)
+        else:
+            peaks["template_stack"] = 0
+
+        def stack_peak(cfg, n_rows, global_col_attention):
+            rep = n_rows * n * cfg.c_m * b
+            row_attn = self._attn_logits(
+                chunk(n_rows), cfg.no_heads_msa, n, n, cfg.c_hidden_msa_att,
+                attention, b,
+            )
+            if global_col_attention:
+                col_attn = 2 * n * cfg.no_heads_msa * n_rows * b
+            else:
+                col_attn = self._attn_logits(
+                    chunk(n), cfg.no_heads_msa, n_rows, n_rows,
+                    cfg.c_hidden_msa_att, attention, b,
+                )
+            tri_attn = self._attn_logits(
+                chunk(n), cfg.no_heads_pair, n, n, cfg.c_hidden_pair_att,
+                attention, b,
+            )
+            tri_mul = 2 * n * n * cfg.c_hidden_mul * b
+            opm = chunk(n) * n * cfg.c_hidden_opm ** 2 * b
+            transition = chunk(n) * n * cfg.transition_n * c_z * b
+            return rep + max(
+                row_attn, col_attn, tri_attn, tri_mul, opm, transition
+            )
+
+        if c.extra_msa.enabled and dims.n_extra > 0:
+            peaks["extra_msa_stack"] = state + stack_peak(
+                c.extra_msa.extra_msa_stack, dims.n_extra, True,
+            )
+        else:
+            peaks["extra_msa_stack"] = 0
+
+        sm = c.structure_module
+        # IPA logits and pair bias
+        peaks["structure_module"] = (
+            state + 4 * sm.no_heads_ipa * n * n * b + n * n * c_z * b
+        )
+
+        heads = c.heads
+        no_pair_heads = 2 if heads.tm.enabled else 1
+        peaks["aux_heads"] = (
+            state + no_pair_heads * n * n * heads.distogram.no_bins * 4
+        )
+
+        peaks["evoformer"] = state + stack_peak(evo, dims.n_seq, False)
+        if "structures" in self.doctor_exports:
+            # Structure exporter runs the structure module and the heads
+            # after every evoformer block
+            peaks["evoformer"] += max(
+                peaks["structure_module"], peaks["aux_heads"]
+            ) - state
+
+        # Persistent memory is present during every stage
+        persistent = peaks["features"] + peaks["weights"]
+        for k in MODULES:
+            if k not in ["features", "weights"] and peaks[k] > 0:
+                peaks[k] += persistent
+
+        for k in peaks:
+            factor = self.calibration.get(k, self.calibration.get("all", 1.))
+            peaks[k] = int(peaks[k] * factor)
+
+        return peaks
+
+    def candidates(self):
+        precisions = ["fp32"]
+        if self.allow_low_precision:
+            precisions.append("bf16")
+
+        for attention in self._attention_options():
+            for chunk_size in CHUNK_SIZE_CANDIDATES:
+                for offload in [False, True]:
+                    # Offloading is only implemented for the chunked path
+                    if offload and chunk_size is None:
+                        continue
+                    for precision in precisions:
+                        yield chunk_size, attention, offload, precision
+
+    def relative_runtime(self, chunk_size, attention, offload, precision):
+        t = ATTN_TIME_FACTORS[attention]
+        if chunk_size is not None:
+            t *= 1 + 4. / chunk_size
+        if offload:
+            t *= OFFLOAD_TIME_FACTOR
+        t *= PRECISION_TIME_FACTORS[self.device_type][precision]
+        return t
+
+    def plan(self, dims: TargetDims, available_bytes: int) -> MemoryPlan:
+        """
+        Returns the fastest plan whose predicted peak fits in the given
+        memory. If none does, returns the plan with the lowest peak.
+        """
+        budget = int(available_bytes * self.safety_margin)
+
+        plans = []
+        for chunk_size, attention, offload, precision in self.candidates():
+            peaks = self.estimate(
+                dims, chunk_size, attention, offload, precision
+            )
+            peak = max(peaks.values())
+            plans.append(MemoryPlan(
+                chunk_size=chunk_size,
+                attention=attention,
+                offload_inference=offload,
+                precision=precision,
+                module_peaks=peaks,
+                peak_bytes=peak,
+                budget_bytes=budget,
+                relative_runtime=self.relative_runtime(
+                    chunk_size, attention, offload, precision
+                ),
+                fits=peak <= budget,
+            ))
+
+        fitting = [p for p in plans if p.fits]
+        if len(fitting) == 0:
+            best = min(plans, key=lambda p: p.peak_bytes)
+            logger.warning(
+                f"No memory plan fits in {budget / GB:.2f} GB (smallest "
+                f"predicted peak: {best.peak_bytes / GB:.2f} GB). Using it "
+                f"anyway."
+            )
+            return best
+
+        return min(fitting, key=lambda p: (p.relative_runtime, p.peak_bytes))
+
+    def calibrate(self, plan: MemoryPlan, measured_peak_bytes: int):
+        """
+        Scales the cost model such that the predicted peak of the given plan
+        matches the measured one. Returns the updated calibration.
+        """
+        ratio = measured_peak_bytes / max(plan.peak_bytes, 1)
+        self.calibration["all"] = self.calibration.get("all", 1.) * ratio
+        return self.calibration
+
+
+def apply_plan(config, plan: MemoryPlan):
+    """
+    Writes the settings of a plan into a model config, in place. Since
+    models keep a reference to their config, this takes effect on models
+    that have already been instantiated.
+    """
+    config.globals.chunk_size = plan.chunk_size
+    config.globals.use_lma = plan.attention == "lma"
+    config.globals.use_deepspeed_evo_attention = plan.attention == "deepspeed"
+    config.globals.use_flash = False
+    config.globals.offload_inference = plan.offload_inference
+    config.model.template.offload_templates = (
+        plan.offload_inference and not config.model.template.average_templates
+    )
+
+
+def autocast_dtype(plan: MemoryPlan):
+    if plan.precision == "bf16":
+        return torch.bfloat16
+    return None
@@ -0,0 +1,312 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Opt-in profiling of the stages of an inference run.
+
+A Profiler records the wall time, CUDA time and peak CUDA memory of named
+stages. Stages are delimited either explicitly, with profile_stage, or by
+forward hooks that Profiler.attach registers on the major submodules of a
+model. Until a profiler is activated with set_profiler, profile_stage is a
+no-op and no hooks are registered.
+"""
+import contextlib
+import functools
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+_profiler = None
+
+
+def set_profiler(profiler):
+    """ Makes profiler the target of profile_stage. None disables it. """
+    global _profiler
+    _profiler = profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+def profile_stage(name: str):
+    """ Context manager recording a stage with the active profiler """
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.stage(name)
+
+
+@contextlib.contextmanager
+def suspend_module_stages():
+    """
+        Keeps the module hooks of the active profiler from recording stages,
+        e.g. during trial runs of a module
+    """
+    if _profiler is None:
+        yield
+        return
+
+    _profiler._suspended += 1
+    try:
+        yield
+    finally:
+        _profiler._suspended -= 1
+
+
+def profiled(name: str):
+    """ Decorator recording each call of a function as a stage """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with profile_stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _model_stages(model) -> Dict[str, torch.nn.Module]:
+    stages = {}
+    for name in [
+        "input_embedder",
+        "recycling_embedder",
+        "template_embedder",
+        "extra_msa_stack",
+        "structure_module",
+        "aux_heads",
+    ]:
+        module = getattr(model, name, None)
+        if module is not None:
+            stages[name] = module
+
+    for i, block in enumerate(model.evoformer.blocks):
+        stages[f"evoformer_block_{i}"] = block
+
+    return stages
+
+
+class _Record:
+    __slots__ = [
+        "name", "target", "depth", "start", "wall", "child_wall",
+        "cuda_events", "peak_memory", "child_peak_memory",
+    ]
+
+
+class Profiler:
+    """
+        Records the stages of an inference run.
+
+        Stages may be nested. For each, the total wall time, the wall time
+        not spent in nested stages ("self_wall"), the CUDA time between its
+        start and end and the peak CUDA memory allocated during it are
+        recorded. CUDA times are resolved lazily, so recording them doesn't
+        synchronize the device.
+    """
+    def __init__(self, device: str = "cpu", synchronize: bool = True):
+        """
+            Args:
+                device:
+                    Device the model runs on
+                synchronize:
+                    Whether to synchronize CUDA devices at stage boundaries,
+                    so that wall times include the kernels launched during
+                    the stage. Adds a small overhead.
+        """
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda"
+        self.synchronize = synchronize and self.use_cuda
+        self.target = None
+        self.records = []
+        self._stack = []
+        self._hook_handles = []
+        self._suspended = 0
+        self._t0 = time.perf_counter()
+
+    def set_target(self, target: Optional[str]):
+        """ Labels the following stages with target """
+        self.target = target
+
+    def _begin(self, name: str) -> _Record:
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+
+        r = _Record()
+        r.name = name
+        r.target = self.target
+        r.depth = len(self._stack)
+        r.child_wall = 0.
+        r.child_peak_memory = 0
+        r.cuda_events = None
+        r.peak_memory = None
+        if self.use_cuda:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            r.cuda_events = (start, end)
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+        self._stack.append(r)
+        r.start = time.perf_counter()
+        return r
+
+    def _end(self, r: _Record):
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+        r.wall = time.perf_counter() - r.start
+
+        popped = self._stack.pop()
+        assert popped is r, "Profiler stages must be properly nested"
+
+        if self.use_cuda:
+            r.cuda_events[1].record()
+            # Nested stages reset the peak memory statistics
+            r.peak_memory = max(
+                torch.cuda.max_memory_allocated(self.device),
+                r.child_peak_memory,
+            )
+
+        if len(self._stack) > 0:
+            parent = self._stack[-1]
+            parent.child_wall += r.wall
+            if r.peak_memory is not None:
+                parent.child_peak_memory = max(
+                    parent.child_peak_memory, r.peak_memory
+                )
+
+        self.records.append(r)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        r = self._begin(name)
+        try:
+            yield
+        finally:
+            self._end(r)
+
+    def attach(self, model):
+        """
+            Registers stage hooks on the major submodules of an AlphaFold
+            model. Replaces hooks registered by earlier calls, so call this
+            again after submodules are swapped out, e.g. by tracing.
+        """
+        self.detach()
+        for name, module in _model_stages(model).items():
+            # Each pre-hook begins a stage that the matching hook ends, even
+            # if the forward pass raises, e.g. a recovered OOM
+            records = []
+            def pre_hook(module, args, name=name, records=records):
+                records.append(
+                    None if self._suspended else self._begin(name)
+                )
+
+            def hook(module, args, output, records=records):
+                r = records.pop()
+                if r is not None:
+                    self._end(r)
+
+            self._hook_handles.append(module.register_forward_pre_hook(pre_hook))
+            self._hook_handles.append(
+                module.register_forward_hook(hook, always_call=True)
+            )
+
+    def detach(self):
+        for handle in self._hook_handles:
+            handle.remove()
+        self._hook_handles = []
+
+    def events(self) -> List[dict]:
+        """ Returns the recorded stages in order of their start """
+        if self.use_cuda:
+            torch.cuda.synchronize(self.device)
+
+        events = []
+        for r in sorted(self.records, key=lambda r: r.start):
+            cuda_time = None
+            if r.cuda_events is not None:
+                cuda_time = r.cuda_events[0].elapsed_time(r.cuda_events[1]) / 1000
+            events.append({
+                "name": r.name,
+                "target": r.target,
+                "depth": r.depth,
+                "start": r.start - self._t0,
+                "wall": r.wall,
+                "self_wall": r.wall - r.child_wall,
+                "cuda_time": cuda_time,
+                "peak_memory": r.peak_memory,
+            })
+
+        return events
+
+    def summary(self) -> Dict[str, dict]:
+        """ Aggregates the recorded stages by name across targets """
+        summary = {}
+        for e in self.events():
+            s = summary.setdefault(e["name"], {
+                "count": 0,
+                "wall": 0.,
+                "self_wall": 0.,
+                "cuda_time": None,
+                "peak_memory": None,
+            })
+            s["count"] += 1
+            s["wall"] += e["wall"]
+            s["self_wall"] += e["self_wall"]
+            if e["cuda_time"] is not None:
+                s["cuda_time"] = (s["cuda_time"] or 0.) + e["cuda_time"]
+            if e["peak_memory"] is not None:
+                s["peak_memory"] = max(s["peak_memory"] or 0, e["peak_memory"])
+
+        for s in summary.values():
+            s["mean_wall"] = s["wall"] / s["count"]
+
+        return summary
+
+    def write_jsonl(self, path: str):
+        with open(path, "w") as fp:
+            for e in self.events():
+                fp.write(json.dumps(e) + "\n")
+
+    def write_chrome_trace(self, path: str):
+        """ Writes a trace viewable in chrome://tracing or Perfetto """
+        trace_events = []
+        for e in self.events():
+            trace_events.append({
+                "name": e["name"],
+                "cat": e["target"] or "",
+                "ph": "X",
+                "ts": e["start"] * 1e6,
+                "dur": e["wall"] * 1e6,
+                "pid": 0,
+                "tid": 0,
+                "args": {
+                    k: e[k] for k in
+                    ["target", "self_wall", "cuda_time", "peak_memory"]
+                },
+            })
+
+        with open(path, "w") as fp:
+            json.dump({"traceEvents": trace_events}, fp)
+
+    def write(self, path: str):
+        """ Writes a Chrome trace if path ends with .json, else JSONL """
+        if path.endswith(".json"):
+            self.write_chrome_trace(path)
+        else:
+            self.write_jsonl(path)
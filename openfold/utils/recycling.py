@@ -0,0 +1,275 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Convergence metrics computed between recycling iterations, and the early
+stopping rules built on top of them.
+"""
+from typing import Callable, Dict, Optional
+
+import torch
+
+import openfold.np.residue_constants as residue_constants
+from openfold.utils.superimposition import kabsch_rmsd
+
+
+def ca_drmsd(
+    prev_pos: torch.Tensor,
+    next_pos: torch.Tensor,
+    mask: torch.Tensor,
+    block_size: int = 256,
+    eps: float = 1e-8,
+) -> torch.Tensor:
+    """
+        RMSD between the CA distance matrices of two structures, as used in
+        AF2Complex: https://www.nature.com/articles/s41467-022-29394-2
+
+        The distance matrices are computed block_size rows at a time, so
+        that memory use stays linear in the number of residues.
+
+        Args:
+            prev_pos:
+                [*, N, 37, 3] previous atom positions
+            next_pos:
+                [*, N, 37, 3] current atom positions
+            mask:
+                [*, N] sequence mask
+        Returns:
+            [*] dRMSDs
+    """
+    ca_idx = residue_constants.atom_order["CA"]
+    prev_ca = prev_pos[..., ca_idx, :].float()
+    next_ca = next_pos[..., ca_idx, :].float()
+    mask = mask.float()
+
+    def distances(points, start, end):
+        d = points[..., start:end, None, :] - points[..., None, :, :]
+        return torch.sqrt(torch.sum(d ** 2, dim=-1))
+
+    n = mask.shape[-1]
+    sq_diff = 0
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        block_mask = mask[..., start:end, None] * mask[..., None, :]
+        block_sq_diff = (
+            distances(prev_ca, start, end) - distances(next_ca, start, end)
+        ) ** 2
+        sq_diff = sq_diff + torch.sum(block_mask * block_sq_diff, dim=(-1, -2))
+
+    # Matches masked_mean
+    no_pairs = torch.sum(mask, dim=-1) ** 2
+    sq_diff = sq_diff / (no_pairs + 1e-4)
+
+    return torch.sqrt(sq_diff + eps)
+
+
+def pair_summary(z: torch.Tensor, block_size: int = 256) -> torch.Tensor:
+    """
+        Per-pair norms of a pair representation. Comparing these between
+        recycling iterations is much cheaper than keeping the full previous
+        pair representation around.
+
+        Args:
+            z:
+                [*, N, N, C_z] pair representation
+        Returns:
+            [*, N, N] channel norms
+    """
+    n = z.shape[-3]
+    return torch.cat([
+        torch.linalg.vector_norm(
+            z[..., i:i + block_size, :, :], dim=-1, dtype=torch.float32
+        )
+        for i in range(0, n, block_size)
+    ], dim=-2)
+
+
+def pair_delta(
+    prev_summary: torch.Tensor,
+    next_summary: torch.Tensor,
+    mask: torch.Tensor,
+    eps: float = 1e-8,
+) -> torch.Tensor:
+    """
+        Relative change of a pair_summary between recycling iterations.
+
+        Args:
+            prev_summary:
+                [*, N, N] previous pair summary
+            next_summary:
+                [*, N, N] current pair summary
+            mask:
+                [*, N] sequence mask
+        Returns:
+            [*] relative changes
+    """
+    mask = mask.float()
+    pair_mask = mask[..., None] * mask[..., None, :]
+    diff = torch.sum(pair_mask * (next_summary - prev_summary) ** 2, dim=(-1, -2))
+    norm = torch.sum(pair_mask * prev_summary ** 2, dim=(-1, -2))
+    return torch.sqrt(diff / (norm + eps))
+
+
+class RecyclingMonitor:
+    """
+        Computes convergence metrics after each recycling iteration,
+        records their trajectory and decides whether to stop recycling.
+
+        Metrics:
+            "ca_drmsd": dRMSD of the CA atoms to the previous iteration
+            "ca_rmsd": CA RMSD to the previous iteration after superposition
+            "mean_plddt": mean pLDDT of the current iteration
+            "plddt_delta": absolute change of the mean pLDDT
+            "pair_delta": relative change of the pair representation norms
+
+        Metrics comparing two iterations are NaN in the first iteration.
+        Recycling stops once, for every element of the batch, all ("all"
+        rule) or any ("any" rule) of the metrics with a non-negative
+        tolerance are at or below it.
+    """
+    def __init__(self, config):
+        """
+            Args:
+                config:
+                    The model config. The dRMSD tolerance is the existing
+                    recycle_early_stop_tolerance; all other settings are
+                    in recycle_early_stop.
+        """
+        early_stop_config = config.recycle_early_stop
+        if early_stop_config.rule not in ["all", "any"]:
+            raise ValueError(
+                f"Unknown recycling early stopping rule: "
+                f"{early_stop_config.rule}"
+            )
+
+        self.rule = early_stop_config.rule
+        self.tolerances = {
+            "ca_drmsd": config.recycle_early_stop_tolerance,
+            "ca_rmsd": early_stop_config.ca_rmsd_tolerance,
+            "plddt_delta": early_stop_config.plddt_delta_tolerance,
+            "pair_delta": early_stop_config.pair_delta_tolerance,
+        }
+        self.tolerances = {
+            k: v for k, v in self.tolerances.items() if v >= 0
+        }
+
+        self.record_metrics = early_stop_config.record_metrics
+        if self.record_metrics:
+            self.metrics = [
+                "ca_drmsd", "ca_rmsd", "mean_plddt", "plddt_delta", "pair_delta"
+            ]
+        else:
+            self.metrics = list(self.tolerances)
+            if "plddt_delta" in self.metrics:
+                self.metrics.append("mean_plddt")
+
+        self.reset()
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.metrics) > 0
+
+    def reset(self):
+        self._prev = {}
+        self._trajectory = []
+
+    def update(
+        self,
+        outputs: Dict[str, torch.Tensor],
+        seq_mask: torch.Tensor,
+        plddt_fn: Optional[Callable[[dict], torch.Tensor]] = None,
+    ) -> bool:
+        """
+            Computes the metrics of the current recycling iteration.
+
+            Args:
+                outputs:
+                    Outputs of the iteration. Must include
+                    "final_atom_positions" and, for the pair delta, "pair"
+                seq_mask:
+                    [*, N] sequence mask
+                plddt_fn:
+                    Computes [*, N] pLDDTs from outputs. Required for the
+                    pLDDT metrics
+            Returns:
+                Whether to stop recycling
+        """
+        if not self.enabled:
+            return False
+
+        with torch.no_grad():
+            cur = {"pos": outputs["final_atom_positions"].detach()}
+            if "mean_plddt" in self.metrics:
+                plddt = plddt_fn(outputs).float()
+                mask = seq_mask.float()
+                cur["mean_plddt"] = (
+                    torch.sum(plddt * mask, dim=-1) /
+                    (torch.sum(mask, dim=-1) + 1e-8)
+                )
+            if "pair_delta" in self.metrics:
+                cur["pair"] = pair_summary(outputs["pair"].detach())
+
+            batch_dims = seq_mask.shape[:-1]
+            nan = seq_mask.new_full(batch_dims, float("nan"), dtype=torch.float32)
+            metrics = {}
+            prev = self._prev
+            for name in self.metrics:
+                if name == "mean_plddt":
+                    metrics[name] = cur["mean_plddt"]
+                elif len(prev) == 0:
+                    metrics[name] = nan
+                elif name == "ca_drmsd":
+                    metrics[name] = ca_drmsd(prev["pos"], cur["pos"], seq_mask)
+                elif name == "ca_rmsd":
+                    ca_idx = residue_constants.atom_order["CA"]
+                    metrics[name] = kabsch_rmsd(
+                        prev["pos"][..., ca_idx, :],
+                        cur["pos"][..., ca_idx, :],
+                        seq_mask,
+                    )
+                elif name == "plddt_delta":
+                    metrics[name] = torch.abs(
+                        cur["mean_plddt"] - prev["mean_plddt"]
+                    )
+                elif name == "pair_delta":
+                    metrics[name] = pair_delta(
+                        prev["pair"], cur["pair"], seq_mask
+                    )
+
+            self._prev = cur
+            self._trajectory.append(metrics)
+
+        if len(self.tolerances) == 0:
+            return False
+
+        # NaNs compare False, so the first iteration never stops
+        met = torch.stack([
+            metrics[name] <= tol for name, tol in self.tolerances.items()
+        ])
+        met = torch.all(met, dim=0) if self.rule == "all" else torch.any(met, dim=0)
+
+        return bool(torch.all(met).item())
+
+    def trajectory(self) -> Dict[str, torch.Tensor]:
+        """
+            Returns:
+                The recorded metrics, each of shape [*, N_iterations]
+        """
+        if len(self._trajectory) == 0:
+            return {}
+
+        return {
+            name: torch.stack([m[name] for m in self._trajectory], dim=-1)
+            for name in self.metrics
+        }
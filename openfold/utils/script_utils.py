@@ -1,8 +1,14 @@
 import json
 import logging
+import multiprocessing
 import os
 import re
 import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    wait,
+)
 
 import numpy
 import torch
@@ -141,13 +147,37 @@ def update_timings(timing_dict, output_file=os.path.join(os.getcwd(), "timings.j
                 timings = {}
     else:
         timings = {}
-    timings.update(timing_dict)
+    for k, v in timing_dict.items():
+        # Merge per-target entries written at different stages of a run
+        if isinstance(v, dict) and isinstance(timings.get(k), dict):
+            timings[k].update(v)
+        else:
+            timings[k] = v
     with open(output_file, "w") as f:
         json.dump(timings, f)
     return output_file
 
 
+def save_recycling_metrics(recycling_metrics, output_file):
+    """
+    Write the per-iteration recycling metrics of one target to a JSON file.
+    Metrics that are undefined for an iteration are written as null.
+    """
+    recycling_metrics = {
+        k: [None if numpy.isnan(x) else float(x) for x in numpy.asarray(v).reshape(-1)]
+        for k, v in recycling_metrics.items()
+    }
+    with open(output_file, "w") as f:
+        json.dump(recycling_metrics, f)
+    return output_file
+
+
 def run_model(model, batch, tag, output_dir):
+    """
+    tag may also be the list of tags of the targets in a batch. The batch's
+    inference time is then recorded for each of them.
+    """
+    tags = [tag] if isinstance(tag, str) else list(tag)
     with torch.no_grad():
         # Temporarily disable templates if there aren't any in the batch
         template_enabled = model.config.template.enabled
@@ -155,28 +185,28 @@ def run_model(model, batch, tag, output_dir):
             "template_" in k for k in batch
         ])
 
-        logger.info(f"Running inference for {tag}...")
+        logger.info(f"Running inference for {', '.join(tags)}...")
         t = time.perf_counter()
         out = model(batch)
         inference_time = time.perf_counter() - t
         logger.info(f"Inference time: {inference_time}")
-        update_timings({tag: {"inference": inference_time}}, os.path.join(output_dir, "timings.json"))
+        update_timings(
+            {t: {"inference": inference_time} for t in tags},
+            os.path.join(output_dir, "timings.json")
+        )
 
         model.config.template.enabled = template_enabled
 
     return out
 
 
-def prep_output(out, batch, feature_dict, feature_processor, config_preset, multimer_ri_gap, subtract_plddt):
-    plddt = out["plddt"]
-
-    plddt_b_factors = numpy.repeat(
-        plddt[..., None], residue_constants.atom_type_num, axis=-1
-    )
-
-    if subtract_plddt:
-        plddt_b_factors = 100 - plddt_b_factors
-
+def prep_output_metadata(batch, feature_dict, feature_processor, config_preset, multimer_ri_gap):
+    """
+    Computes everything prep_output needs besides the model outputs, which
+    stays the same across all structures predicted for a target. Only the
+    aatype, residue_index and asym_id entries of batch, which hold NumPy
+    arrays without a recycling dimension, are read.
+    """
     # Prep protein metadata
     template_domain_names = []
     template_chain_index = None
@@ -203,50 +233,96 @@ def prep_output(out, batch, feature_dict, feature_processor, config_preset, mult
         f"config_preset={config_preset}",
     ])
 
-    # For multi-chain FASTAs
+    # For multi-chain FASTAs, restart the residue index of each chain
     ri = feature_dict["residue_index"]
     chain_index = (ri - numpy.arange(ri.shape[0])) / multimer_ri_gap
     chain_index = chain_index.astype(numpy.int64)
-    cur_chain = 0
-    prev_chain_max = 0
-    for i, c in enumerate(chain_index):
-        if c != cur_chain:
-            cur_chain = c
-            prev_chain_max = i + cur_chain * multimer_ri_gap
+    prev_chain_index = numpy.concatenate([[0], chain_index[:-1]])
+    chain_starts = numpy.where(
+        chain_index != prev_chain_index, numpy.arange(ri.shape[0]), -1
+    )
+    chain_start = numpy.maximum.accumulate(chain_starts)
+    prev_chain_max = numpy.where(
+        chain_start >= 0,
+        chain_start + chain_index[chain_start] * multimer_ri_gap,
+        0,
+    )
+
+    residue_index = numpy.array(batch["residue_index"])
+    residue_index[:ri.shape[0]] -= prev_chain_max
+
+    features = {
+        "aatype": batch["aatype"],
+        "residue_index": residue_index,
+    }
+    if "asym_id" in batch:
+        features["asym_id"] = batch["asym_id"]
+
+    return {
+        "features": features,
+        "remark": remark,
+        "parents": template_domain_names,
+        "parents_chain_index": template_chain_index,
+    }
+
 
-        batch["residue_index"][i] -= prev_chain_max
+def prep_output(out, batch, feature_dict, feature_processor, config_preset, multimer_ri_gap, subtract_plddt,
+                metadata=None):
+    """
+    Assembles the output protein of a prediction. Only final_atom_positions,
+    final_atom_mask and plddt are read from out. metadata may be the
+    result of an earlier prep_output_metadata call for the same target, in
+    which case batch, feature_dict, feature_processor, config_preset and
+    multimer_ri_gap are ignored.
+    """
+    if metadata is None:
+        metadata = prep_output_metadata(
+            batch, feature_dict, feature_processor, config_preset, multimer_ri_gap
+        )
+
+    plddt = out["plddt"]
+
+    plddt_b_factors = numpy.repeat(
+        plddt[..., None], residue_constants.atom_type_num, axis=-1
+    )
+
+    if subtract_plddt:
+        plddt_b_factors = 100 - plddt_b_factors
 
     unrelaxed_protein = protein.from_prediction(
-        features=batch,
+        features=metadata["features"],
         result=out,
         b_factors=plddt_b_factors,
         remove_leading_feature_dimension=False,
-        remark=remark,
-        parents=template_domain_names,
-        parents_chain_index=template_chain_index,
+        remark=metadata["remark"],
+        parents=metadata["parents"],
+        parents_chain_index=metadata["parents_chain_index"],
     )
 
     return unrelaxed_protein
 
 
-def relax_protein(config, model_device, unrelaxed_protein, output_directory, output_name, cif_output=False):
+def _relax(relax_config, use_gpu, unrelaxed_protein, cif_output):
     amber_relaxer = relax.AmberRelaxation(
-        use_gpu=(model_device != "cpu"),
-        **config.relax,
+        use_gpu=use_gpu,
+        **relax_config,
     )
 
     t = time.perf_counter()
-    visible_devices = os.getenv("CUDA_VISIBLE_DEVICES", default="")
-    if "cuda" in model_device:
-        device_no = model_device.split(":")[-1]
-        os.environ["CUDA_VISIBLE_DEVICES"] = device_no
     # the struct_str will contain either a PDB-format or a ModelCIF format string
     struct_str, _, _ = amber_relaxer.process(prot=unrelaxed_protein, cif_output=cif_output)
-    os.environ["CUDA_VISIBLE_DEVICES"] = visible_devices
     relaxation_time = time.perf_counter() - t
 
+    return struct_str, relaxation_time
+
+
+def _write_relaxed_protein(struct_str, relaxation_time, output_directory, output_name, cif_output, tag, timings_dir):
     logger.info(f"Relaxation time: {relaxation_time}")
-    update_timings({"relaxation": relaxation_time}, os.path.join(output_directory, "timings.json"))
+    # Keyed like the inference time of run_model
+    update_timings(
+        {tag: {"relaxation": relaxation_time}},
+        os.path.join(timings_dir, "timings.json")
+    )
 
     # Save the relaxed PDB.
     suffix = "_relaxed.pdb"
@@ -259,3 +335,78 @@ def relax_protein(config, model_device, unrelaxed_protein, output_directory, out
         fp.write(struct_str)
 
     logger.info(f"Relaxed output written to {relaxed_output_path}...")
+
+
+def relax_protein(config, model_device, unrelaxed_protein, output_directory, output_name, cif_output=False, tag=None, timings_dir=None):
+    """
+    tag and timings_dir are those passed to run_model for the same target.
+    They default to output_name and output_directory.
+    """
+    visible_devices = os.getenv("CUDA_VISIBLE_DEVICES", default="")
+    if "cuda" in model_device:
+        device_no = model_device.split(":")[-1]
+        os.environ["CUDA_VISIBLE_DEVICES"] = device_no
+    struct_str, relaxation_time = _relax(
+        config.relax.to_dict(),
+        model_device != "cpu",
+        unrelaxed_protein,
+        cif_output,
+    )
+    os.environ["CUDA_VISIBLE_DEVICES"] = visible_devices
+
+    _write_relaxed_protein(
+        struct_str, relaxation_time, output_directory, output_name, cif_output,
+        tag if tag is not None else output_name,
+        timings_dir if timings_dir is not None else output_directory,
+    )
+
+
+class RelaxationPool:
+    """
+    Runs Amber relaxation in a pool of worker processes on the OpenMM CPU
+    platform, such that inference on the next target doesn't wait for it.
+
+    At most max_pending relaxations are in flight at once; submit blocks
+    until one of them finishes beyond that. Relaxed structures are written
+    by the submitting process, from submit, poll and close.
+    """
+    def __init__(self, config, num_workers, max_pending=None):
+        self.relax_config = config.relax.to_dict()
+        self.max_pending = (
+            max_pending if max_pending is not None else 2 * num_workers
+        )
+        # Forking a process that has initialized CUDA is unsafe
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self.pending = {}
+
+    def submit(self, unrelaxed_protein, output_directory, output_name, cif_output=False, tag=None, timings_dir=None):
+        """ tag and timings_dir are as in relax_protein """
+        while len(self.pending) >= self.max_pending:
+            wait(self.pending, return_when=FIRST_COMPLETED)
+            self.poll()
+
+        future = self.executor.submit(
+            _relax, self.relax_config, False, unrelaxed_protein, cif_output
+        )
+        self.pending[future] = (
+            output_directory, output_name, cif_output,
+            tag if tag is not None else output_name,
+            timings_dir if timings_dir is not None else output_directory,
+        )
+
+    def poll(self):
+        """ Writes the results of all finished relaxations """
+        done = [f for f in self.pending if f.done()]
+        for future in done:
+            write_args = self.pending.pop(future)
+            struct_str, relaxation_time = future.result()
+            _write_relaxed_protein(struct_str, relaxation_time, *write_args)
+
+    def close(self):
+        """ Waits for and writes all outstanding relaxations """
+        wait(self.pending)
+        self.poll()
+        self.executor.shutdown()
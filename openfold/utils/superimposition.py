@@ -11,39 +11,113 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from Bio.SVDSuperimposer import SVDSuperimposer
-import numpy as np
 import torch
 
 
-def _superimpose_np(reference, coords):
+def superimpose(reference, coords, mask):
     """
         Superimposes coordinates onto a reference by minimizing RMSD using SVD.
 
         Args:
             reference:
-                [N, 3] reference array
+                [*, N, 3] reference tensor
             coords:
-                [N, 3] array
+                [*, N, 3] tensor
+            mask:
+                [*, N] tensor
         Returns:
-            A tuple of [N, 3] superimposed coords and the final RMSD.
+            A tuple of [*, N, 3] superimposed coords, zeroed where masked,
+            and [*] final RMSDs.
     """
-    sup = SVDSuperimposer()
-    sup.set(reference, coords)
-    sup.run()
-    return sup.get_transformed(), sup.get_rms()
+    rotation, translation = kabsch(reference, coords, mask)
+    superimposed = (
+        coords.to(rotation.dtype) @ rotation + translation[..., None, :]
+    )
+    superimposed = superimposed * mask[..., None]
 
+    sq_dev = torch.sum(
+        (superimposed - reference * mask[..., None]) ** 2, dim=(-1, -2)
+    )
+    rmsd = torch.sqrt(sq_dev / torch.sum(mask, dim=-1))
 
-def _superimpose_single(reference, coords):
-	reference_np = reference.detach().to(torch.float).cpu().numpy()  
-	coords_np = coords.detach().to(torch.float).cpu().numpy()
-	superimposed, rmsd = _superimpose_np(reference_np, coords_np)
-	return coords.new_tensor(superimposed), coords.new_tensor(rmsd)
+    return superimposed.to(coords.dtype), rmsd.to(coords.dtype)
 
 
-def superimpose(reference, coords, mask):
+def kabsch(reference, coords, mask, eps=1e-8):
     """
-        Superimposes coordinates onto a reference by minimizing RMSD using SVD.
+        Computes the rigid transformation that superimposes coords onto a
+        reference by minimizing the RMSD of the unmasked points. Batched and
+        stays on the device.
+
+        Args:
+            reference:
+                [*, N, 3] reference tensor
+            coords:
+                [*, N, 3] tensor
+            mask:
+                [*, N] tensor
+        Returns:
+            A tuple of [*, 3, 3] rotations and [*, 3] translations, such that
+            coords @ rotation + translation[..., None, :] is superimposed
+            onto reference. Both are fp64.
+    """
+    rotation, translation = kabsch_multi_mask(
+        reference, coords, mask[..., None, :], eps=eps
+    )
+    return rotation[..., 0, :, :], translation[..., 0, :]
+
+
+def kabsch_multi_mask(reference, coords, masks, eps=1e-8):
+    """
+        Like kabsch, for several masks of the same points at once, e.g. the
+        seeds of a superposition search. The points aren't copied per mask,
+        so this is much cheaper than broadcasting them for kabsch.
+
+        Args:
+            reference:
+                [*, N, 3] reference tensor
+            coords:
+                [*, N, 3] tensor
+            masks:
+                [*, M, N] tensor
+        Returns:
+            A tuple of [*, M, 3, 3] rotations and [*, M, 3] translations
+    """
+    reference = reference.to(torch.float64)
+    coords = coords.to(torch.float64)
+    masks = masks.to(torch.float64)
+
+    # Sums over the points are matrix products with the masks
+    count = torch.sum(masks, dim=-1, keepdim=True) + eps
+    reference_center = (masks @ reference) / count
+    coords_center = (masks @ coords) / count
+
+    # [*, M, 3, 3]
+    outer = coords[..., :, None] * reference[..., None, :]
+    cov = masks @ outer.reshape(outer.shape[:-2] + (9,))
+    cov = cov.reshape(cov.shape[:-1] + (3, 3))
+    cov = cov - (
+        coords_center[..., :, None] * reference_center[..., None, :]
+    ) * count[..., None]
+    u, _, vh = torch.linalg.svd(cov)
+
+    # Correct for reflections
+    sign = torch.sign(torch.det(u) * torch.det(vh))
+    u = torch.cat([u[..., :2], u[..., 2:] * sign[..., None, None]], dim=-1)
+    rotation = u @ vh
+
+    translation = reference_center - (
+        coords_center[..., None, :] @ rotation
+    )[..., 0, :]
+
+    return rotation, translation
+
+
+def kabsch_rmsd(reference, coords, mask, eps=1e-8):
+    """
+        Computes the RMSD of coords to a reference after optimal
+        superposition, without computing the superposition itself. Unlike
+        superimpose, this is batched and stays on the device.
 
         Args:
             reference:
@@ -53,48 +127,36 @@ def superimpose(reference, coords, mask):
             mask:
                 [*, N] tensor
         Returns:
-            A tuple of [*, N, 3] superimposed coords and [*] final RMSDs.
+            [*] RMSDs
     """
-    def select_unmasked_coords(coords, mask):
-        return torch.masked_select(
-            coords,
-            (mask > 0.)[..., None],
-        ).reshape(-1, 3)
-
-    batch_dims = reference.shape[:-2]
-    flat_reference = reference.reshape((-1,) + reference.shape[-2:])
-    flat_coords = coords.reshape((-1,) + reference.shape[-2:])
-    flat_mask = mask.reshape((-1,) + mask.shape[-1:])
-    superimposed_list = []
-    rmsds = []
-    for r, c, m in zip(flat_reference, flat_coords, flat_mask):
-        r_unmasked_coords = select_unmasked_coords(r, m)
-        c_unmasked_coords = select_unmasked_coords(c, m)
-        superimposed, rmsd = _superimpose_single(
-            r_unmasked_coords, 
-            c_unmasked_coords
-        )
-
-        # This is very inelegant, but idk how else to invert the masking
-        # procedure.
-        count = 0
-        superimposed_full_size = torch.zeros_like(r)
-        for i, unmasked in enumerate(m):
-            if(unmasked):
-                superimposed_full_size[i] = superimposed[count]
-                count += 1
-
-        superimposed_list.append(superimposed_full_size)
-        rmsds.append(rmsd)
-
-    superimposed_stacked = torch.stack(superimposed_list, dim=0)
-    rmsds_stacked = torch.stack(rmsds, dim=0)
-
-    superimposed_reshaped = superimposed_stacked.reshape(
-        batch_dims + coords.shape[-2:]
+    # The 3x3 SVD is cheap, and numerically much better behaved in fp64
+    reference = reference.to(torch.float64)
+    coords = coords.to(torch.float64)
+    mask = mask.to(torch.float64)[..., None]
+
+    count = torch.sum(mask, dim=-2, keepdim=True)
+    reference = reference - (
+        torch.sum(reference * mask, dim=-2, keepdim=True) / (count + eps)
+    )
+    coords = coords - (
+        torch.sum(coords * mask, dim=-2, keepdim=True) / (count + eps)
     )
-    rmsds_reshaped = rmsds_stacked.reshape(
-        batch_dims
+    reference = reference * mask
+    coords = coords * mask
+
+    # [*, 3, 3]
+    cov = coords.transpose(-1, -2) @ reference
+    u, s, vh = torch.linalg.svd(cov)
+
+    # Correct for reflections
+    sign = torch.sign(torch.det(u) * torch.det(vh))
+    s = torch.cat([s[..., :2], s[..., 2:] * sign[..., None]], dim=-1)
+
+    sq_dev = (
+        torch.sum(reference ** 2, dim=(-1, -2)) +
+        torch.sum(coords ** 2, dim=(-1, -2)) -
+        2 * torch.sum(s, dim=-1)
     )
+    msd = torch.clamp(sq_dev, min=0) / (count[..., 0, 0] + eps)
 
-    return superimposed_reshaped, rmsds_reshaped
+    return torch.sqrt(msd).to(torch.float32)
@@ -12,7 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import contextlib
+import hashlib
+import json
+import logging
+import math
+import os
+import tempfile
 from functools import partialmethod
+from typing import Optional
 
 import numpy as np
 import torch
@@ -20,6 +27,18 @@ import torch
 from openfold.utils.tensor_utils import tensor_tree_map
 
 
+# Sequence lengths are rounded up to a multiple of this before tracing, such
+# that one set of traced modules serves every target in the bucket
+TRACING_INTERVAL = 50
+
+# Bump to invalidate existing trace caches
+TRACE_CACHE_VERSION = 1
+
+
+def round_up_seqlen(seqlen):
+    return int(math.ceil(seqlen / TRACING_INTERVAL)) * TRACING_INTERVAL
+
+
 def pad_feature_dict_seq(feature_dict, seqlen):
     """ Pads the sequence length of a feature dict. Used for tracing. """
     # The real sequence length can't be longer than the desired one
@@ -58,10 +77,169 @@ def pad_feature_dict_seq(feature_dict, seqlen):
     return new_feature_dict
 
 
-def trace_model_(model, sample_input):
+def model_fingerprint(model):
+    """
+        Hashes the config, parameters and dtypes of a model. Computed once
+        and stored on the model, since tracing replaces the submodules
+        whose parameters go into the hash.
+    """
+    fingerprint = getattr(model, "_trace_fingerprint", None)
+    if(fingerprint is not None):
+        return fingerprint
+
+    h = hashlib.sha1()
+    for config in [model.globals, model.config]:
+        h.update(
+            json.dumps(config.to_dict(), sort_keys=True, default=str).encode()
+        )
+    for name, param in sorted(model.state_dict().items()):
+        h.update(name.encode())
+        h.update(str(param.dtype).encode())
+        # numpy has no bfloat16
+        h.update(param.detach().float().cpu().contiguous().numpy().tobytes())
+
+    model._trace_fingerprint = h.hexdigest()
+    return model._trace_fingerprint
+
+
+def _trace_device_name(device):
+    if(device.type == "cuda"):
+        return torch.cuda.get_device_name(device)
+    return device.type
+
+
+class TraceCache:
+    """
+        On-disk cache of frozen TorchScript modules produced by 
+        trace_model_, shared across runs. Each set of traced modules lives
+        in its own subdirectory, named after the hash of everything that
+        was baked into the trace.
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def key(self, **kwargs) -> str:
+        kwargs["version"] = TRACE_CACHE_VERSION
+        kwargs["torch_version"] = torch.__version__
+        return hashlib.sha1(
+            json.dumps(kwargs, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def _path(self, key: str, name: str) -> str:
+        return os.path.join(self.cache_dir, key, f"{name}.pt")
+
+    def load(self, key: str, name: str, device) -> Optional[torch.nn.Module]:
+        path = self._path(key, name)
+        if(not os.path.exists(path)):
+            return None
+
+        try:
+            return torch.jit.load(path, map_location=device)
+        except RuntimeError:
+            logging.warning(f"Ignoring unreadable traced module at {path}")
+            return None
+
+    def save(self, key: str, name: str, traced_module: torch.nn.Module):
+        path = self._path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), suffix=".tmp"
+        )
+        os.close(fd)
+        torch.jit.save(traced_module, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def _get_submodule(module, path):
+    for attr in path.split("."):
+        module = getattr(module, attr)
+    return module
+
+
+def _set_submodule(module, path, value):
+    *parents, attr = path.split(".")
+    for p in parents:
+        module = getattr(module, p)
+    delattr(module, attr)
+    setattr(module, attr, value)
+
+
+def _untrace_model_(model, device):
+    """ 
+        Puts back the submodules replaced by a previous trace_model_ call
+        with keep_untraced=True
+    """
+    untraced = getattr(model, "_untraced_submodules", None)
+    if(untraced is None):
+        if(getattr(model, "_traced", False)):
+            raise ValueError(
+                "The model was traced with keep_untraced=False and can't be "
+                "traced again"
+            )
+        return
+
+    for path, submodule in untraced.items():
+        _set_submodule(model, path, submodule.to(device))
+
+    del model._untraced_submodules
+
+
+def trace_block(block, block_inputs):
+    # Yes, yes, I know
+    with contextlib.redirect_stderr(None):
+        traced_block = torch.jit.trace(block, block_inputs)
+    
+    traced_block = torch.jit.freeze(traced_block, optimize_numerics=True)
+    
+    # It would be nice to use this, but its runtimes are extremely
+    # unpredictable
+    # traced_block = torch.jit.optimize_for_inference(traced_block)
+
+    return traced_block
+
+
+def wrap_traced_block(traced_block):
+    # All trace inputs need to be tensors. This wrapper takes care of that
+    def traced_block_wrapper(*args, **kwargs): 
+        to_tensor = lambda t: torch.tensor(t) if type(t) != torch.Tensor else t
+        args = [to_tensor(a) for a in args]
+        kwargs = {k: to_tensor(v) for k,v in kwargs.items()} 
+        return traced_block(*args, **kwargs)
+    
+    return traced_block_wrapper
+
+
+def trace_model_(model, sample_input, cache_dir=None, keep_untraced=False):
+    """
+        Replaces the evoformer's attention and triangular update modules 
+        with frozen TorchScript traces specialized to the shape of 
+        sample_input. The original modules are freed, unless keep_untraced
+        is set.
+
+        Args:
+            model:
+                An AlphaFold model
+            sample_input:
+                A padded, processed feature dict with a recycling dimension
+            cache_dir:
+                Optional directory in which traced modules are persisted.
+                Modules traced with the same model config, weights, dtype,
+                input shapes, chunk sizes and device are loaded from it 
+                rather than traced again.
+            keep_untraced:
+                Whether to keep the original modules, on the CPU, such that 
+                the model may be traced again with a larger sample_input
+    """
+    # Compute the fingerprint while all of the parameters are still in place
+    fingerprint = model_fingerprint(model) if cache_dir is not None else None
+
     # Grab the inputs to the final recycling iteration
     feats = tensor_tree_map(lambda t: t[..., -1], sample_input)
 
+    # Tracing always starts from the original modules
+    _untrace_model_(model, feats["aatype"].device)
+    untraced = {}
+
     # Gather some metadata
     n = feats["aatype"].shape[-1]
     msa_depth = feats["true_msa"].shape[-2]
@@ -136,26 +314,6 @@ def trace_model_(model, sample_input):
                 model.template_pair_stack
             )
 
-    def trace_block(block, block_inputs):
-        # Yes, yes, I know
-        with contextlib.redirect_stderr(None):
-            traced_block = torch.jit.trace(block, block_inputs)
-        
-        traced_block = torch.jit.freeze(traced_block, optimize_numerics=True)
-        
-        # It would be nice to use this, but its runtimes are extremely
-        # unpredictable
-        # traced_block = torch.jit.optimize_for_inference(traced_block)
-        
-        # All trace inputs need to be tensors. This wrapper takes care of that
-        def traced_block_wrapper(*args, **kwargs): 
-            to_tensor = lambda t: torch.tensor(t) if type(t) != torch.Tensor else t
-            args = [to_tensor(a) for a in args]
-            kwargs = {k: to_tensor(v) for k,v in kwargs.items()} 
-            return traced_block(*args, **kwargs)
-        
-        return traced_block_wrapper
-
     def verify_arg_order(fn, arg_list):
         """ Because it's difficult to specify keyword arguments of Module 
             functions during tracing, we need to pass them as a tuple. As a 
@@ -174,6 +332,44 @@ def trace_model_(model, sample_input):
         model.globals.chunk_size, evoformer_chunk_size // 4
     )
 
+    cache = None
+    if(cache_dir is not None):
+        cache = TraceCache(cache_dir)
+        cache_key = cache.key(
+            model=fingerprint,
+            n=n,
+            msa_depth=msa_depth,
+            extra_msa_depth=extra_msa_depth,
+            no_templates=no_templates,
+            evoformer_chunk_size=evoformer_chunk_size,
+            evoformer_attn_chunk_size=evoformer_attn_chunk_size,
+            device=_trace_device_name(device),
+        )
+
+    no_loaded = 0
+    no_traced = 0
+    def trace_evoformer_submodule_(name, args):
+        nonlocal no_loaded, no_traced
+        with torch.no_grad():
+            for i in range(len(model.evoformer.blocks)):
+                path = f"evoformer.blocks.{i}.{name}"
+                submodule = _get_submodule(model, path)
+
+                traced_block = None
+                if(cache is not None):
+                    traced_block = cache.load(cache_key, path, device)
+                if(traced_block is None):
+                    traced_block = trace_block(submodule, args)
+                    if(cache is not None):
+                        cache.save(cache_key, path, traced_block)
+                else:
+                    no_loaded += 1
+
+                _set_submodule(model, path, wrap_traced_block(traced_block))
+                if(keep_untraced):
+                    untraced[path] = submodule.to("cpu")
+                no_traced += 1
+
     # MSA row attention
     msa_att_row_arg_tuples = [
         ("m", m),
@@ -189,13 +385,7 @@ def trace_model_(model, sample_input):
         msa_att_row_arg_tuples
     )
     msa_att_row_args = [arg for _, arg in msa_att_row_arg_tuples]
-    with torch.no_grad():
-        for b in model.evoformer.blocks:
-            traced_block = trace_block(
-                b.msa_att_row, msa_att_row_args
-            )
-            del b.msa_att_row
-            b.msa_att_row = traced_block
+    trace_evoformer_submodule_("msa_att_row", msa_att_row_args)
 
     # MSA col attention
     msa_att_col_arg_tuples = [
@@ -211,13 +401,7 @@ def trace_model_(model, sample_input):
         msa_att_col_arg_tuples
     )
     msa_att_col_args = [arg for _, arg in msa_att_col_arg_tuples]
-    with torch.no_grad():
-        for b in model.evoformer.blocks:
-            traced_block = trace_block(
-                b.msa_att_col, msa_att_col_args
-            )
-            del b.msa_att_col
-            b.msa_att_col = traced_block
+    trace_evoformer_submodule_("msa_att_col", msa_att_col_args)
     
     # OPM
     opm_arg_tuples = [
@@ -231,13 +415,7 @@ def trace_model_(model, sample_input):
         opm_arg_tuples
     )
     opm_args = [arg for _, arg in opm_arg_tuples]
-    with torch.no_grad():
-        for b in model.evoformer.blocks:
-            traced_block = trace_block(
-                b.core.outer_product_mean, opm_args
-            )
-            del b.core.outer_product_mean
-            b.core.outer_product_mean = traced_block
+    trace_evoformer_submodule_("core.outer_product_mean", opm_args)
 
     # Triangular multiplicative update (out)
     tri_mul_out_arg_tuples = [
@@ -251,13 +429,7 @@ def trace_model_(model, sample_input):
         tri_mul_out_arg_tuples
     )
     tri_mul_out_args = [arg for _, arg in tri_mul_out_arg_tuples]
-    with torch.no_grad():
-        for b in model.evoformer.blocks:
-            traced_block = trace_block(
-                b.core.tri_mul_out, tri_mul_out_args
-            )
-            del b.core.tri_mul_out
-            b.core.tri_mul_out = traced_block
+    trace_evoformer_submodule_("core.tri_mul_out", tri_mul_out_args)
 
     # Triangular multiplicative update (in)
     tri_mul_in_arg_tuples = [
@@ -271,13 +443,7 @@ def trace_model_(model, sample_input):
         tri_mul_in_arg_tuples
     )
     tri_mul_in_args = [arg for _, arg in tri_mul_in_arg_tuples]
-    with torch.no_grad():
-        for b in model.evoformer.blocks:
-            traced_block = trace_block(
-                b.core.tri_mul_in, tri_mul_in_args
-            )
-            del b.core.tri_mul_in
-            b.core.tri_mul_in = traced_block
+    trace_evoformer_submodule_("core.tri_mul_in", tri_mul_in_args)
 
     # Triangular attention (start)
     tri_att_start_arg_tuples = [
@@ -294,13 +460,7 @@ def trace_model_(model, sample_input):
         tri_att_start_arg_tuples
     )
     tri_att_start_args = [arg for _, arg in tri_att_start_arg_tuples]
-    with torch.no_grad():
-        for b in model.evoformer.blocks:
-            traced_block = trace_block(
-                b.core.tri_att_start, tri_att_start_args
-            )
-            del b.core.tri_att_start
-            b.core.tri_att_start = traced_block
+    trace_evoformer_submodule_("core.tri_att_start", tri_att_start_args)
 
     # Triangular attention (end)
     tri_att_end_arg_tuples = [
@@ -317,13 +477,7 @@ def trace_model_(model, sample_input):
         tri_att_end_arg_tuples
     )
     tri_att_end_args = [arg for _, arg in tri_att_end_arg_tuples]
-    with torch.no_grad():
-        for b in model.evoformer.blocks:
-            traced_block = trace_block(
-                b.core.tri_att_end, tri_att_end_args
-            )
-            del b.core.tri_att_end
-            b.core.tri_att_end = traced_block
+    trace_evoformer_submodule_("core.tri_att_end", tri_att_end_args)
 
     #evoformer_arg_tuples = [
     #    ("m", m),
@@ -416,6 +570,16 @@ def trace_model_(model, sample_input):
 #        del model.template_pair_stack.blocks
 #        model.template_pair_stack.blocks = traced_template_pair_stack
 
+    model._traced = True
+    if(keep_untraced):
+        model._untraced_submodules = untraced
+
+    if(cache is not None):
+        logging.info(
+            f"Loaded {no_loaded} of {no_traced} traced "
+            f"modules from {cache_dir}"
+        )
+
     # We need to do another dry run after tracing to allow the model to reach
     # top speeds. Why, I don't know.
     two_recycling_iter_input = tensor_tree_map(
@@ -11,8 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import math
+
 import torch
 
+from openfold.utils.loss import lddt
+from openfold.utils.superimposition import kabsch_multi_mask, kabsch_rmsd
+
 
 def drmsd(structure_1, structure_2, mask=None):
     def prep_d(structure):
@@ -29,8 +34,15 @@ def drmsd(structure_1, structure_2, mask=None):
     if(mask is not None):
         drmsd = drmsd * (mask[..., None] * mask[..., None, :])
     drmsd = torch.sum(drmsd, dim=(-1, -2))
-    n = d1.shape[-1] if mask is None else torch.min(torch.sum(mask, dim=-1))
-    drmsd = drmsd * (1 / (n * (n - 1))) if n > 1 else (drmsd * 0.)
+    if(mask is None):
+        n = d1.shape[-1]
+        drmsd = drmsd * (1 / (n * (n - 1))) if n > 1 else (drmsd * 0.)
+    else:
+        # Avoids synchronizing with the device on n
+        n = torch.min(torch.sum(mask, dim=-1))
+        drmsd = torch.where(
+            n > 1, drmsd / torch.clamp(n * (n - 1), min=1), drmsd * 0.
+        )
     drmsd = torch.sqrt(drmsd)
 
     return drmsd
@@ -67,3 +79,285 @@ def gdt_ts(p1, p2, mask):
 def gdt_ha(p1, p2, mask):
     return gdt(p1, p2, mask, [0.5, 1., 2., 4.])
 
+
+def tm_score_d0(length):
+    """ The TM-score distance scale for a structure of the given length """
+    length = torch.as_tensor(length, dtype=torch.float64)
+    d0 = 1.24 * torch.clamp(length - 15, min=1e-8) ** (1. / 3) - 1.8
+    return torch.where(length > 21, d0, torch.full_like(d0, 0.5))
+
+
+def _seed_masks(mask, no_seeds):
+    """
+        Masks of the fragments of the unmasked residues that seed the
+        superposition search: fragments of the whole, half, a quarter, ...
+        down to 4 residues, at no_seeds evenly spaced offsets.
+
+        Args:
+            mask:
+                [B, N] boolean mask
+        Returns:
+            [B, S, N] boolean seed masks
+    """
+    n = mask.shape[-1]
+    no_aligned = torch.sum(mask, dim=-1, keepdim=True).to(torch.float64)
+    rank = torch.cumsum(mask, dim=-1) - 1
+
+    no_levels = max(1, math.ceil(math.log2(max(n, 4) / 4)) + 1)
+    seeds = []
+    for level in range(no_levels):
+        frag_len = torch.clamp(
+            torch.floor(no_aligned / 2 ** level), min=min(4, n)
+        )
+        frag_len = torch.minimum(frag_len, no_aligned)
+        for i in range(no_seeds):
+            frac = i / max(no_seeds - 1, 1)
+            start = torch.round(frac * (no_aligned - frag_len))
+            seeds.append(mask * (rank >= start) * (rank < start + frag_len))
+            if level == 0:
+                break
+
+    return torch.stack(seeds, dim=-2)
+
+
+def _superposition_search(
+    p1, p2, mask, d_search, score_fn, no_seeds, no_iters, eps
+):
+    """
+        Searches for the superpositions of p1 onto p2 that maximize a score,
+        like the TM-score program: superpositions on fragments of the
+        structures are refined iteratively on the residues within a
+        distance cutoff. Several cutoffs, e.g. those of GDT, are searched
+        with separate superpositions.
+
+        Args:
+            p1:
+                [B, N, 3] fp64 coordinates
+            p2:
+                [B, N, 3] fp64 reference coordinates
+            mask:
+                [B, N] boolean mask
+            d_search:
+                [B, C] refinement cutoffs
+            score_fn:
+                Maps [B, C, S, N] distances to [B, C, S] scores
+        Returns:
+            [B, C] best scores
+    """
+    no_batch, n = mask.shape
+    no_cutoffs = d_search.shape[-1]
+
+    # Squared distances after superposition are computed from per-residue
+    # moments of the structures, so the superimposed coordinates of each
+    # seed are never materialized:
+    # |p1 R + t - p2|^2 = |p1|^2 + |p2 - t|^2 + 2 (p1 R) . (t - p2)
+    # [B, N, 9]
+    outer = (p1[..., :, None] * p2[..., None, :]).reshape(p1.shape[:-1] + (9,))
+    sq_norms = torch.sum(p1 ** 2, dim=-1) + torch.sum(p2 ** 2, dim=-1)
+
+    # [B, C * S, N]
+    cur_mask = _seed_masks(mask, no_seeds).repeat(1, no_cutoffs, 1)
+    # [B, C * S, 1]
+    d_search = d_search.repeat_interleave(
+        cur_mask.shape[-2] // no_cutoffs, dim=-1
+    )[..., None]
+    mask = mask[..., None, :]
+    k = torch.clamp(torch.sum(mask, dim=-1, keepdim=True), max=3)
+    best = torch.zeros(cur_mask.shape[:-1], dtype=p1.dtype, device=p1.device)
+    for _ in range(no_iters):
+        rotation, translation = kabsch_multi_mask(p2, p1, cur_mask, eps=eps)
+
+        # [B, C * S, N]
+        rotated_t = (rotation @ translation[..., :, None])[..., 0]
+        sq_d = (
+            sq_norms[..., None, :] -
+            2 * (outer @ rotation.flatten(-2).transpose(-1, -2)).transpose(-1, -2) -
+            2 * (p2 @ translation.transpose(-1, -2)).transpose(-1, -2) +
+            2 * (p1 @ rotated_t.transpose(-1, -2)).transpose(-1, -2) +
+            torch.sum(translation ** 2, dim=-1, keepdim=True)
+        )
+        d = torch.sqrt(torch.clamp(sq_d, min=0) + eps)
+
+        score = score_fn(d.reshape(no_batch, no_cutoffs, -1, n))
+        best = torch.maximum(best, score.reshape(best.shape))
+
+        # The next superposition is on the residues within the cutoff, or
+        # the closest three if there are fewer
+        d_masked = torch.where(mask, d, torch.full_like(d, float("inf")))
+        closest = torch.topk(
+            d_masked, min(3, n), dim=-1, largest=False
+        ).values
+        kth = torch.gather(
+            closest, -1, torch.clamp(k - 1, min=0).expand(d.shape[:-1] + (1,))
+        )
+        cur_mask = mask * (d <= torch.maximum(d_search, kth))
+
+    best = best.reshape(no_batch, no_cutoffs, -1)
+
+    return torch.max(best, dim=-1).values
+
+
+def _flatten_structures(p1, p2, mask):
+    n = p1.shape[-2]
+    p1 = p1.reshape(-1, n, 3).to(torch.float64)
+    p2 = p2.reshape(-1, n, 3).to(torch.float64)
+    mask = mask.reshape(-1, n) > 0
+    return p1, p2, mask
+
+
+def tm_score(p1, p2, mask, length=None, no_seeds=8, no_iters=20, eps=1e-8):
+    """
+        Computes the TM-score of p1 with respect to the reference p2,
+        searching for the superposition that maximizes it. All structures
+        and seeds of the search are processed at once.
+
+        Args:
+            p1:
+                [*, N, 3] coordinates, e.g. of CA atoms
+            p2:
+                [*, N, 3] reference coordinates
+            mask:
+                [*, N] mask of the residues present in both structures
+            length:
+                Length to normalize the score by, e.g. that of the
+                reference. Defaults to the number of unmasked residues
+            no_seeds:
+                Number of initial fragments per fragment length
+            no_iters:
+                Number of refinement iterations per initial fragment
+        Returns:
+            [*] TM-scores
+    """
+    batch_dims = p1.shape[:-2]
+    p1, p2, mask = _flatten_structures(p1, p2, mask)
+
+    if length is None:
+        length = torch.sum(mask, dim=-1)
+    length = torch.as_tensor(
+        length, dtype=torch.float64, device=p1.device
+    ).reshape(-1)
+    length = length.expand(p1.shape[0])
+
+    d0 = tm_score_d0(length)
+    d_search = torch.clamp(d0, min=4.5, max=8.)
+
+    def score_fn(d):
+        score = torch.sum(
+            mask[:, None, None] / (1 + (d / d0[:, None, None, None]) ** 2),
+            dim=-1,
+        )
+        return score / torch.clamp(length, min=1)[:, None, None]
+
+    score = _superposition_search(
+        p1, p2, mask, d_search[:, None], score_fn, no_seeds, no_iters, eps
+    )
+
+    return score[..., 0].to(torch.float32).reshape(batch_dims)
+
+
+def _gdt_cutoff_scores(p1, p2, mask, cutoffs, no_seeds, no_iters, eps):
+    """
+        Returns the [*, C] largest fractions of residues within each cutoff
+        under any superposition. See gdt_search
+    """
+    batch_dims = p1.shape[:-2]
+    p1, p2, mask = _flatten_structures(p1, p2, mask)
+
+    cutoffs = torch.tensor(cutoffs, dtype=p1.dtype, device=p1.device)
+    n = torch.clamp(torch.sum(mask, dim=-1), min=1)
+
+    def score_fn(d):
+        within = (d <= cutoffs[None, :, None, None]) * mask[:, None, None]
+        return torch.sum(within, dim=-1) / n[:, None, None]
+
+    score = _superposition_search(
+        p1,
+        p2,
+        mask,
+        cutoffs.expand(p1.shape[0], -1),
+        score_fn,
+        no_seeds,
+        no_iters,
+        eps,
+    )
+
+    return score.to(torch.float32).reshape(batch_dims + (-1,))
+
+
+def gdt_search(
+    p1, p2, mask, cutoffs=(1., 2., 4., 8.), no_seeds=8, no_iters=20, eps=1e-8
+):
+    """
+        Computes the GDT of p1 with respect to the reference p2, i.e. the
+        mean over the cutoffs of the largest fraction of residues within
+        the cutoff under any superposition. Unlike gdt, the structures
+        needn't be superimposed, and scores aren't averaged over the batch.
+
+        Args:
+            p1:
+                [*, N, 3] coordinates, e.g. of CA atoms
+            p2:
+                [*, N, 3] reference coordinates
+            mask:
+                [*, N] mask
+            cutoffs:
+                Distance cutoffs, e.g. [1, 2, 4, 8] for GDT-TS and
+                [0.5, 1, 2, 4] for GDT-HA
+        Returns:
+            [*] GDT scores
+    """
+    score = _gdt_cutoff_scores(
+        p1, p2, mask, cutoffs, no_seeds, no_iters, eps
+    )
+    return torch.mean(score, dim=-1)
+
+
+def compare_structures(
+    p1, p2, mask, length=None, no_seeds=8, no_iters=20, eps=1e-8
+):
+    """
+        Compares stacks of structures to references, e.g. the CA atoms of
+        predictions to those of the ground truth, in one call.
+
+        Args:
+            p1:
+                [*, N, 3] coordinates
+            p2:
+                [*, N, 3] reference coordinates
+            mask:
+                [*, N] mask of the residues present in both structures
+            length:
+                Length to normalize TM-scores by. See tm_score
+        Returns:
+            A dict of [*] "rmsd" after optimal superposition, "tm_score",
+            "gdt_ts" and "gdt_ha" scores, and "lddt" scores of p1 with
+            respect to p2
+    """
+    search_kwargs = {"no_seeds": no_seeds, "no_iters": no_iters, "eps": eps}
+
+    # GDT-TS and GDT-HA share three of their cutoffs, so the superpositions
+    # of all five are searched once
+    gdt_scores = _gdt_cutoff_scores(
+        p1, p2, mask, [0.5, 1., 2., 4., 8.], **search_kwargs
+    )
+
+    return {
+        "rmsd": kabsch_rmsd(p2, p1, mask),
+        "tm_score": tm_score(p1, p2, mask, length=length, **search_kwargs),
+        "gdt_ts": torch.mean(gdt_scores[..., 1:], dim=-1),
+        "gdt_ha": torch.mean(gdt_scores[..., :4], dim=-1),
+        "lddt": lddt(
+            p1.float(), p2.float(), mask[..., None].float(), per_residue=False
+        ),
+    }
+
+
+def compare_structures_np(p1, p2, mask, **kwargs):
+    """ compare_structures for NumPy arrays """
+    metrics = compare_structures(
+        torch.as_tensor(p1),
+        torch.as_tensor(p2),
+        torch.as_tensor(mask),
+        **kwargs,
+    )
+    return {k: v.cpu().numpy() for k, v in metrics.items()}
@@ -0,0 +1,349 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A SQLite-backed work queue, shared by workers on any number of nodes through
+a common filesystem. Workers lease items and keep their leases alive with
+heartbeats. Items whose lease expires, e.g. because their worker was
+preempted, become available again, and failed items are retried a bounded
+number of times. Finished items stay finished, so a campaign can be resumed
+by restarting its workers on the same queue.
+
+SQLite relies on POSIX locks, so the queue must live on a filesystem that
+supports them (most cluster filesystems do; some NFS setups don't).
+"""
+import contextlib
+import dataclasses
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Mapping, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    key TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    started REAL,
+    duration REAL,
+    timings TEXT,
+    error TEXT
+)
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class WorkItem:
+    key: str
+    payload: Any
+    attempt: int
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+class WorkQueue:
+    def __init__(self,
+        path: str,
+        lease_seconds: float = 600.,
+        max_attempts: int = 3,
+        timeout: float = 600.,
+    ):
+        """
+            Args:
+                path:
+                    Path of the SQLite database. Created if it doesn't exist
+                lease_seconds:
+                    Time after which the item of a worker that stopped
+                    sending heartbeats is handed to another worker
+                max_attempts:
+                    Number of times an item is attempted before it's marked
+                    as failed
+                timeout:
+                    Time to wait for other workers' transactions, in seconds
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+        with self._transaction() as conn:
+            conn.execute(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Connections can't be shared between threads, and opening one is
+        # cheap next to the work items
+        conn = sqlite3.connect(
+            self.path, timeout=self.timeout, isolation_level=None
+        )
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def add(
+        self,
+        items: Iterable[Tuple[str, Any]],
+        merge: Optional[Callable[[Any, Any, bool], Any]] = None,
+    ) -> int:
+        """
+            Adds (key, payload) pairs to the queue. Payloads must be
+            JSON-serializable. Returns the number of new items.
+
+            Keys the queue already holds are skipped, unless merge is given.
+            merge(old_payload, new_payload, done) then returns the item's
+            updated payload, or None to leave it as is. Finished items whose
+            payload is updated are queued again, and so are running ones
+            once they finish.
+        """
+        items = [(k, p) for k, p in items]
+        with self._transaction() as conn:
+            existing = {}
+            if merge is not None:
+                keys = [k for k, _ in items]
+                # Stays below SQLite's limit on query parameters
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    existing.update({
+                        key: (payload, status)
+                        for key, payload, status in conn.execute(
+                            "SELECT key, payload, status FROM items "
+                            f"WHERE key IN ({','.join('?' * len(chunk))})",
+                            chunk,
+                        )
+                    })
+
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO items (key, payload, status) "
+                "VALUES (?, ?, ?)",
+                [(k, json.dumps(p), PENDING) for k, p in items],
+            )
+            no_new = conn.total_changes - before
+
+            for k, p in items:
+                if k not in existing:
+                    continue
+                old_payload, status = existing[k]
+                payload = merge(json.loads(old_payload), p, status == DONE)
+                if payload is None:
+                    continue
+                payload = json.dumps(payload)
+                conn.execute(
+                    "UPDATE items SET payload = ?, "
+                    "status = CASE WHEN status = ? THEN ? ELSE status END, "
+                    "attempts = CASE WHEN status = ? THEN 0 ELSE attempts END "
+                    "WHERE key = ?",
+                    (payload, DONE, PENDING, DONE, k),
+                )
+                # Later duplicates of the key merge with the update
+                existing[k] = (
+                    payload, PENDING if status == DONE else status
+                )
+
+            return no_new
+
+    def claim(self, worker: str) -> Optional[WorkItem]:
+        """
+            Leases the next available item to a worker. Returns None once
+            no item is available.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            # Items whose last attempt lost its lease
+            conn.execute(
+                "UPDATE items SET status = ?, error = ? "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, "Lease expired", RUNNING, now, self.max_attempts),
+            )
+
+            row = conn.execute(
+                "SELECT key, payload, attempts FROM items "
+                "WHERE status = ? OR (status = ? AND lease_expires < ?) "
+                "ORDER BY attempts, rowid LIMIT 1",
+                (PENDING, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                return None
+
+            key, payload, attempts = row
+            conn.execute(
+                "UPDATE items SET status = ?, attempts = ?, worker = ?, "
+                "lease_expires = ?, started = ? WHERE key = ?",
+                (
+                    RUNNING, attempts + 1, worker,
+                    now + self.lease_seconds, now, key,
+                ),
+            )
+
+        return WorkItem(
+            key=key, payload=json.loads(payload), attempt=attempts + 1,
+        )
+
+    def heartbeat(self, key: str, worker: str) -> bool:
+        """
+            Extends a worker's lease. Returns False if the worker no longer
+            holds it.
+        """
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE items SET lease_expires = ? "
+                "WHERE key = ? AND worker = ? AND status = ?",
+                (time.time() + self.lease_seconds, key, worker, RUNNING),
+            )
+            return cur.rowcount > 0
+
+    def complete(self,
+        key: str,
+        worker: str,
+        timings: Optional[Mapping[str, float]] = None,
+        payload: Any = None,
+    ):
+        """
+            Marks an item as done. If the payload the worker processed is
+            given and the item's payload was updated in the meantime, the
+            item is queued again instead.
+        """
+        status = DONE
+        with self._transaction() as conn:
+            if payload is not None:
+                row = conn.execute(
+                    "SELECT payload FROM items WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[0] != json.dumps(payload):
+                    status = PENDING
+
+            conn.execute(
+                "UPDATE items SET status = ?, lease_expires = NULL, "
+                "duration = ? - started, timings = ?, error = NULL, "
+                "attempts = CASE WHEN ? = ? THEN 0 ELSE attempts END "
+                "WHERE key = ? AND worker = ?",
+                (
+                    status, time.time(), json.dumps(timings),
+                    status, PENDING, key, worker,
+                ),
+            )
+
+    def fail(self, key: str, worker: str, error: str):
+        """ Returns the item to the queue, unless it's out of attempts """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE items SET "
+                "status = CASE WHEN attempts < ? THEN ? ELSE ? END, "
+                "lease_expires = NULL, duration = ? - started, error = ? "
+                "WHERE key = ? AND worker = ?",
+                (
+                    self.max_attempts, PENDING, FAILED,
+                    time.time(), error, key, worker,
+                ),
+            )
+
+    def reset_failed(self) -> int:
+        """ Makes failed items available again. Returns their number """
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE items SET status = ?, attempts = 0 WHERE status = ?",
+                (PENDING, FAILED),
+            )
+            return cur.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) FROM items GROUP BY status"
+            ).fetchall()
+
+        counts = {s: 0 for s in [PENDING, RUNNING, DONE, FAILED]}
+        counts.update(dict(rows))
+        return counts
+
+    @contextlib.contextmanager
+    def lease(self, key: str, worker: str):
+        """
+            Sends heartbeats for an item from a background thread while the
+            context is active.
+        """
+        stop = threading.Event()
+
+        def send_heartbeats():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    if not self.heartbeat(key, worker):
+                        logger.warning(f"Lost the lease on {key}")
+                        return
+                except sqlite3.Error as e:
+                    logger.warning(f"Heartbeat for {key} failed: {e}")
+
+        thread = threading.Thread(target=send_heartbeats, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def work(self, fn, worker: Optional[str] = None) -> int:
+        """
+            Processes items until the queue runs dry. fn receives an item's
+            payload and may return a dict of timings to record.
+
+            Returns:
+                The number of items processed successfully
+        """
+        if worker is None:
+            worker = default_worker_id()
+
+        processed = 0
+        while True:
+            item = self.claim(worker)
+            if item is None:
+                return processed
+
+            try:
+                with self.lease(item.key, worker):
+                    timings = fn(item.payload)
+            except Exception as e:
+                logger.warning(
+                    f"Attempt {item.attempt} at {item.key} failed: {e}"
+                )
+                self.fail(item.key, worker, repr(e))
+                continue
+
+            self.complete(item.key, worker, timings, payload=item.payload)
+            processed += 1
@@ -13,8 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import contextlib
 import logging
-import math
 import numpy as np
 import os
 import pickle
@@ -44,14 +44,47 @@ if (
 torch.set_grad_enabled(False)
 
 from openfold.config import model_config
-from openfold.data import templates, feature_pipeline, data_pipeline
+from openfold.data import templates, feature_pipeline, data_pipeline, input_pipeline
+from openfold.data.alignment_store import resolve_alignment_dir
+from openfold.data.embedding_store import EmbeddingStore
 from openfold.data.tools import hhsearch, hmmsearch
 from openfold.np import protein
+from openfold.utils.cpu_utils import (
+    compile_evoformer_blocks_,
+    configure_cpu_threads,
+    cpu_supports_bf16,
+    keep_fp32_,
+    parse_core_list,
+)
+from openfold.utils.batch_utils import (
+    bucket_targets,
+    pad_features_num_res,
+    stack_features,
+    unbatch_outputs,
+)
+from openfold.utils.memory_planner import (
+    GB,
+    MemoryPlanner,
+    apply_plan,
+    autocast_dtype,
+    available_memory,
+    feature_dims,
+    load_calibration,
+    save_calibration,
+)
+from openfold.utils.profiler import (
+    Profiler,
+    get_profiler,
+    profile_stage,
+    set_profiler,
+)
 from openfold.utils.script_utils import (load_models_from_command_line, parse_fasta, run_model,
-                                         prep_output, relax_protein)
+                                         prep_output, relax_protein, update_timings,
+                                         save_recycling_metrics, RelaxationPool)
 from openfold.utils.tensor_utils import tensor_tree_map
 from openfold.utils.trace_utils import (
     pad_feature_dict_seq,
+    round_up_seqlen,
     trace_model_,
 )
 
@@ -64,7 +97,6 @@ from openfold.doctor.structure_exporter import PDBExporter
 from openfold.doctor.sequence_coverage_plotter import SequenceCoveragePlotter
 from openfold.doctor.attention_exporter import AttnExporter
 from openfold.doctor.sequence_exporter import MSAExporter
-TRACING_INTERVAL = 50
 
 
 def precompute_alignments(tags, seqs, alignment_dir, args):
@@ -99,9 +131,19 @@ def precompute_alignments(tags, seqs, alignment_dir, args):
                     uniref90_database_path=args.uniref90_database_path,
                     template_searcher=template_searcher,
                     no_cpus=args.cpus,
+                    max_concurrent_searches=args.max_concurrent_searches,
                 )
-                embedding_generator = EmbeddingGenerator()
-                embedding_generator.run(tmp_fasta_path, alignment_dir)
+                if args.embedding_store is not None:
+                    embedding_store = EmbeddingStore(args.embedding_store)
+                    if seq not in embedding_store:
+                        embedding_generator = EmbeddingGenerator()
+                        embedding_generator.run(
+                            tmp_fasta_path, alignment_dir,
+                            store=embedding_store,
+                        )
+                else:
+                    embedding_generator = EmbeddingGenerator()
+                    embedding_generator.run(tmp_fasta_path, alignment_dir)
             else:
                 alignment_runner = data_pipeline.AlignmentRunner(
                     jackhmmer_binary_path=args.jackhmmer_binary_path,
@@ -114,12 +156,17 @@ def precompute_alignments(tags, seqs, alignment_dir, args):
                     uniprot_database_path=args.uniprot_database_path,
                     template_searcher=template_searcher,
                     use_small_bfd=args.bfd_database_path is None,
-                    no_cpus=args.cpus
+                    no_cpus=args.cpus,
+                    max_concurrent_searches=args.max_concurrent_searches,
                 )
 
-            alignment_runner.run(
+            alignment_timings = alignment_runner.run(
                 tmp_fasta_path, local_alignment_dir
             )
+            update_timings(
+                {tag: {"alignments": alignment_timings}},
+                os.path.join(args.output_dir, "timings.json"),
+            )
         else:
             logger.info(
                 f"Using precomputed alignments for {tag} at {alignment_dir}..."
@@ -129,10 +176,6 @@ def precompute_alignments(tags, seqs, alignment_dir, args):
         os.remove(tmp_fasta_path)
 
 
-def round_up_seqlen(seqlen):
-    return int(math.ceil(seqlen / TRACING_INTERVAL)) * TRACING_INTERVAL
-
-
 def generate_feature_dict(
     tags,
     seqs,
@@ -156,7 +199,7 @@ def generate_feature_dict(
         with open(tmp_fasta_path, "w") as fp:
             fp.write(f">{tag}\n{seq}")
 
-        local_alignment_dir = os.path.join(alignment_dir, tag)
+        local_alignment_dir = resolve_alignment_dir(alignment_dir, tag)
         feature_dict = data_processor.process_fasta(
             fasta_path=tmp_fasta_path,
             alignment_dir=local_alignment_dir,
@@ -177,6 +220,260 @@ def generate_feature_dict(
     return feature_dict
 
 
+def to_numpy(t):
+    # NumPy has no bfloat16, which outputs may be in under CPU autocast
+    if t.dtype == torch.bfloat16:
+        t = t.float()
+    return np.array(t.cpu())
+
+
+def cpu_precision_context(args):
+    if args.cpu_inference and args.cpu_bf16 == "on":
+        return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def write_prediction(
+    out,
+    processed_feature_dict,
+    feature_dict,
+    feature_processor,
+    config,
+    args,
+    output_directory,
+    output_name,
+    tag,
+    relax_pool=None,
+):
+    """
+    Writes the unrelaxed and (possibly in the background) relaxed structures
+    of a prediction, and optionally its outputs. out and 
+    processed_feature_dict hold NumPy arrays without recycling dimensions.
+    """
+    unrelaxed_protein = prep_output(
+        out,
+        processed_feature_dict,
+        feature_dict,
+        feature_processor,
+        args.config_preset,
+        args.multimer_ri_gap,
+        args.subtract_plddt
+    )
+
+    unrelaxed_file_suffix = "_unrelaxed.pdb"
+    if args.cif_output:
+        unrelaxed_file_suffix = "_unrelaxed.cif"
+    unrelaxed_output_path = os.path.join(
+        output_directory, f'{output_name}{unrelaxed_file_suffix}'
+    )
+
+    with open(unrelaxed_output_path, 'w') as fp:
+        if args.cif_output:
+            fp.write(protein.to_modelcif(unrelaxed_protein))
+        else:
+            fp.write(protein.to_pdb(unrelaxed_protein))
+
+    logger.info(f"Output written to {unrelaxed_output_path}...")
+
+    if not args.skip_relaxation:
+        # Relax the prediction.
+        logger.info(f"Running relaxation on {unrelaxed_output_path}...")
+        if relax_pool is not None:
+            relax_pool.submit(unrelaxed_protein, output_directory, output_name,
+                              args.cif_output, tag, args.output_dir)
+        else:
+            with profile_stage("relaxation"):
+                relax_protein(config, args.model_device, unrelaxed_protein, output_directory, output_name,
+                              args.cif_output, tag, args.output_dir)
+
+    if "recycling_metrics" in out:
+        recycling_metrics_path = save_recycling_metrics(
+            out["recycling_metrics"],
+            os.path.join(
+                output_directory, f'{output_name}_recycling_metrics.json'
+            ),
+        )
+        logger.info(
+            f"Ran {int(out['num_recycles'])} recycling iterations, metrics "
+            f"written to {recycling_metrics_path}..."
+        )
+
+    if args.save_outputs:
+        output_dict_path = os.path.join(
+            output_directory, f'{output_name}_output_dict.pkl'
+        )
+        with open(output_dict_path, "wb") as fp:
+            pickle.dump(out, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+        logger.info(f"Model output written to {output_dict_path}...")
+
+
+def run_batched_inference(
+    model,
+    output_directory,
+    sorted_targets,
+    feature_dicts,
+    alignment_dir,
+    data_processor,
+    feature_processor,
+    config,
+    args,
+    is_multimer,
+    seq_coverage_plotter=None,
+    relax_pool=None,
+):
+    """
+    Runs inference on up to args.batch_size targets per forward pass.
+    Targets whose residue counts round up to the same value are padded to
+    that value and stacked along a batch dimension. Doctor exports are
+    written per target, to a subdirectory named after its output name.
+    """
+    export_structures = (
+        args.intermediate_structures_export or args.protein_movie
+    )
+    export_representations = (
+        args.representation_export or args.representation_movies
+    )
+
+    profiler = get_profiler()
+
+    # Generate all feature dicts first, since they're needed for bucketing
+    output_names = []
+    for (tag, tags), seqs in sorted_targets:
+        output_name = f'{tag}_{args.config_preset}'
+        if args.output_postfix is not None:
+            output_name = f'{output_name}_{args.output_postfix}'
+        output_names.append(output_name)
+
+        if profiler is not None:
+            profiler.set_target(tag)
+
+        # Does nothing if the alignments have already been computed
+        with profile_stage("alignment"):
+            precompute_alignments(tags, seqs, alignment_dir, args)
+
+        if tag not in feature_dicts:
+            with profile_stage("data_pipeline"):
+                feature_dicts[tag] = generate_feature_dict(
+                    tags,
+                    seqs,
+                    alignment_dir,
+                    data_processor,
+                    args,
+                )
+
+        if seq_coverage_plotter:
+            seq_coverage_plotter._plot_msa_v2(tag, feature_dicts[tag])
+
+    target_tags = [tag for (tag, _), _ in sorted_targets]
+    lengths = [feature_dicts[tag]["aatype"].shape[0] for tag in target_tags]
+
+    batches = bucket_targets(lengths, args.batch_size, round_up_seqlen)
+    for batch_idx in batches:
+        num_res = round_up_seqlen(lengths[batch_idx[0]])
+
+        batch_tags = [target_tags[i] for i in batch_idx]
+        if profiler is not None:
+            profiler.set_target("+".join(batch_tags))
+            profiler.attach(model)
+
+        target_feats = []
+        for i in batch_idx:
+            with profile_stage("feature_transforms"):
+                processed_feature_dict = feature_processor.process_features(
+                    feature_dicts[target_tags[i]], mode='predict',
+                    is_multimer=is_multimer,
+                )
+            processed_feature_dict = {
+                k: torch.as_tensor(v)
+                for k, v in processed_feature_dict.items()
+            }
+            target_feats.append(processed_feature_dict)
+
+        batch = stack_features([
+            pad_features_num_res(f, num_res, config.data.common.feat)
+            for f in target_feats
+        ])
+        batch = tensor_tree_map(lambda t: t.to(args.model_device), batch)
+
+        # The exporters' hooks crop each target out of the batch
+        exporters = []
+        for j, i in enumerate(batch_idx):
+            target_dir = lambda name: os.path.join(
+                output_directory, name, output_names[i]
+            )
+            target_exporters = {}
+            if export_structures:
+                target_exporters["structures"] = PDBExporter(
+                    model, feature_dicts[target_tags[i]], feature_processor,
+                    args, output_dir=target_dir("intermediate_structures"),
+                    batch_index=j, num_res=lengths[i],
+                )
+            if export_representations:
+                target_exporters["representations"] = RepresentationExporter(
+                    model, output_dir=target_dir("heatmaps"),
+                    batch_index=j, num_res=lengths[i],
+                )
+            if args.attention_export:
+                target_exporters["attention"] = AttnExporter(
+                    model, args, target_dir("attn"),
+                    batch_index=j, num_res=lengths[i],
+                )
+            if args.msa_fasta_export:
+                target_exporters["msa"] = MSAExporter(
+                    model, args, target_dir("msa_fasta"),
+                    batch_index=j, num_res=lengths[i],
+                )
+            exporters.append(target_exporters)
+
+        with cpu_precision_context(args), profile_stage("inference"):
+            out = run_model(model, batch, batch_tags, args.output_dir)
+
+        for target_exporters in exporters:
+            for exporter in target_exporters.values():
+                exporter.remove()
+
+        for j, i in enumerate(batch_idx):
+            target_out = unbatch_outputs(
+                out, j, lengths[i], model.config.heads.tm
+            )
+            str_exporter = exporters[j].get("structures")
+            if str_exporter is not None and "recycling_metrics" in target_out:
+                str_exporter.save_recycling_metrics(
+                    target_out["recycling_metrics"]
+                )
+            target_out = tensor_tree_map(
+                to_numpy, target_out
+            )
+
+            # Toss out the recycling dimensions
+            processed_feature_dict = tensor_tree_map(
+                lambda x: np.array(x[..., -1]), target_feats[j]
+            )
+
+            write_prediction(
+                target_out,
+                processed_feature_dict,
+                feature_dicts[target_tags[i]],
+                feature_processor,
+                config,
+                args,
+                output_directory,
+                output_names[i],
+                target_tags[i],
+                relax_pool,
+            )
+
+            if args.protein_movie:
+                exporters[j]["structures"].make_movie()
+
+            if args.representation_movies:
+                exporters[j]["representations"].pngs_to_mpg()
+
+        if relax_pool is not None:
+            relax_pool.poll()
+
+
 def list_files_with_extensions(dir, extensions):
     return [f for f in os.listdir(dir) if f.endswith(extensions)]
 
@@ -189,10 +486,40 @@ def main(args):
         args.use_single_seq_mode = True
 
 
+    if args.cpu_inference:
+        if torch.device(args.model_device).type != "cpu":
+            raise ValueError("--cpu_inference requires --model_device cpu")
+        if args.cpu_compile and args.trace_model:
+            raise ValueError(
+                "--cpu_compile and --trace_model are mutually exclusive"
+            )
+        if args.plan_memory:
+            # Memory plans set the chunk size, attention kernel and
+            # offloading, overriding the CPU settings
+            raise ValueError(
+                "--cpu_inference and --plan_memory are mutually exclusive"
+            )
+
+        cores = None
+        if args.cpu_cores is not None:
+            cores = parse_core_list(args.cpu_cores)
+        threads = configure_cpu_threads(
+            args.cpu_threads, args.cpu_interop_threads, cores
+        )
+
+        if args.cpu_bf16 == "auto":
+            args.cpu_bf16 = "on" if cpu_supports_bf16() else "off"
+
+        logger.info(
+            f"CPU inference with {threads} threads, bfloat16 autocast "
+            f"{args.cpu_bf16}"
+        )
+
     config = model_config(
         args.config_preset,
         long_sequence_inference=args.long_sequence_inference,
         use_deepspeed_evoformer_attention=args.use_deepspeed_evoformer_attention,
+        cpu_inference=args.cpu_inference,
         )
 
     if args.experiment_config_json: 
@@ -205,11 +532,57 @@ def main(args):
             custom_config_dict = json.load(f)
         config.update_from_flattened_dict(custom_config_dict)
 
+    if args.lazy_recycling:
+        config.data.predict.lazy_recycling = True
+
+    if args.record_recycling_metrics:
+        config.model.recycle_early_stop.record_metrics = True
+
+    if args.chunk_size_cache is not None:
+        config.globals.chunk_size_cache_path = args.chunk_size_cache
+
+    if args.relax_if_needed:
+        config.relax.relax_if_needed = True
+
+    if args.local_relax_radius is not None:
+        config.relax.local_radius = args.local_relax_radius
+
     if args.trace_model:
         if not config.data.predict.fixed_size:
             raise ValueError(
                 "Tracing requires that fixed_size mode be enabled in the config"
             )
+        if config.data.predict.lazy_recycling:
+            raise ValueError(
+                "Tracing is not supported with lazy_recycling"
+            )
+
+    if args.batch_size > 1:
+        if not config.data.predict.fixed_size:
+            raise ValueError(
+                "Batched inference requires that fixed_size mode be enabled "
+                "in the config"
+            )
+        unsupported = {
+            "--trace_model": args.trace_model,
+            "--lazy_recycling": config.data.predict.lazy_recycling,
+            "--plan_memory": args.plan_memory,
+        }
+        for flag, enabled in unsupported.items():
+            if enabled:
+                raise ValueError(
+                    f"{flag} is not supported with --batch_size > 1"
+                )
+
+    if (
+        args.profile is not None and
+        args.plan_memory and
+        args.memory_planner_calibration is not None
+    ):
+        raise ValueError(
+            "--profile resets the CUDA peak memory statistics that "
+            "--memory_planner_calibration relies on"
+        )
 
     is_multimer = "multimer" in args.config_preset
 
@@ -232,8 +605,14 @@ def main(args):
             obsolete_pdbs_path=args.obsolete_pdbs_path
         )
 
+    embedding_store = None
+    if args.embedding_store is not None:
+        embedding_store = EmbeddingStore(args.embedding_store)
+
     data_processor = data_pipeline.DataPipeline(
         template_featurizer=template_featurizer,
+        msa_parsing_workers=args.msa_parsing_workers,
+        embedding_store=embedding_store,
     )
 
     if is_multimer:
@@ -284,6 +663,23 @@ def main(args):
         tag_list.append((tag, tags))
         seq_list.append(seqs)
 
+    memory_planner = None
+    if args.plan_memory:
+        doctor_exports = []
+        if args.attention_export:
+            doctor_exports.append("attention")
+        if args.intermediate_structures_export or args.protein_movie:
+            doctor_exports.append("structures")
+        if args.representation_export or args.representation_movies:
+            doctor_exports.append("representations")
+        memory_planner = MemoryPlanner(
+            config,
+            device=args.model_device,
+            calibration=load_calibration(args.memory_planner_calibration),
+            allow_low_precision=args.memory_planner_allow_bf16,
+            doctor_exports=doctor_exports,
+        )
+
     seq_sort_fn = lambda target: sum([len(s) for s in target[1]])
     sorted_targets = sorted(zip(tag_list, seq_list), key=seq_sort_fn)
     feature_dicts = {}
@@ -294,25 +690,69 @@ def main(args):
         args.jax_param_path,
         args.output_dir)
 
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler(args.model_device)
+        set_profiler(profiler)
+
+    relax_pool = None
+    if args.relax_workers > 0 and not args.skip_relaxation:
+        relax_pool = RelaxationPool(config, args.relax_workers)
+
     for model, output_directory in model_generator:
+        if args.cpu_inference:
+            if args.cpu_bf16 == "on":
+                keep_fp32_(model)
+            if args.cpu_compile:
+                compile_evoformer_blocks_(model)
+
+        if args.batch_size > 1:
+            run_batched_inference(
+                model,
+                output_directory,
+                sorted_targets,
+                feature_dicts,
+                alignment_dir,
+                data_processor,
+                feature_processor,
+                config,
+                args,
+                is_multimer,
+                seq_coverage_plotter=seq_coverage_plotter,
+                relax_pool=relax_pool,
+            )
+            continue
+
         cur_tracing_interval = 0
+        if args.trace_model:
+            max_tracing_interval = round_up_seqlen(
+                max(
+                    (seq_sort_fn(target) for target in sorted_targets),
+                    default=0,
+                )
+            )
         for (tag, tags), seqs in sorted_targets:
             output_name = f'{tag}_{args.config_preset}'
             if args.output_postfix is not None:
                 output_name = f'{output_name}_{args.output_postfix}'
 
+            if profiler is not None:
+                profiler.set_target(tag)
+
             # Does nothing if the alignments have already been computed
-            precompute_alignments(tags, seqs, alignment_dir, args)
+            with profile_stage("alignment"):
+                precompute_alignments(tags, seqs, alignment_dir, args)
 
             feature_dict = feature_dicts.get(tag, None)
             if feature_dict is None:
-                feature_dict = generate_feature_dict(
-                    tags,
-                    seqs,
-                    alignment_dir,
-                    data_processor,
-                    args,
-                )
+                with profile_stage("data_pipeline"):
+                    feature_dict = generate_feature_dict(
+                        tags,
+                        seqs,
+                        alignment_dir,
+                        data_processor,
+                        args,
+                    )
 
                 if args.trace_model:
                     n = feature_dict["aatype"].shape[-2]
@@ -326,14 +766,23 @@ def main(args):
             if seq_coverage_plotter:
                 seq_coverage_plotter._plot_msa_v2(tag, feature_dict)
 
-            processed_feature_dict = feature_processor.process_features(
-                feature_dict, mode='predict', is_multimer=is_multimer
-            )
+            with profile_stage("feature_transforms"):
+                processed_feature_dict = feature_processor.process_features(
+                    feature_dict, mode='predict', is_multimer=is_multimer
+                )
 
-            processed_feature_dict = {
-                k: torch.as_tensor(v, device=args.model_device)
-                for k, v in processed_feature_dict.items()
-            }
+            is_lazy_batch = isinstance(
+                processed_feature_dict, input_pipeline.LazyRecyclingBatch
+            )
+            if is_lazy_batch:
+                processed_feature_dict = processed_feature_dict.to(
+                    args.model_device
+                )
+            else:
+                processed_feature_dict = {
+                    k: torch.as_tensor(v, device=args.model_device)
+                    for k, v in processed_feature_dict.items()
+                }
 
             if args.protein_movie and not args.intermediate_structures_export:
                 args.intermediate_structures_export = True
@@ -359,7 +808,15 @@ def main(args):
                         f"Tracing model at {rounded_seqlen} residues..."
                     )
                     t = time.perf_counter()
-                    trace_model_(model, processed_feature_dict)
+                    # The original modules are only kept around if a
+                    # larger target will need them to be traced again
+                    trace_model_(
+                        model, processed_feature_dict,
+                        cache_dir=args.trace_cache_dir,
+                        keep_untraced=(
+                            rounded_seqlen < max_tracing_interval
+                        ),
+                    )
                     tracing_time = time.perf_counter() - t
                     logger.info(
                         f"Tracing time: {tracing_time}"
@@ -380,55 +837,97 @@ def main(args):
             if args.msa_fasta_export:
                 msa_fasta_exporter = MSAExporter(model, args, os.path.join(output_directory, "msa_fasta"))
 
-            logger.debug(f"max recycling iters: {args.max_recycling_iters}")
-            out = run_model(model, processed_feature_dict, tag, args.output_dir)
+            precision_ctx = cpu_precision_context(args)
+            if memory_planner is not None:
+                if is_lazy_batch:
+                    first_feats = processed_feature_dict.get_cycle(0)
+                else:
+                    first_feats = tensor_tree_map(
+                        lambda t: t[..., 0], processed_feature_dict
+                    )
 
-            # Toss out the recycling dimensions --- we don't need them anymore
-            processed_feature_dict = tensor_tree_map(
-                lambda x: np.array(x[..., -1].cpu()),
-                processed_feature_dict
-            )
-            out = tensor_tree_map(lambda x: np.array(x.cpu()), out)
+                if args.memory_budget_gb is not None:
+                    memory_budget = int(args.memory_budget_gb * GB)
+                else:
+                    memory_budget = available_memory(args.model_device)
 
-            unrelaxed_protein = prep_output(
-                out,
-                processed_feature_dict,
-                feature_dict,
-                feature_processor,
-                args.config_preset,
-                args.multimer_ri_gap,
-                args.subtract_plddt
-            )
+                memory_plan = memory_planner.plan(
+                    feature_dims(first_feats), memory_budget
+                )
+                apply_plan(config, memory_plan)
+                logger.info(
+                    f"Memory plan for {tag}: chunk_size="
+                    f"{memory_plan.chunk_size}, attention="
+                    f"{memory_plan.attention}, offload_inference="
+                    f"{memory_plan.offload_inference}, precision="
+                    f"{memory_plan.precision} (predicted peak "
+                    f"{memory_plan.peak_bytes / GB:.2f} GB)"
+                )
+                update_timings(
+                    {tag: memory_plan.to_dict()},
+                    os.path.join(args.output_dir, "memory_plan.json"),
+                )
 
-            unrelaxed_file_suffix = "_unrelaxed.pdb"
-            if args.cif_output:
-                unrelaxed_file_suffix = "_unrelaxed.cif"
-            unrelaxed_output_path = os.path.join(
-                output_directory, f'{output_name}{unrelaxed_file_suffix}'
-            )
+                dtype = autocast_dtype(memory_plan)
+                if dtype is not None:
+                    precision_ctx = torch.autocast(
+                        device_type=torch.device(args.model_device).type,
+                        dtype=dtype,
+                    )
 
-            with open(unrelaxed_output_path, 'w') as fp:
-                if args.cif_output:
-                    fp.write(protein.to_modelcif(unrelaxed_protein))
-                else:
-                    fp.write(protein.to_pdb(unrelaxed_protein))
+                if "cuda" in args.model_device:
+                    torch.cuda.reset_peak_memory_stats(args.model_device)
 
-            logger.info(f"Output written to {unrelaxed_output_path}...")
+            if profiler is not None:
+                # Tracing may have replaced the hooked submodules
+                profiler.attach(model)
 
-            if not args.skip_relaxation:
-                # Relax the prediction.
-                logger.info(f"Running relaxation on {unrelaxed_output_path}...")
-                relax_protein(config, args.model_device, unrelaxed_protein, output_directory, output_name,
-                              args.cif_output)
+            logger.debug(f"max recycling iters: {args.max_recycling_iters}")
+            with precision_ctx, profile_stage("inference"):
+                out = run_model(model, processed_feature_dict, tag, args.output_dir)
+
+            if (
+                memory_planner is not None and
+                args.memory_planner_calibration is not None and
+                "cuda" in args.model_device
+            ):
+                calibration = memory_planner.calibrate(
+                    memory_plan,
+                    torch.cuda.max_memory_allocated(args.model_device),
+                )
+                save_calibration(calibration, args.memory_planner_calibration)
 
-            if args.save_outputs:
-                output_dict_path = os.path.join(
-                    output_directory, f'{output_name}_output_dict.pkl'
+            if (
+                args.intermediate_structures_export and
+                "recycling_metrics" in out
+            ):
+                str_exporter.save_recycling_metrics(out["recycling_metrics"])
+
+            # Toss out the recycling dimensions --- we don't need them anymore
+            if is_lazy_batch:
+                processed_feature_dict = tensor_tree_map(
+                    to_numpy,
+                    processed_feature_dict.last()
                 )
-                with open(output_dict_path, "wb") as fp:
-                    pickle.dump(out, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            else:
+                processed_feature_dict = tensor_tree_map(
+                    lambda x: np.array(x[..., -1].cpu()),
+                    processed_feature_dict
+                )
+            out = tensor_tree_map(to_numpy, out)
 
-                logger.info(f"Model output written to {output_dict_path}...")
+            write_prediction(
+                out,
+                processed_feature_dict,
+                feature_dict,
+                feature_processor,
+                config,
+                args,
+                output_directory,
+                output_name,
+                tag,
+                relax_pool,
+            )
 
             if args.protein_movie:
                 str_exporter.make_movie()
@@ -436,6 +935,23 @@ def main(args):
             if args.representation_movies:
                 repr_exporter.pngs_to_mpg()
 
+            if relax_pool is not None:
+                relax_pool.poll()
+
+    if relax_pool is not None:
+        relax_pool.close()
+
+    if profiler is not None:
+        profiler.detach()
+        profiler.write(args.profile)
+        summary_path = os.path.join(args.output_dir, "profile_summary.json")
+        with open(summary_path, "w") as fp:
+            json.dump(profiler.summary(), fp, indent=4)
+        logger.info(
+            f"Profile written to {args.profile}, summary to {summary_path}"
+        )
+        set_profiler(None)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -509,6 +1025,13 @@ if __name__ == "__main__":
         "--use_single_seq_mode", action="store_true", default=False,
         help="""Use single sequence embeddings instead of MSAs."""
     )
+    parser.add_argument(
+        "--embedding_store", type=str, default=None,
+        help="""Directory of a sequence embedding store, written by
+                scripts/precompute_embeddings.py --use_embedding_store.
+                In single sequence mode, embeddings are loaded from it, and
+                new sequences are embedded into it"""
+    )
     parser.add_argument(
         "--output_dir", type=str, default=os.getcwd(),
         help="""Name of the directory in which to output the prediction""",
@@ -541,6 +1064,17 @@ if __name__ == "__main__":
         "--cpus", type=int, default=4,
         help="""Number of CPUs with which to run alignment tools"""
     )
+    parser.add_argument(
+        "--max_concurrent_searches", type=int, default=None,
+        help="""Maximum number of alignment database searches to run at
+                once, between which --cpus are split. By default, all run
+                concurrently. 1 runs them one after another"""
+    )
+    parser.add_argument(
+        "--msa_parsing_workers", type=int, default=0,
+        help="""Number of processes in which to parse each target's MSA
+                files concurrently. 0 parses them one after another"""
+    )
     parser.add_argument(
         "--preset", type=str, default='full_dbs',
         choices=('reduced_dbs', 'full_dbs')
@@ -555,6 +1089,30 @@ if __name__ == "__main__":
     parser.add_argument(
         "--skip_relaxation", action="store_true", default=False,
     )
+    parser.add_argument(
+        "--batch_size", type=int, default=1,
+        help="""Maximum number of targets to run through the model at once.
+             Targets of similar length are padded to a common length, so
+             this requires fixed_size mode. Useful for many short targets,
+             which underutilize the GPU on their own"""
+    )
+    parser.add_argument(
+        "--relax_workers", type=int, default=0,
+        help="""Number of background processes in which to run relaxation,
+                on the CPU, while inference moves on to the next target. 
+                If 0, relaxation runs inline on --model_device"""
+    )
+    parser.add_argument(
+        "--relax_if_needed", action="store_true", default=False,
+        help="""Skip relaxation of predictions without clashes or bond
+                violations. Their "relaxed" output is the unrelaxed
+                structure, without hydrogens"""
+    )
+    parser.add_argument(
+        "--local_relax_radius", type=float, default=None,
+        help="""If set, relaxation only moves residues within this many
+                Angstroms of residues with structural violations"""
+    )
     parser.add_argument(
         "--multimer_ri_gap", type=int, default=200,
         help="""Residue index offset between multiple sequences, if provided"""
@@ -565,6 +1123,13 @@ if __name__ == "__main__":
                 Significantly improves runtime at the cost of lengthy
                 'compilation.' Useful for large batch jobs."""
     )
+    parser.add_argument(
+        "--trace_cache_dir", type=str, default=None,
+        help="""Directory in which --trace_model persists traced modules,
+                such that later runs with the same model and sequence
+                length bucket skip tracing. See 
+                scripts/prewarm_trace_cache.py"""
+    )
     parser.add_argument(
         "--subtract_plddt", action="store_true", default=False,
         help=""""Whether to output (100 - pLDDT) in the B-factor column instead
@@ -574,6 +1139,89 @@ if __name__ == "__main__":
         "--long_sequence_inference", action="store_true", default=False,
         help="""enable options to reduce memory usage at the cost of speed, helps longer sequences fit into GPU memory, see the README for details"""
     )
+    parser.add_argument(
+        "--lazy_recycling", action="store_true", default=False,
+        help="""Generate the input features of each recycling iteration on
+                demand instead of up front. Reduces memory usage when
+                running many recycling iterations"""
+    )
+    parser.add_argument(
+        "--cpu_inference", action="store_true", default=False,
+        help="""Tune the run for --model_device cpu: size the thread pools to
+                the available cores, use fixed chunk sizes instead of tuning
+                them, and run the evoformer under bfloat16 autocast if the
+                CPU supports it natively"""
+    )
+    parser.add_argument(
+        "--cpu_threads", type=int, default=None,
+        help="""Number of intra-op threads with --cpu_inference. Defaults to
+                the number of available cores"""
+    )
+    parser.add_argument(
+        "--cpu_interop_threads", type=int, default=None,
+        help="""Number of inter-op threads with --cpu_inference"""
+    )
+    parser.add_argument(
+        "--cpu_cores", type=str, default=None,
+        help="""Cores to pin the process to with --cpu_inference, e.g.
+                "0-15" or "0-7,16-23". Useful to keep several runs on one
+                node from competing for cores"""
+    )
+    parser.add_argument(
+        "--cpu_bf16", type=str, default="auto", choices=["auto", "on", "off"],
+        help="""Whether to run the trunk of the model under bfloat16 autocast
+                with --cpu_inference. "auto" enables it on CPUs with native
+                bfloat16 instructions (AVX512-BF16 or AMX). The structure
+                module and heads always run in fp32"""
+    )
+    parser.add_argument(
+        "--cpu_compile", action="store_true", default=False,
+        help="""Compile the evoformer blocks with torch.compile with
+                --cpu_inference. Pays off for long targets or many targets,
+                since compilation takes minutes"""
+    )
+    parser.add_argument(
+        "--profile", type=str, default=None,
+        help="""Path to which to write the wall time, CUDA time and peak
+                memory of each stage of the run (data pipeline, feature
+                transforms, evoformer blocks, structure module, relaxation,
+                ...). Written as a Chrome trace if the path ends with .json,
+                as JSON lines otherwise. A summary aggregated across targets
+                is written to profile_summary.json in the output directory"""
+    )
+    parser.add_argument(
+        "--record_recycling_metrics", action="store_true", default=False,
+        help="""Record convergence metrics (CA RMSD, dRMSD, mean pLDDT, pair
+                representation change) after each recycling iteration and
+                write them to <output_name>_recycling_metrics.json"""
+    )
+    parser.add_argument(
+        "--chunk_size_cache", type=str, default=None,
+        help="""Path to a JSON file in which tuned chunk sizes are persisted,
+                such that later runs can skip chunk size tuning"""
+    )
+    parser.add_argument(
+        "--plan_memory", action="store_true", default=False,
+        help="""Choose chunk_size, attention implementation, offloading and
+                precision per target from a model of its peak memory usage.
+                Overrides the corresponding config settings. The plans are
+                written to memory_plan.json in the output directory. Not
+                compatible with --cpu_inference"""
+    )
+    parser.add_argument(
+        "--memory_budget_gb", type=float, default=None,
+        help="""Memory available to --plan_memory. Defaults to the free 
+                memory of --model_device"""
+    )
+    parser.add_argument(
+        "--memory_planner_calibration", type=str, default=None,
+        help="""JSON file of memory planner calibration factors. Updated
+                with the measured peak memory of each CUDA run"""
+    )
+    parser.add_argument(
+        "--memory_planner_allow_bf16", action="store_true", default=False,
+        help="""Allow --plan_memory to run targets under bfloat16 autocast"""
+    )
     parser.add_argument(
         "--cif_output", action="store_true", default=False,
         help="Output predicted models in ModelCIF format instead of PDB format (default)"
@@ -0,0 +1,202 @@
+"""
+Measures end-to-end inference throughput on CPUs, with and without the
+--cpu_inference settings of run_pretrained_openfold.py.
+
+Each mode runs in a fresh process, since PyTorch's thread pools can only be
+sized once per process. Weights are randomly initialized and MSAs random,
+which doesn't affect the run time. Throughput is reported per core, to
+compare nodes of different sizes, e.g.:
+
+    python3 -m scripts.benchmark_cpu_inference cpu_throughput.json \\
+        --sizes 100 250 500 1000 --cpu_cores 0-15
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import time
+
+import torch
+
+from scripts.run_benchmarks import random_raw_features
+
+logging.basicConfig()
+logger = logging.getLogger(__file__)
+logger.setLevel(level=logging.INFO)
+
+
+def _run_mode(mode, args):
+    from openfold.config import model_config
+    from openfold.data import feature_pipeline
+    from openfold.model.model import AlphaFold
+    from openfold.utils.cpu_utils import (
+        available_cores,
+        compile_evoformer_blocks_,
+        configure_cpu_threads,
+        cpu_supports_bf16,
+        keep_fp32_,
+        parse_core_list,
+    )
+
+    torch.set_grad_enabled(False)
+    torch.manual_seed(args.seed)
+
+    cores = None
+    if args.cpu_cores is not None:
+        cores = parse_core_list(args.cpu_cores)
+
+    cpu_inference = mode == "cpu_inference"
+    bf16 = False
+    if cpu_inference:
+        threads = configure_cpu_threads(args.cpu_threads, None, cores)
+        bf16 = args.cpu_bf16 == "on" or (
+            args.cpu_bf16 == "auto" and cpu_supports_bf16()
+        )
+    else:
+        # The default path only inherits the affinity, like a plain run
+        # under taskset would
+        if cores is not None:
+            configure_cpu_threads(None, None, cores)
+        threads = torch.get_num_threads()
+
+    config = model_config(
+        args.config_preset,
+        use_deepspeed_evoformer_attention=False,
+        cpu_inference=cpu_inference,
+    )
+    config.data.common.max_recycling_iters = args.max_recycling_iters
+
+    model = AlphaFold(config).eval()
+    if bf16:
+        keep_fp32_(model)
+    if cpu_inference and args.cpu_compile:
+        compile_evoformer_blocks_(model)
+
+    feature_processor = feature_pipeline.FeaturePipeline(config.data)
+
+    def run(n_res):
+        feats = feature_processor.process_features(
+            random_raw_features(n_res, args.msa_depth), mode="predict",
+        )
+        feats = {k: torch.as_tensor(v) for k, v in feats.items()}
+
+        precision_ctx = torch.autocast(
+            device_type="cpu", dtype=torch.bfloat16, enabled=bf16,
+        )
+        t = time.perf_counter()
+        with precision_ctx:
+            model(feats)
+        return time.perf_counter() - t
+
+    # Warm-up, which also compiles, at the smallest size
+    run(min(args.sizes))
+
+    results = {}
+    for n_res in args.sizes:
+        times = [run(n_res) for _ in range(args.repeats)]
+        t = min(times)
+        results[str(n_res)] = {
+            "seconds": t,
+            "residues_per_second_per_core": n_res / t / threads,
+            "targets_per_hour_per_core": 3600 / t / threads,
+        }
+
+    return {
+        "threads": threads,
+        "cores": len(available_cores()),
+        "bf16": bf16,
+        "results": results,
+    }
+
+
+def main(args):
+    modes = ["default", "cpu_inference"]
+    if args.mode is not None:
+        modes = [args.mode]
+
+    output = {
+        "metadata": {
+            "torch_version": torch.__version__,
+            "processor": platform.processor(),
+            "config_preset": args.config_preset,
+            "max_recycling_iters": args.max_recycling_iters,
+            "msa_depth": args.msa_depth,
+        },
+    }
+    ctx = multiprocessing.get_context("spawn")
+    for mode in modes:
+        logger.info(f"Benchmarking {mode}...")
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            output[mode] = pool.apply(_run_mode, (mode, args))
+
+        for n_res, r in output[mode]["results"].items():
+            logger.info(
+                f"{mode} {n_res} residues: {r['seconds']:.1f}s, "
+                f"{r['residues_per_second_per_core']:.3f} residues/s/core"
+            )
+
+    if len(modes) == 2:
+        speedups = {}
+        for n_res, r in output["cpu_inference"]["results"].items():
+            default = output["default"]["results"][n_res]
+            speedups[n_res] = (
+                r["residues_per_second_per_core"] /
+                default["residues_per_second_per_core"]
+            )
+        output["per_core_speedup"] = speedups
+        logger.info(f"Per-core speedups: {speedups}")
+
+    with open(args.output_path, "w") as fp:
+        json.dump(output, fp, indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "output_path", type=str,
+        help="Path of the JSON file to which to write the results"
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 250, 500, 1000],
+        help="Residue counts of the benchmarked targets"
+    )
+    parser.add_argument(
+        "--mode", type=str, default=None,
+        choices=["default", "cpu_inference"],
+        help="Only benchmark one of the modes"
+    )
+    parser.add_argument(
+        "--config_preset", type=str, default="model_1",
+    )
+    parser.add_argument(
+        "--max_recycling_iters", type=int, default=0,
+        help="""Number of recycling iterations. Run time grows linearly with
+                it, so per-core throughput comparisons don't need any"""
+    )
+    parser.add_argument(
+        "--msa_depth", type=int, default=512,
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=1,
+    )
+    parser.add_argument(
+        "--cpu_threads", type=int, default=None,
+    )
+    parser.add_argument(
+        "--cpu_cores", type=str, default=None,
+        help="Cores to pin both modes to, e.g. 0-15"
+    )
+    parser.add_argument(
+        "--cpu_bf16", type=str, default="auto", choices=["auto", "on", "off"],
+    )
+    parser.add_argument(
+        "--cpu_compile", action="store_true", default=False,
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0,
+    )
+
+    args = parser.parse_args()
+
+    main(args)
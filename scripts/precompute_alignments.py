@@ -5,14 +5,23 @@ import logging
 import os
 import threading
 from multiprocessing import cpu_count
-from shutil import copyfile
 import tempfile
 
 import openfold.data.mmcif_parsing as mmcif_parsing
+from openfold.data.alignment_store import (
+    DEDUP_MODES,
+    AlignmentMapWriter,
+    link_alignment_dir,
+    list_alignment_names,
+    merge_seq_group,
+    sequence_hash,
+    store_alignments,
+)
 from openfold.data.data_pipeline import AlignmentRunner
 from openfold.data.parsers import parse_fasta
 from openfold.data.tools import hhsearch, hmmsearch
 from openfold.np import protein, residue_constants
+from openfold.utils.work_queue import WorkQueue
 
 from utils import add_data_args
 
@@ -20,98 +29,227 @@ from utils import add_data_args
 logging.basicConfig(level=logging.WARNING)
 
 
-def run_seq_group_alignments(seq_groups, alignment_runner, args):
-    dirs = set(os.listdir(args.output_dir))
-    for seq, names in seq_groups:
-        first_name = names[0]
-        alignment_dir = os.path.join(args.output_dir, first_name)
-        
-        try:
-            os.makedirs(alignment_dir)
-        except Exception as e:
-            logging.warning(f"Failed to create directory for {first_name} with exception {e}...")
-            continue
+def run_alignments(seq, alignment_dir, alignment_runner):
+    fd, fasta_path = tempfile.mkstemp(suffix=".fasta")
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(f'>query\n{seq}')
 
-        fd, fasta_path = tempfile.mkstemp(suffix=".fasta")
-        with os.fdopen(fd, 'w') as fp:
-            fp.write(f'>query\n{seq}')
+    try:
+        return alignment_runner.run(
+            fasta_path, alignment_dir
+        )
+    finally:
+        os.remove(fasta_path)
 
-        try:
-            alignment_runner.run(
-                fasta_path, alignment_dir
+
+def align_seq_group(
+    seq, names, alignment_runner, args, map_writer=None, dirs=None, exist_ok=False,
+):
+    """
+    Computes the alignments of the chains in names, which share the
+    sequence seq. Chains in dirs are skipped. Returns the timings of the
+    alignment tools.
+    """
+    if(dirs is None):
+        dirs = set()
+
+    first_name = names[0]
+
+    # Chains are mapped to a single directory per sequence
+    if(args.dedup == "index"):
+        timings = {}
+        def run(alignment_dir):
+            timings.update(
+                run_alignments(seq, alignment_dir, alignment_runner)
             )
-        except Exception as e:
-            logging.warning(e)
-            logging.warning(f"Failed to run alignments for {first_name}. Skipping...")
-            os.remove(fasta_path)
+
+        key = store_alignments(args.output_dir, seq, run)
+        map_writer.add([n for n in names if n not in dirs], key)
+        return timings
+
+    alignment_dir = os.path.join(args.output_dir, first_name)
+    os.makedirs(alignment_dir, exist_ok=exist_ok)
+
+    try:
+        timings = run_alignments(seq, alignment_dir, alignment_runner)
+    except Exception:
+        if(not exist_ok):
             os.rmdir(alignment_dir)
+        raise
+
+    for name in names[1:]:
+        if(name in dirs):
+            logging.warning(
+                f'{name} has already been processed. Skipping...'
+            )
             continue
 
-        os.remove(fasta_path)
+        link_alignment_dir(
+            alignment_dir,
+            os.path.join(args.output_dir, name),
+            mode=args.dedup,
+        )
 
-        for name in names[1:]:
-            if(name in dirs):
-                logging.warning(
-                    f'{name} has already been processed. Skipping...'
-                )
-                continue
-            
-            cp_dir = os.path.join(args.output_dir, name)
-            os.makedirs(cp_dir, exist_ok=True)
-            
-            for f in os.listdir(alignment_dir):
-                copyfile(os.path.join(alignment_dir, f), os.path.join(cp_dir, f))
+    return timings
 
 
-def parse_and_align(files, alignment_runner, args):
+def run_seq_group_alignments(seq_groups, alignment_runner, args, map_writer=None):
+    dirs = set(list_alignment_names(args.output_dir))
+    for seq, names in seq_groups:
+        try:
+            align_seq_group(
+                seq, names, alignment_runner, args,
+                map_writer=map_writer, dirs=dirs,
+            )
+        except Exception as e:
+            logging.warning(e)
+            logging.warning(f"Failed to run alignments for {names[0]}. Skipping...")
+
+
+def parse_seq_groups(f, args):
+    """ Groups the chains in an input file by sequence """
+    path = os.path.join(args.input_dir, f)
+    file_id = os.path.splitext(f)[0]
+    seq_group_dict = {}  
+    if(f.endswith('.cif')):
+        with open(path, 'r') as fp:
+            mmcif_str = fp.read()
+        mmcif = mmcif_parsing.parse(
+            file_id=file_id, mmcif_string=mmcif_str
+        )
+        if(mmcif.mmcif_object is None):
+            logging.warning(f'Failed to parse {f}...')
+            if(args.raise_errors):
+                raise list(mmcif.errors.values())[0]
+            else:
+                return []
+        mmcif = mmcif.mmcif_object
+        for chain_letter, seq in mmcif.chain_to_seqres.items():
+            chain_id = '_'.join([file_id, chain_letter])
+            l = seq_group_dict.setdefault(seq, [])
+            l.append(chain_id)
+    elif(f.endswith('.fasta') or f.endswith('.fa')):
+        with open(path, 'r') as fp:
+            fasta_str = fp.read()
+        input_seqs, _ = parse_fasta(fasta_str)
+        if len(input_seqs) != 1: 
+            msg = f'More than one input_sequence found in {f}'
+            if(args.raise_errors):
+                raise ValueError(msg)
+            else:
+                logging.warning(msg)
+        input_sequence = input_seqs[0]
+        seq_group_dict[input_sequence] = [file_id]
+    elif(f.endswith('.core')):
+        with open(path, 'r') as fp:
+            core_str = fp.read()
+        core_prot = protein.from_proteinnet_string(core_str)
+        aatype = core_prot.aatype
+        seq = ''.join([
+            residue_constants.restypes_with_x[aatype[i]] 
+            for i in range(len(aatype))
+        ])
+        seq_group_dict[seq] = [file_id]
+
+    return [(k,v) for k,v in seq_group_dict.items()]
+
+
+def parse_and_align(files, alignment_runner, args, map_writer=None):
     for f in files:
-        path = os.path.join(args.input_dir, f)
-        file_id = os.path.splitext(f)[0]
-        seq_group_dict = {}  
-        if(f.endswith('.cif')):
-            with open(path, 'r') as fp:
-                mmcif_str = fp.read()
-            mmcif = mmcif_parsing.parse(
-                file_id=file_id, mmcif_string=mmcif_str
+        seq_group_tuples = parse_seq_groups(f, args)
+        run_seq_group_alignments(
+            seq_group_tuples, alignment_runner, args, map_writer=map_writer
+        )
+
+
+def link_queue_item(payload, args, map_writer=None):
+    """
+    Links chain names added to a sequence group after its alignments were
+    done.
+    """
+    linked = payload["linked"]
+    new_names = [n for n in payload["names"] if n not in linked]
+    if(args.dedup == "index"):
+        map_writer.add(new_names, sequence_hash(payload["seq"]))
+    else:
+        src = os.path.join(args.output_dir, linked[0])
+        for name in new_names:
+            link_alignment_dir(
+                src, os.path.join(args.output_dir, name), mode=args.dedup
             )
-            if(mmcif.mmcif_object is None):
-                logging.warning(f'Failed to parse {f}...')
-                if(args.raise_errors):
-                    raise list(mmcif.errors.values())[0]
-                else:
-                    continue
-            mmcif = mmcif.mmcif_object
-            for chain_letter, seq in mmcif.chain_to_seqres.items():
-                chain_id = '_'.join([file_id, chain_letter])
-                l = seq_group_dict.setdefault(seq, [])
-                l.append(chain_id)
-        elif(f.endswith('.fasta') or f.endswith('.fa')):
-            with open(path, 'r') as fp:
-                fasta_str = fp.read()
-            input_seqs, _ = parse_fasta(fasta_str)
-            if len(input_seqs) != 1: 
-                msg = f'More than one input_sequence found in {f}'
-                if(args.raise_errors):
-                    raise ValueError(msg)
-                else:
-                    logging.warning(msg)
-            input_sequence = input_seqs[0]
-            seq_group_dict[input_sequence] = [file_id]
-        elif(f.endswith('.core')):
-            with open(path, 'r') as fp:
-                core_str = fp.read()
-            core_prot = protein.from_proteinnet_string(core_str)
-            aatype = core_prot.aatype
-            seq = ''.join([
-                residue_constants.restypes_with_x[aatype[i]] 
-                for i in range(len(aatype))
-            ])
-            seq_group_dict[seq] = [file_id]
-        else:
-            continue
 
-        seq_group_tuples = [(k,v) for k,v in seq_group_dict.items()]
-        run_seq_group_alignments(seq_group_tuples, alignment_runner, args)
+
+def align_queue_item(payload, alignment_runner, args, map_writer=None):
+    if("linked" in payload):
+        link_queue_item(payload, args, map_writer=map_writer)
+        return {}
+
+    if("file" in payload):
+        seq_groups = parse_seq_groups(payload["file"], args)
+    else:
+        seq_groups = [(payload["seq"], payload["names"])]
+
+    # Work items are leased to one worker at a time, so directories left
+    # behind by a preempted attempt can be reused
+    timings = {}
+    for seq, names in seq_groups:
+        timings[names[0]] = align_seq_group(
+            seq, names, alignment_runner, args,
+            map_writer=map_writer, exist_ok=True,
+        )
+
+    return timings
+
+
+def run_work_queue(seq_groups, files, alignment_runner, args, map_writer=None):
+    """
+    Adds the inputs to the work queue at args.work_queue, then processes
+    items from it until it runs dry. Any number of copies of the script can
+    share a queue.
+    """
+    queue = WorkQueue(
+        args.work_queue,
+        lease_seconds=args.lease_seconds,
+        max_attempts=args.max_attempts,
+    )
+
+    if(seq_groups is not None):
+        items = [
+            (sequence_hash(seq), {"seq": seq, "names": names})
+            for seq, names in seq_groups
+        ]
+        # Chain names added for a sequence that's already queued are merged
+        # into its item
+        merge = merge_seq_group
+    else:
+        items = [(f, {"file": f}) for f in files]
+        merge = None
+
+    no_new = queue.add(items, merge=merge)
+    logging.warning(f"Added {no_new} new items to {args.work_queue}")
+
+    if(args.retry_failed):
+        no_reset = queue.reset_failed()
+        logging.warning(f"Retrying {no_reset} failed items")
+
+    func = partial(
+        align_queue_item,
+        alignment_runner=alignment_runner,
+        args=args,
+        map_writer=map_writer,
+    )
+
+    threads = []
+    for i in range(args.no_tasks):
+        print(f"Started thread {i}...")
+        t = threading.Thread(target=queue.work, args=(func,))
+        threads.append(t)
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    logging.warning(f"Work queue status: {queue.counts()}")
 
 
 def main(args):
@@ -142,8 +280,13 @@ def main(args):
         template_searcher=template_searcher,
         use_small_bfd=args.bfd_database_path is None,
         no_cpus=args.cpus_per_task,
+        max_concurrent_searches=args.max_concurrent_searches,
     )
 
+    map_writer = None
+    if(args.dedup == "index"):
+        map_writer = AlignmentMapWriter(args.output_dir)
+
     files = list(os.listdir(args.input_dir))
 
     # Do some filtering
@@ -153,9 +296,10 @@ def main(args):
     else:
         cache = None
 
+    # The work queue keeps track of finished inputs itself
     dirs = []
-    if(cache is not None and args.filter):
-        dirs = set(os.listdir(args.output_dir))
+    if(cache is not None and args.filter and args.work_queue is None):
+        dirs = set(list_alignment_names(args.output_dir))
         def prot_is_done(f):
             prot_id = os.path.splitext(f)[0]
             if(prot_id in cache):
@@ -187,6 +331,7 @@ def main(args):
 
         return t_arglist
 
+    seq_groups = None
     if(cache is not None and "seqs" in next(iter(cache.values()))):
         seq_group_dict = {}
         for f in files:
@@ -204,7 +349,8 @@ def main(args):
        
         func = partial(run_seq_group_alignments, 
             alignment_runner=alignment_runner, 
-            args=args
+            args=args,
+            map_writer=map_writer,
         )
 
         seq_groups = [(k,v) for k,v in seq_group_dict.items()]
@@ -217,9 +363,16 @@ def main(args):
         func = partial(parse_and_align,
             alignment_runner=alignment_runner,
             args=args,
+            map_writer=map_writer,
         )
         task_arglist = [[a] for a in split_up_arglist(files)]
 
+    if(args.work_queue is not None):
+        run_work_queue(
+            seq_groups, files, alignment_runner, args, map_writer=map_writer
+        )
+        return
+
     threads = []
     for i, task_args in enumerate(task_arglist):
         print(f"Started thread {i}...")
@@ -251,6 +404,12 @@ if __name__ == "__main__":
         "--cpus_per_task", type=int, default=cpu_count(),
         help="Number of CPUs to use"
     )
+    parser.add_argument(
+        "--max_concurrent_searches", type=int, default=None,
+        help="""Maximum number of database searches to run at once per
+                target, between which --cpus_per_task are split. By
+                default, all run concurrently"""
+    )
     parser.add_argument(
         "--mmcif_cache", type=str, default=None,
         help="Path to mmCIF cache. Used to filter files to be parsed"
@@ -261,6 +420,36 @@ if __name__ == "__main__":
     parser.add_argument(
         "--filter", type=bool, default=True,
     )
+    parser.add_argument(
+        "--dedup", type=str, default="hardlink", choices=DEDUP_MODES,
+        help="""How to store the alignments of chains with identical
+                sequences. "copy", "hardlink" and "symlink" give every chain
+                its own directory, holding copies of or links to the files
+                of the first chain. "index" stores the alignments once per
+                sequence hash, and maps chain names to them in
+                alignment_map.jsonl"""
+    )
+    parser.add_argument(
+        "--work_queue", type=str, default=None,
+        help="""Path to a SQLite work queue, created if it doesn't exist.
+                Any number of copies of this script, on any number of nodes
+                sharing a filesystem, can pull inputs from the same queue.
+                Rerunning with the same queue resumes where the previous
+                run stopped"""
+    )
+    parser.add_argument(
+        "--lease_seconds", type=float, default=600.,
+        help="""Time after which the inputs of a work queue worker that
+                stopped sending heartbeats are handed to other workers"""
+    )
+    parser.add_argument(
+        "--max_attempts", type=int, default=3,
+        help="Number of times a work queue input is tried before it fails"
+    )
+    parser.add_argument(
+        "--retry_failed", action="store_true", default=False,
+        help="Whether to give failed work queue inputs another round of attempts"
+    )
 
     args = parser.parse_args()
 
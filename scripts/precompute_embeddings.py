@@ -6,6 +6,7 @@ import os
 import torch
 
 from openfold.data import parsers
+from openfold.data.embedding_store import EmbeddingStore
 
 logging.basicConfig(level=logging.INFO)
 
@@ -109,9 +110,28 @@ class EmbeddingGenerator:
         self,
         fasta_file,
         output_dir,
+        store=None,
     ):
-
+        """
+        Embeds the sequences in fasta_file. Embeddings are written to
+        per-sequence .pt files in output_dir or, if an EmbeddingStore is
+        given, to the store. Sequences already in the store are skipped.
+        """
         dataset = SequenceDataset.from_file(fasta_file)
+        if store is not None:
+            missing = store.missing(dataset.sequences)
+            logging.info(
+                f"Skipping {len(dataset) - len(missing)} sequences that are "
+                f"duplicates or already embedded"
+            )
+            if len(missing) == 0:
+                return
+
+            # Sequences are keyed by hash, so labels only need to be unique
+            dataset = SequenceDataset(
+                [str(i) for i in range(len(missing))], missing
+            )
+
         batches = dataset.get_batch_indices(self.toks_per_batch, extra_toks_per_seq=1)
         data_loader = torch.utils.data.DataLoader(
             dataset, collate_fn=self.alphabet.get_batch_converter(), batch_sampler=batches
@@ -134,6 +154,16 @@ class EmbeddingGenerator:
                     33: out["representations"][33].to(device="cpu")
                 }
 
+                if store is not None:
+                    store.add(
+                        strs,
+                        [
+                            representations[33][i, 1: len(s) + 1]
+                            for i, s in enumerate(strs)
+                        ],
+                    )
+                    continue
+
                 for i, label in enumerate(labels):
                     os.makedirs(os.path.join(output_dir, label), exist_ok=True)
                     result = {"label": label}
@@ -160,9 +190,13 @@ def main(args):
         args.fasta_dir,
         args.output_dir
     )
+    store = None
+    if args.use_embedding_store:
+        store = EmbeddingStore(args.output_dir)
     embedding_generator.run(
         temp_fasta_file,
-        args.output_dir
+        args.output_dir,
+        store=store,
     )
     os.remove(temp_fasta_file)
     logging.info("Completed.")
@@ -194,6 +228,12 @@ if __name__ == "__main__":
         "--nogpu", action="store_true",
         help="Do not use GPU"
     )
+    parser.add_argument(
+        "--use_embedding_store", action="store_true", default=False,
+        help="""Write the embeddings to a single float16 store in output_dir,
+                keyed by sequence, instead of one .pt file per sequence.
+                Sequences already in the store are skipped"""
+    )
 
     args = parser.parse_args()
 
@@ -0,0 +1,157 @@
+"""
+Populates a --trace_cache_dir for run_pretrained_openfold.py --trace_model
+ahead of time, by tracing each model at a list of sequence length buckets
+using placeholder inputs.
+
+The config-related arguments need to match those of the later inference
+runs, since the config is part of the cache key.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import torch
+
+from openfold.config import model_config
+from openfold.data import data_pipeline, feature_pipeline, templates
+from openfold.utils.script_utils import load_models_from_command_line
+from openfold.utils.trace_utils import (
+    TRACING_INTERVAL,
+    round_up_seqlen,
+    trace_model_,
+)
+
+logging.basicConfig()
+logger = logging.getLogger(__file__)
+logger.setLevel(level=logging.INFO)
+
+torch.set_grad_enabled(False)
+
+
+def make_placeholder_features(seqlen):
+    sequence = "A" * seqlen
+    feature_dict = {}
+    feature_dict.update(
+        data_pipeline.make_sequence_features(sequence, "prewarm", seqlen)
+    )
+    feature_dict.update(data_pipeline.make_dummy_msa_feats(sequence))
+    feature_dict.update(templates.empty_template_feats(seqlen))
+    return feature_dict
+
+
+def main(args):
+    if "multimer" in args.config_preset:
+        raise ValueError("Tracing is not supported for multimer models")
+
+    config = model_config(
+        args.config_preset,
+        long_sequence_inference=args.long_sequence_inference,
+        use_deepspeed_evoformer_attention=args.use_deepspeed_evoformer_attention,
+    )
+
+    if args.experiment_config_json:
+        with open(args.experiment_config_json, 'r') as f:
+            custom_config_dict = json.load(f)
+        config.update_from_flattened_dict(custom_config_dict)
+
+    if args.chunk_size_cache is not None:
+        config.globals.chunk_size_cache_path = args.chunk_size_cache
+
+    if not config.data.predict.fixed_size:
+        raise ValueError(
+            "Tracing requires that fixed_size mode be enabled in the config"
+        )
+
+    feature_processor = feature_pipeline.FeaturePipeline(config.data)
+
+    seqlens = sorted(set(round_up_seqlen(l) for l in args.seqlens))
+
+    model_generator = load_models_from_command_line(
+        config,
+        args.model_device,
+        args.openfold_checkpoint_path,
+        args.jax_param_path,
+        args.output_dir,
+    )
+    for model, _ in model_generator:
+        for seqlen in seqlens:
+            processed_feature_dict = feature_processor.process_features(
+                make_placeholder_features(seqlen), mode='predict',
+            )
+            processed_feature_dict = {
+                k: torch.as_tensor(v, device=args.model_device)
+                for k, v in processed_feature_dict.items()
+            }
+
+            logger.info(f"Tracing model at {seqlen} residues...")
+            t = time.perf_counter()
+            trace_model_(
+                model, processed_feature_dict, cache_dir=args.trace_cache_dir,
+                keep_untraced=(seqlen != seqlens[-1]),
+            )
+            logger.info(f"Tracing time: {time.perf_counter() - t}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "trace_cache_dir", type=str,
+        help="Directory passed to run_pretrained_openfold.py --trace_cache_dir"
+    )
+    parser.add_argument(
+        "--seqlens", type=int, nargs="+",
+        default=[TRACING_INTERVAL * i for i in range(1, 11)],
+        help=f"""Sequence lengths to trace at. Each is rounded up to a
+                 multiple of {TRACING_INTERVAL}"""
+    )
+    parser.add_argument(
+        "--model_device", type=str, default="cpu",
+        help="""Name of the device on which to run the model. Any valid torch
+             device name is accepted (e.g. "cpu", "cuda:0")"""
+    )
+    parser.add_argument(
+        "--config_preset", type=str, default="model_1",
+        help="""Name of a model config preset defined in openfold/config.py"""
+    )
+    parser.add_argument(
+        "--jax_param_path", type=str, default=None,
+        help="""Path to JAX model parameters. If None, and openfold_checkpoint_path
+             is also None, parameters are selected automatically according to
+             the model name from openfold/resources/params"""
+    )
+    parser.add_argument(
+        "--openfold_checkpoint_path", type=str, default=None,
+        help="""Path to OpenFold checkpoint. Can be either a DeepSpeed
+             checkpoint directory or a .pt file"""
+    )
+    parser.add_argument(
+        "--output_dir", type=str, default=os.getcwd(),
+        help="""Directory in which converted checkpoints are written, if any"""
+    )
+    parser.add_argument(
+        "--long_sequence_inference", action="store_true", default=False,
+    )
+    parser.add_argument(
+        "--use_deepspeed_evoformer_attention", action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--experiment_config_json", default="",
+        help="Path to a json file with custom config values to overwrite config setting",
+    )
+    parser.add_argument(
+        "--chunk_size_cache", type=str, default=None,
+        help="""Path to a JSON file in which tuned chunk sizes are persisted"""
+    )
+
+    args = parser.parse_args()
+
+    if args.jax_param_path is None and args.openfold_checkpoint_path is None:
+        args.jax_param_path = os.path.join(
+            "openfold", "resources", "params",
+            "params_" + args.config_preset + ".npz"
+        )
+
+    main(args)
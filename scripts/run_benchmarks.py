@@ -0,0 +1,444 @@
+"""
+Benchmarks the hot paths of inference and of the data pipeline.
+
+Each benchmark runs on CPU, with small, randomly initialized modules, at a
+range of residue counts. Wall times and peak memory are written to a JSON
+file. Pass the JSON file of an earlier run as --baseline to diff against it,
+e.g.:
+
+    python3 scripts/run_benchmarks.py baseline.json
+    # ... make changes ...
+    python3 scripts/run_benchmarks.py new.json --baseline baseline.json
+
+Results are only comparable between runs on the same machine with the same
+--threads.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import string
+import sys
+import tempfile
+import time
+from functools import partial
+
+import numpy as np
+import torch
+
+logging.basicConfig()
+logger = logging.getLogger(__file__)
+logger.setLevel(level=logging.INFO)
+
+
+BENCHMARKS = {}
+
+# MSA depth used for the module and data pipeline benchmarks
+N_SEQ = 128
+
+# Number of evoformer blocks in the benchmarked EvoformerStack
+NO_BLOCKS = 2
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. The decorated function is called with a residue
+    count and returns a function without arguments, the call of which is
+    timed.
+    """
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return decorator
+
+
+def _config():
+    from openfold.config import model_config
+    return model_config("model_1", use_deepspeed_evoformer_attention=False)
+
+
+def _random_sequence(n_res):
+    return "".join(random.choices("ACDEFGHIKLMNPQRSTVWY", k=n_res))
+
+
+def _random_a3m(n_res, n_seq=N_SEQ):
+    lines = []
+    for i in range(n_seq):
+        seq = list(_random_sequence(n_res))
+        if i > 0:
+            for j in random.sample(range(n_res), n_res // 10):
+                seq[j] = "-"
+            for j in random.sample(range(n_res), n_res // 20):
+                seq[j] += random.choice(string.ascii_lowercase)
+        lines.append(f">seq_{i}")
+        lines.append("".join(seq))
+    return "\n".join(lines) + "\n"
+
+
+def _random_stockholm(n_res, n_seq=N_SEQ):
+    lines = ["# STOCKHOLM 1.0", ""]
+    for i in range(n_seq):
+        seq = list(_random_sequence(n_res))
+        if i > 0:
+            for j in random.sample(range(n_res), n_res // 10):
+                seq[j] = "-"
+        lines.append(f"seq_{i} {''.join(seq)}")
+    lines.append("//")
+    return "\n".join(lines) + "\n"
+
+
+def random_raw_features(n_res, n_seq=N_SEQ):
+    """ Unprocessed features of a random sequence with a random MSA """
+    from openfold.data import data_pipeline, parsers, templates
+
+    msa = parsers.parse_a3m(_random_a3m(n_res, n_seq))
+    feats = {}
+    feats.update(data_pipeline.make_sequence_features(
+        msa.sequences[0], "benchmark", n_res
+    ))
+    feats.update(data_pipeline.make_msa_features([msa]))
+    feats.update(templates.empty_template_feats(n_res))
+    return feats
+
+
+@benchmark("evoformer_stack")
+def bench_evoformer_stack(n_res):
+    from openfold.model.evoformer import EvoformerStack
+
+    c = _config().model.evoformer_stack
+    c.no_blocks = NO_BLOCKS
+    stack = EvoformerStack(**c).eval()
+
+    m = torch.rand(N_SEQ, n_res, c.c_m)
+    z = torch.rand(n_res, n_res, c.c_z)
+    msa_mask = torch.ones(N_SEQ, n_res)
+    pair_mask = torch.ones(n_res, n_res)
+
+    def run():
+        with torch.no_grad():
+            stack(
+                m.clone(), z.clone(), msa_mask, pair_mask,
+                chunk_size=None, inplace_safe=True,
+            )
+
+    return run
+
+
+@benchmark("structure_module")
+def bench_structure_module(n_res):
+    from openfold.model.structure_module import StructureModule
+
+    c = _config().model.structure_module
+    sm = StructureModule(is_multimer=False, **c).eval()
+
+    s = torch.rand(n_res, c.c_s)
+    z = torch.rand(n_res, n_res, c.c_z)
+    aatype = torch.randint(0, 20, (n_res,))
+    mask = torch.ones(n_res)
+
+    def run():
+        with torch.no_grad():
+            sm({"single": s, "pair": z}, aatype, mask=mask, inplace_safe=True)
+
+    return run
+
+
+def _attention_inputs(n_res, c=64, c_hidden=32, no_heads=4):
+    from openfold.model.primitives import Attention
+
+    attn = Attention(c, c, c, c_hidden, no_heads).eval()
+    # Shaped like the inputs to triangle attention
+    x = torch.rand(1, n_res, n_res, c)
+    mask_bias = torch.zeros(1, n_res, 1, 1, n_res)
+    triangle_bias = torch.rand(1, 1, no_heads, n_res, n_res)
+    return attn, x, [mask_bias, triangle_bias]
+
+
+@benchmark("attention")
+def bench_attention(n_res):
+    attn, x, biases = _attention_inputs(n_res)
+
+    def run():
+        with torch.no_grad():
+            attn(x, x, biases)
+
+    return run
+
+
+@benchmark("attention_lma")
+def bench_attention_lma(n_res):
+    attn, x, biases = _attention_inputs(n_res)
+
+    def run():
+        with torch.no_grad():
+            attn(
+                x, x, biases, use_lma=True,
+                lma_q_chunk_size=256, lma_kv_chunk_size=1024,
+            )
+
+    return run
+
+
+@benchmark("attention_chunked")
+def bench_attention_chunked(n_res):
+    from openfold.utils.chunk_utils import chunk_layer
+
+    attn, x, biases = _attention_inputs(n_res)
+
+    def run():
+        with torch.no_grad():
+            chunk_layer(
+                attn,
+                {"q_x": x, "kv_x": x, "biases": biases},
+                chunk_size=16,
+                no_batch_dims=2,
+            )
+
+    return run
+
+
+@benchmark("parse_a3m")
+def bench_parse_a3m(n_res):
+    from openfold.data import parsers
+
+    a3m = _random_a3m(n_res)
+    return partial(parsers.parse_a3m, a3m)
+
+
+@benchmark("parse_stockholm")
+def bench_parse_stockholm(n_res):
+    from openfold.data import parsers
+
+    sto = _random_stockholm(n_res)
+    return partial(parsers.parse_stockholm, sto)
+
+
+@benchmark("make_msa_features")
+def bench_make_msa_features(n_res):
+    from openfold.data import data_pipeline, parsers
+
+    msa = parsers.parse_a3m(_random_a3m(n_res))
+    return partial(data_pipeline.make_msa_features, [msa])
+
+
+@benchmark("process_features")
+def bench_process_features(n_res):
+    from openfold.data import feature_pipeline
+
+    feature_processor = feature_pipeline.FeaturePipeline(_config().data)
+    feats = random_raw_features(n_res)
+    return partial(feature_processor.process_features, feats, "predict")
+
+
+@benchmark("doctor_structure_export")
+def bench_doctor_structure_export(n_res):
+    """ What the intermediate structure exporter does per evoformer block """
+    from openfold.np import protein, residue_constants
+    from openfold.utils.script_utils import prep_output, prep_output_metadata
+
+    feature_processor = argparse.Namespace(config=_config().data)
+    aatype = np.random.randint(0, 20, (n_res,))
+    metadata = prep_output_metadata(
+        {"aatype": aatype, "residue_index": np.arange(n_res)},
+        {},
+        feature_processor,
+        "model_1",
+        200,
+    )
+    out = {
+        "final_atom_positions": (
+            np.random.randn(n_res, residue_constants.atom_type_num, 3) * 30
+        ).astype(np.float32),
+        "final_atom_mask": (
+            residue_constants.STANDARD_ATOM_MASK[aatype].astype(np.float32)
+        ),
+        "plddt": np.random.rand(n_res).astype(np.float32) * 100,
+    }
+
+    def run():
+        prot = prep_output(
+            out, None, {}, feature_processor, "model_1", 200, False,
+            metadata=metadata,
+        )
+        protein.to_pdb(prot)
+
+    return run
+
+
+@benchmark("doctor_representation_heatmap")
+def bench_doctor_representation_heatmap(n_res):
+    from openfold.doctor.representation_exporter import RepresentationExporter
+
+    output_dir = tempfile.mkdtemp()
+    exporter = RepresentationExporter(
+        argparse.Namespace(), output_dir=output_dir, export_msa=False,
+    )
+    z = torch.rand(n_res, n_res, 128)
+    return partial(exporter._representation_hook, None, z, "after", 0)
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_benchmark(name, n_res, repeats, threads, seed):
+    """ Runs one benchmark in a fresh process, such that peak RSS is its own """
+    torch.set_num_threads(threads)
+    torch.set_grad_enabled(False)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    fn = BENCHMARKS[name](n_res)
+
+    # Warm-up
+    fn()
+
+    rss_before = _peak_rss_bytes()
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+
+    return {
+        "min": min(times),
+        "median": float(np.median(times)),
+        "peak_rss_mb": _peak_rss_bytes() / 2 ** 20,
+        # Memory beyond the peak reached during setup and warm-up. Zero
+        # if the benchmark doesn't need more than it did during warm-up
+        "peak_rss_increase_mb": (_peak_rss_bytes() - rss_before) / 2 ** 20,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ Prints a comparison to a baseline and returns the regressions """
+    regressions = []
+    print(f"{'benchmark':<40}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for key, r in results.items():
+        b = baseline.get(key)
+        if b is None or "error" in r or "error" in b:
+            continue
+
+        ratio = r["median"] / b["median"]
+        flag = ""
+        if ratio > tolerance:
+            flag = "  <-- regression"
+            regressions.append(key)
+        print(
+            f"{key:<40}{b['median']:>12.4f}{r['median']:>12.4f}"
+            f"{ratio:>8.2f}{flag}"
+        )
+
+    return regressions
+
+
+def main(args):
+    names = [n for n in BENCHMARKS if re.search(args.filter, n)]
+    if len(names) == 0:
+        raise ValueError(f"No benchmark matches {args.filter}")
+
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    for name in names:
+        for n_res in args.sizes:
+            key = f"{name}/{n_res}"
+            logger.info(f"Running {key}...")
+            with ctx.Pool(1, maxtasksperchild=1) as pool:
+                try:
+                    results[key] = pool.apply(
+                        _run_benchmark,
+                        (name, n_res, args.repeats, args.threads, args.seed),
+                    )
+                except Exception as e:
+                    # e.g. missing optional dependencies of the exporters
+                    logger.warning(f"{key} failed: {e}")
+                    results[key] = {"error": repr(e)}
+                    continue
+            logger.info(
+                f"{key}: median {results[key]['median']:.4f}s, peak RSS "
+                f"{results[key]['peak_rss_mb']:.0f} MB"
+            )
+
+    output = {
+        "metadata": {
+            "torch_version": torch.__version__,
+            "python_version": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "threads": args.threads,
+            "repeats": args.repeats,
+            "n_seq": N_SEQ,
+            "sizes": args.sizes,
+        },
+        "results": results,
+    }
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fp:
+            baseline = json.load(fp)
+
+        if baseline["metadata"]["threads"] != args.threads:
+            logger.warning(
+                "The baseline was run with a different number of threads"
+            )
+
+        regressions = compare(results, baseline["results"], args.tolerance)
+        output["regressions"] = regressions
+
+    with open(args.output_path, "w") as fp:
+        json.dump(output, fp, indent=4)
+
+    logger.info(f"Results written to {args.output_path}")
+
+    if args.baseline is not None and len(output["regressions"]) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "output_path", type=str,
+        help="Path of the JSON file to which to write the results"
+    )
+    parser.add_argument(
+        "--baseline", type=str, default=None,
+        help="""Results of an earlier run to compare against. Exits with a
+                nonzero status if any benchmark regressed"""
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=1.1,
+        help="""Ratio of median times to the baseline above which a
+                benchmark counts as a regression"""
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[64, 128, 256],
+        help="Residue counts at which to run each benchmark"
+    )
+    parser.add_argument(
+        "--filter", type=str, default="",
+        help="Regex selecting the benchmarks to run by name"
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=3,
+        help="Number of timed runs of each benchmark, after one warm-up run"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="Number of threads PyTorch may use"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0,
+    )
+
+    args = parser.parse_args()
+
+    main(args)
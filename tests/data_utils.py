@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 from random import randint
 import torch
 import numpy as np
 from scipy.spatial.transform import Rotation
 
+from openfold.data import mmcif_parsing
+from openfold.np import protein, residue_constants
 from tests.config import consts
 
 
@@ -142,3 +145,38 @@ def random_attention_inputs(batch_size, n_seq, n, no_heads, c_hidden, inf=1e9,
     biases = [mask_bias, z_bias]
 
     return q, kv, mask, biases
+
+
+def load_test_protein(file_id="1psm", chain_id="A"):
+    """
+        Loads the residues of a chain in tests/test_data/mmcifs whose atoms
+        are all resolved
+    """
+    path = os.path.join(
+        os.path.dirname(__file__), "test_data", "mmcifs", f"{file_id}.cif"
+    )
+    with open(path, "r") as fp:
+        mmcif_object = mmcif_parsing.parse(
+            file_id=file_id, mmcif_string=fp.read()
+        ).mmcif_object
+
+    positions, mask = mmcif_parsing.get_atom_coords(mmcif_object, chain_id)
+    aatype = np.array([
+        residue_constants.restype_order.get(r, residue_constants.restype_num)
+        for r in mmcif_object.chain_to_seqres[chain_id]
+    ])
+    resolved = np.flatnonzero(
+        (aatype < residue_constants.restype_num) &
+        np.all(
+            mask == residue_constants.STANDARD_ATOM_MASK[aatype], axis=-1
+        )
+    )
+
+    return protein.Protein(
+        atom_positions=positions[resolved],
+        aatype=aatype[resolved],
+        atom_mask=mask[resolved],
+        residue_index=resolved + 1,
+        b_factors=np.zeros_like(mask[resolved]),
+        chain_index=np.zeros_like(resolved),
+    )
@@ -0,0 +1,165 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from openfold.data.data_pipeline import AlignmentRunner
+from openfold.data.tools.utils import run_task_graph
+
+
+SEARCH_TIME = 0.2
+
+
+class FakeMsaRunner:
+    """ Sleeps instead of searching, tracking how many searches overlap """
+    def __init__(self, state, name, fmt):
+        self.state = state
+        self.name = name
+        self.fmt = fmt
+        self.databases = [name]
+
+    def query(self, fasta_path, max_sequences=None):
+        with self.state["lock"]:
+            self.state["active"] += 1
+            self.state["max_active"] = max(
+                self.state["max_active"], self.state["active"]
+            )
+        time.sleep(SEARCH_TIME)
+        with self.state["lock"]:
+            self.state["active"] -= 1
+            self.state["finished"].append(self.name)
+
+        msa = "# STOCKHOLM 1.0\n\nquery ACDE\n#=GC RF xxxx\n//\n"
+        if self.fmt == "a3m":
+            msa = ">query\nACDE\n"
+        return [{self.fmt: msa}]
+
+
+class FakeTemplateSearcher:
+    input_format = "sto"
+
+    def __init__(self, state):
+        self.state = state
+
+    def query(self, msa, output_dir=None):
+        self.state["template_search_saw"] = list(self.state["finished"])
+        return ""
+
+
+class TestAlignmentRunner(unittest.TestCase):
+    def _make_runner(self, state, **kwargs):
+        runner = AlignmentRunner(no_cpus=10, **kwargs)
+        runner.jackhmmer_uniref90_runner = FakeMsaRunner(
+            state, "uniref90", "sto"
+        )
+        runner.jackhmmer_mgnify_runner = FakeMsaRunner(state, "mgnify", "sto")
+        runner.hhblits_bfd_unirefclust_runner = FakeMsaRunner(
+            state, "bfd_uniref30", "a3m"
+        )
+        runner.jackhmmer_uniprot_runner = FakeMsaRunner(
+            state, "uniprot", "sto"
+        )
+        runner.use_small_bfd = False
+        runner.template_searcher = FakeTemplateSearcher(state)
+        runner._split_cpus(10)
+        return runner
+
+    def _run(self, **kwargs):
+        state = {
+            "lock": threading.Lock(),
+            "active": 0,
+            "max_active": 0,
+            "finished": [],
+        }
+        runner = self._make_runner(state, **kwargs)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            t = time.perf_counter()
+            timings = runner.run(os.path.join(tmp_dir, "query.fasta"), tmp_dir)
+            wall = time.perf_counter() - t
+            outputs = set(os.listdir(tmp_dir))
+
+        return runner, state, timings, wall, outputs
+
+    def test_concurrent_searches(self):
+        runner, state, timings, wall, outputs = self._run()
+
+        self.assertEqual(state["max_active"], 4)
+        self.assertLess(wall, 3 * SEARCH_TIME)
+        self.assertIn("uniref90", state["template_search_saw"])
+        self.assertEqual(
+            set(timings.keys()),
+            {
+                "jackhmmer_uniref90",
+                "template_search",
+                "jackhmmer_mgnify",
+                "hhblits_bfd",
+                "jackhmmer_uniprot",
+            }
+        )
+        self.assertEqual(
+            outputs,
+            {
+                "uniref90_hits.sto",
+                "mgnify_hits.sto",
+                "bfd_uniref_hits.a3m",
+                "uniprot_hits.sto",
+            }
+        )
+
+        # 10 CPUs between 4 searches, with the leftovers going to uniref90
+        n_cpus = [r.n_cpu for r in runner._msa_runners()]
+        self.assertEqual(n_cpus, [4, 2, 2, 2])
+
+    def test_sequential_searches(self):
+        runner, state, _, _, _ = self._run(max_concurrent_searches=1)
+        self.assertEqual(state["max_active"], 1)
+        self.assertTrue(all(r.n_cpu == 10 for r in runner._msa_runners()))
+
+    def test_split_cpus_counts_used_runners(self):
+        state = {"lock": threading.Lock(), "finished": []}
+        runner = self._make_runner(state)
+
+        # Only one of the two BFD searches runs
+        runner.jackhmmer_small_bfd_runner = FakeMsaRunner(
+            state, "small_bfd", "sto"
+        )
+        runner._split_cpus(10)
+        self.assertEqual(
+            [r.n_cpu for r in runner._msa_runners()], [4, 2, 2, 2]
+        )
+
+        runner.use_small_bfd = True
+        runner._split_cpus(10)
+        runners = runner._msa_runners()
+        self.assertIn(runner.jackhmmer_small_bfd_runner, runners)
+        self.assertNotIn(runner.hhblits_bfd_unirefclust_runner, runners)
+        self.assertEqual([r.n_cpu for r in runners], [4, 2, 2, 2])
+
+    def test_task_graph_errors(self):
+        with self.assertRaises(ValueError):
+            run_task_graph({"a": (lambda b: b, ["b"]), "b": (lambda a: a, ["a"])})
+
+        def fail():
+            raise RuntimeError("search failed")
+
+        with self.assertRaises(RuntimeError):
+            run_task_graph({"a": (fail, []), "b": (lambda a: a, ["a"])})
+
+
+if __name__ == "__main__":
+    unittest.main()
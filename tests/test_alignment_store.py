@@ -0,0 +1,101 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from openfold.data.alignment_store import (
+    AlignmentMapWriter,
+    link_alignment_dir,
+    list_alignment_names,
+    resolve_alignment_dir,
+    sequence_hash,
+    store_alignments,
+)
+
+
+def fake_alignments(alignment_dir):
+    with open(os.path.join(alignment_dir, "uniref90_hits.sto"), "w") as fp:
+        fp.write("# STOCKHOLM 1.0\n//\n")
+
+
+class TestAlignmentStore(unittest.TestCase):
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, "1abc_A"))
+
+            calls = []
+            def run_alignments(alignment_dir):
+                calls.append(alignment_dir)
+                fake_alignments(alignment_dir)
+
+            writer = AlignmentMapWriter(tmp_dir)
+            key = store_alignments(tmp_dir, "ACDE", run_alignments)
+            writer.add(["1xyz_A", "1xyz_B"], key)
+
+            # The same sequence isn't aligned twice
+            self.assertEqual(
+                store_alignments(tmp_dir, "acde", run_alignments), key
+            )
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(key, sequence_hash("ACDE"))
+
+            self.assertEqual(
+                sorted(list_alignment_names(tmp_dir)),
+                ["1abc_A", "1xyz_A", "1xyz_B"],
+            )
+            for name in ["1xyz_A", "1xyz_B"]:
+                self.assertEqual(
+                    resolve_alignment_dir(tmp_dir, name),
+                    os.path.join(tmp_dir, key),
+                )
+            self.assertEqual(
+                resolve_alignment_dir(tmp_dir, "1abc_A"),
+                os.path.join(tmp_dir, "1abc_A"),
+            )
+            self.assertTrue(os.path.exists(
+                os.path.join(tmp_dir, key, "uniref90_hits.sto")
+            ))
+
+    def test_failed_alignments_leave_nothing(self):
+        def fail(alignment_dir):
+            fake_alignments(alignment_dir)
+            raise RuntimeError("jackhmmer failed")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(RuntimeError):
+                store_alignments(tmp_dir, "ACDE", fail)
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+    def test_link_alignment_dir(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, "1abc_A")
+            os.makedirs(src)
+            fake_alignments(src)
+            src_file = os.path.join(src, "uniref90_hits.sto")
+
+            for mode in ["copy", "hardlink", "symlink"]:
+                dst = os.path.join(tmp_dir, f"1abc_{mode}")
+                link_alignment_dir(src, dst, mode=mode)
+                dst_file = os.path.join(dst, "uniref90_hits.sto")
+                with open(dst_file) as fp:
+                    self.assertEqual(fp.read(), "# STOCKHOLM 1.0\n//\n")
+                self.assertEqual(
+                    os.path.samefile(src_file, dst_file), mode != "copy"
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import importlib.util
+import io
+import os
+import unittest
+
+import numpy as np
+
+from tests.data_utils import load_test_protein
+
+openmm_is_installed = importlib.util.find_spec("openmm") is not None
+if openmm_is_installed:
+    from openmm import app as openmm_app
+    from openmm import unit
+    from openfold.np.relax import amber_minimize
+
+stereo_chemical_props_path = os.path.join(
+    os.path.dirname(__file__), "..", "openfold", "resources",
+    "stereo_chemical_props.txt",
+)
+
+
+@unittest.skipUnless(openmm_is_installed, "Requires OpenMM")
+class TestAmberMinimize(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.prot = load_test_protein()
+        cls.pdb_str = amber_minimize.clean_protein(cls.prot)
+        cls.minimize_kwargs = {
+            "max_iterations": 0,
+            "tolerance": 2.39,
+            "stiffness": 10.,
+            "restraint_set": "non_hydrogen",
+            "max_attempts": 1,
+            "use_gpu": False,
+        }
+
+    def _minimizer(self, frozen_residues=()):
+        return amber_minimize.RestrainedMinimizer(
+            self.pdb_str,
+            stiffness=(
+                self.minimize_kwargs["stiffness"] *
+                amber_minimize.ENERGY / (amber_minimize.LENGTH ** 2)
+            ),
+            restraint_set=self.minimize_kwargs["restraint_set"],
+            use_gpu=False,
+            frozen_residues=frozen_residues,
+        )
+
+    def test_freeze_residues(self):
+        pdb = openmm_app.PDBFile(io.StringIO(self.pdb_str))
+        system = amber_minimize._get_force_field().createSystem(
+            pdb.topology, constraints=openmm_app.HBonds
+        )
+        no_constraints = system.getNumConstraints()
+
+        frozen_residues = {0, 1, 2}
+        amber_minimize._freeze_residues(system, pdb.topology, frozen_residues)
+
+        def mass(i):
+            return system.getParticleMass(i).value_in_unit(unit.dalton)
+
+        for atom in pdb.topology.atoms():
+            self.assertEqual(
+                mass(atom.index) == 0., atom.residue.index in frozen_residues
+            )
+
+        # Constraints between two massless particles are removed, and only
+        # those
+        constraints = [
+            system.getConstraintParameters(i)[:2]
+            for i in range(system.getNumConstraints())
+        ]
+        self.assertLess(len(constraints), no_constraints)
+        self.assertTrue(
+            all(mass(p1) > 0. or mass(p2) > 0. for p1, p2 in constraints)
+        )
+
+    def test_frozen_residues_stay_in_place(self):
+        minimizer = self._minimizer(frozen_residues={0, 1, 2})
+        out = amber_minimize._run_one_iteration(
+            pdb_string=None, minimizer=minimizer, **self.minimize_kwargs
+        )
+
+        frozen = np.array([
+            atom.residue.index in {0, 1, 2}
+            for atom in minimizer.topology.atoms()
+        ])
+        np.testing.assert_allclose(
+            out["pos"][frozen], out["posinit"][frozen], atol=1e-6
+        )
+        self.assertGreater(
+            np.max(np.abs(out["pos"][~frozen] - out["posinit"][~frozen])),
+            1e-3,
+        )
+
+    def test_reuse_system(self):
+        ref = amber_minimize._run_one_iteration(
+            pdb_string=self.pdb_str,
+            exclude_residues=[3],
+            **self.minimize_kwargs,
+        )
+
+        minimizer = self._minimizer()
+        out = amber_minimize._run_one_iteration(
+            pdb_string=None,
+            minimizer=minimizer,
+            exclude_residues=[3],
+            **self.minimize_kwargs,
+        )
+        np.testing.assert_allclose(out["pos"], ref["pos"], atol=1e-3)
+        self.assertAlmostEqual(out["efinal"], ref["efinal"], places=2)
+
+        # The next iteration starts from the minimized positions
+        out_2 = amber_minimize._run_one_iteration(
+            pdb_string=None,
+            minimizer=minimizer,
+            exclude_residues=[3, 10],
+            **self.minimize_kwargs,
+        )
+        np.testing.assert_allclose(out_2["posinit"], out["pos"], atol=1e-6)
+        self.assertLessEqual(out_2["efinal"], out_2["einit"])
+
+    def test_residues_near_violations(self):
+        prot = self.prot
+        n_res = prot.aatype.shape[0]
+        rng = np.random.RandomState(0)
+        violation_mask = np.zeros(n_res, dtype=bool)
+        violation_mask[rng.choice(n_res, 3, replace=False)] = True
+
+        # Brute force over all pairs of atoms
+        atom_mask = prot.atom_mask > 0.5
+        d = np.linalg.norm(
+            prot.atom_positions[:, None, :, None] -
+            prot.atom_positions[None, :, None, :],
+            axis=-1,
+        )
+        pair_mask = (
+            atom_mask[:, None, :, None] & atom_mask[None, :, None, :]
+        )
+
+        for radius in [0., 4., 8.]:
+            near = np.any((d < radius) & pair_mask, axis=(-1, -2))
+            expected = np.flatnonzero(
+                np.any(near[:, violation_mask], axis=-1) | violation_mask
+            )
+
+            # Blocks much smaller than the number of violating atoms
+            for block_size in [1, 7, 1000]:
+                np.testing.assert_array_equal(
+                    amber_minimize.residues_near_violations(
+                        prot, violation_mask, radius, block_size=block_size
+                    ),
+                    expected,
+                )
+
+        np.testing.assert_array_equal(
+            amber_minimize.residues_near_violations(
+                prot, np.zeros(n_res, dtype=bool), 8.
+            ),
+            [],
+        )
+
+    @unittest.skipUnless(
+        os.path.exists(stereo_chemical_props_path),
+        "Requires stereo_chemical_props.txt",
+    )
+    def test_run_pipeline_reuse_system(self):
+        outs = [
+            amber_minimize.run_pipeline(
+                self.prot,
+                stiffness=10.,
+                use_gpu=False,
+                max_outer_iterations=1,
+                reuse_system=reuse_system,
+            )
+            for reuse_system in [False, True]
+        ]
+        np.testing.assert_allclose(outs[1]["pos"], outs[0]["pos"], atol=1e-3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+import unittest
+
+from openfold.config import NUM_RES, NUM_MSA_SEQ
+from openfold.utils.batch_utils import (
+    bucket_targets,
+    pad_features_num_res,
+    stack_features,
+    unbatch_outputs,
+)
+from openfold.utils.loss import compute_tm
+
+
+class TestBatchUtils(unittest.TestCase):
+    def test_bucket_targets(self):
+        lengths = [10, 45, 60, 20, 55, 30]
+        batches = bucket_targets(lengths, 2, lambda l: (l + 49) // 50 * 50)
+        self.assertEqual(batches, [[0, 1], [3, 5], [2, 4]])
+
+    def test_pad_and_stack(self):
+        schema = {
+            "aatype": [NUM_RES],
+            "msa_feat": [NUM_MSA_SEQ, NUM_RES, None],
+            "seq_length": [],
+        }
+        no_recycling = 2
+        feats = []
+        for n in [7, 11]:
+            feats.append({
+                "aatype": torch.ones(n, no_recycling),
+                "msa_feat": torch.ones(5, n, 3, no_recycling),
+                "seq_length": torch.full((no_recycling,), n),
+            })
+
+        padded = [pad_features_num_res(f, 16, schema) for f in feats]
+        batch = stack_features(padded)
+
+        self.assertEqual(batch["aatype"].shape, (2, 16, no_recycling))
+        self.assertEqual(batch["msa_feat"].shape, (2, 5, 16, 3, no_recycling))
+        self.assertEqual(batch["aatype"][0, 7:].sum().item(), 0)
+        self.assertEqual(batch["aatype"][1, :11].sum().item(), 11 * 2)
+        self.assertEqual(batch["seq_length"][:, 0].tolist(), [7, 11])
+
+    def test_unbatch_outputs(self):
+        no_blocks, n, no_bins = 3, 16, 64
+        tm_config = {
+            "enabled": True,
+            "max_bin": 31,
+            "no_bins": no_bins,
+        }
+        out = {
+            "sm": {
+                "positions": torch.rand(no_blocks, 2, n, 14, 3),
+                "single": torch.rand(2, n, 8),
+            },
+            "final_atom_positions": torch.rand(2, n, 37, 3),
+            "tm_logits": torch.rand(2, n, n, no_bins),
+            "num_recycles": torch.tensor(3),
+        }
+
+        target_out = unbatch_outputs(out, 1, 10, tm_config)
+
+        self.assertEqual(
+            target_out["sm"]["positions"].shape, (no_blocks, 10, 14, 3)
+        )
+        self.assertEqual(target_out["sm"]["single"].shape, (10, 8))
+        self.assertTrue(torch.equal(
+            target_out["final_atom_positions"],
+            out["final_atom_positions"][1, :10],
+        ))
+        self.assertEqual(target_out["num_recycles"].item(), 3)
+        self.assertEqual(
+            target_out["predicted_aligned_error"].shape, (10, 10)
+        )
+        expected_ptm = compute_tm(out["tm_logits"][1, :10, :10], **tm_config)
+        self.assertTrue(torch.allclose(target_out["ptm_score"], expected_ptm))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import torch
+import torch.nn as nn
+import unittest
+
+from openfold.config import model_config
+from openfold.utils.cpu_utils import keep_fp32_, parse_core_list
+
+
+class DTypeRecorder(nn.Module):
+    def forward(self, x, extra):
+        self.dtype = x["single"].dtype
+        return torch.matmul(x["single"], x["single"].transpose(-1, -2))
+
+
+class TestCpuUtils(unittest.TestCase):
+    def test_parse_core_list(self):
+        self.assertEqual(parse_core_list("0-3,8, 10-11"), [0, 1, 2, 3, 8, 10, 11])
+
+    def test_keep_fp32(self):
+        model = argparse.Namespace(
+            structure_module=DTypeRecorder(), aux_heads=DTypeRecorder(),
+        )
+        keep_fp32_(model)
+
+        x = {"single": torch.rand(4, 8, dtype=torch.bfloat16)}
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            out = model.structure_module(x, None)
+
+        self.assertEqual(model.structure_module.dtype, torch.float32)
+        self.assertEqual(out.dtype, torch.float32)
+
+    def test_cpu_inference_config(self):
+        c = model_config(
+            "model_1",
+            use_deepspeed_evoformer_attention=True,
+            cpu_inference=True,
+        )
+        self.assertFalse(c.globals.use_deepspeed_evo_attention)
+        self.assertFalse(c.model.evoformer_stack.tune_chunk_size)
+        self.assertIsNotNone(c.globals.chunk_size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+
+import numpy as np
+
+from openfold.data.data_pipeline import (
+    CustomTemplateDataPipeline,
+    make_sequence_features_with_custom_template,
+)
+from openfold.data.templates import (
+    CustomTemplateFeaturizer,
+    QueryToTemplateAlignError,
+)
+
+
+MMCIF_PATH = os.path.join(
+    os.path.dirname(__file__), "test_data", "mmcifs", "2crb.cif"
+)
+SEQUENCE = (
+    "GSSGSSGMEGPLNLAHQQSRRADRLLAAGKYEEAISCHRKATTYLSEAMKLTESEQAHLSLELQRDSHMK"
+    "QLLLIQERWKRAKREERLKAHSGPSSG"
+)
+
+
+def mutate(seq, mutations):
+    seq = list(seq)
+    for i, aa in mutations:
+        seq[i] = aa
+    return "".join(seq)
+
+
+class TestCustomTemplate(unittest.TestCase):
+    def make_features(self, seq):
+        return make_sequence_features_with_custom_template(
+            seq, MMCIF_PATH, "2crb", "A", "kalign",
+        )
+
+    def assertFeaturesEqual(self, feats, ref):
+        self.assertEqual(sorted(feats), sorted(ref))
+        for k in ref:
+            self.assertEqual(feats[k].dtype, ref[k].dtype, k)
+            np.testing.assert_array_equal(feats[k], ref[k], err_msg=k)
+
+    def test_template_features(self):
+        feats = self.make_features(SEQUENCE)
+        self.assertEqual(feats["template_aatype"].shape[:2], (1, len(SEQUENCE)))
+        self.assertEqual(feats["template_sequence"][0], SEQUENCE.encode())
+
+        short = self.make_features(SEQUENCE[:40])
+        np.testing.assert_array_equal(
+            short["template_all_atom_positions"],
+            feats["template_all_atom_positions"][:, :40],
+        )
+
+        featurizer = CustomTemplateFeaturizer(MMCIF_PATH, "2crb", "A")
+        with self.assertRaises(QueryToTemplateAlignError):
+            featurizer.get_features(SEQUENCE + "A")
+
+    def test_incremental_features(self):
+        data_pipeline = CustomTemplateDataPipeline(
+            CustomTemplateFeaturizer(MMCIF_PATH, "2crb", "A")
+        )
+
+        variants = [
+            SEQUENCE,
+            mutate(SEQUENCE, [(5, "W")]),
+            mutate(SEQUENCE, [(5, "W"), (50, "X"), (96, "C")]),
+            SEQUENCE[:60],
+            mutate(SEQUENCE, [(0, "Y")]),
+            SEQUENCE,
+        ]
+        feats = [data_pipeline.process_sequence(v) for v in variants]
+        for v, f in zip(variants, feats):
+            self.assertFeaturesEqual(f, self.make_features(v))
+
+        # Variants of the same length share the template features
+        self.assertIs(
+            feats[0]["template_all_atom_positions"],
+            feats[2]["template_all_atom_positions"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
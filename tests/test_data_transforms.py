@@ -7,8 +7,9 @@ import unittest
 
 from openfold.data.data_transforms import make_seq_mask, add_distillation_flag, make_all_atom_aatype, fix_templates_aatype, \
     correct_msa_restypes, squeeze_features, randomly_replace_msa_with_unknown, MSA_FEATURE_NAMES, sample_msa, \
-    crop_extra_msa, delete_extra_msa, nearest_neighbor_clusters, make_msa_mask, make_hhblits_profile, make_masked_msa, \
+    crop_extra_msa, delete_extra_msa, nearest_neighbor_clusters, summarize_clusters, make_msa_mask, make_hhblits_profile, make_masked_msa, \
     make_msa_feat, crop_templates, make_atom14_masks
+from openfold.data.input_pipeline import LazyRecyclingBatch
 from tests.config import config
 
 
@@ -148,6 +149,36 @@ class TestDataTransforms(unittest.TestCase):
         protein = nearest_neighbor_clusters.__wrapped__(protein, 0)
         assert 'extra_cluster_assignment' in protein
 
+    def test_nearest_neighbor_clusters_chunked(self):
+        with gzip.open('tests/test_data/sample_feats.pickle.gz', 'rb') as f:
+            features = pickle.load(f)
+
+        def get_protein():
+            extra_msa = torch.tensor(features['extra_msa'][0], dtype=torch.int64)
+            return {
+                'msa': torch.tensor(features['true_msa'][0], dtype=torch.int64),
+                'msa_mask': torch.tensor(features['msa_mask'][0], dtype=torch.float32),
+                'deletion_matrix': torch.zeros(features['true_msa'][0].shape),
+                'extra_msa': extra_msa,
+                'extra_msa_mask': torch.tensor(features['extra_msa_mask'][0], dtype=torch.float32),
+                'extra_deletion_matrix': torch.randint(0, 3, extra_msa.shape).float(),
+            }
+
+        protein = get_protein()
+        protein_chunked = {k: v.clone() for k, v in protein.items()}
+
+        protein = nearest_neighbor_clusters.__wrapped__(protein, 0, None)
+        protein = summarize_clusters.__wrapped__(protein, None)
+        protein_chunked = nearest_neighbor_clusters.__wrapped__(protein_chunked, 0, 7)
+        protein_chunked = summarize_clusters.__wrapped__(protein_chunked, 7)
+
+        assert torch.equal(
+            protein['extra_cluster_assignment'], 
+            protein_chunked['extra_cluster_assignment'],
+        )
+        for k in ['cluster_profile', 'cluster_deletion_mean']:
+            assert torch.allclose(protein[k], protein_chunked[k])
+
     def test_make_msa_mask(self):
         with open('tests/test_data/features.pkl', 'rb') as file:
             features = pickle.load(file)
@@ -221,6 +252,34 @@ class TestDataTransforms(unittest.TestCase):
         assert 'residx_atom37_to_atom14' in protein
         assert 'atom37_atom_exists' in protein
 
+    def test_lazy_recycling_batch(self):
+        with open('tests/test_data/features.pkl', 'rb') as file:
+            features = pickle.load(file)
+
+        def ensemble_fn(tensors, cycle_no):
+            protein = {'msa': tensors['msa'].clone()}
+            return sample_msa.__wrapped__(protein, 8, keep_extra=True)
+
+        tensors = {'msa': torch.tensor(features['msa'], dtype=torch.int64)}
+        batch = LazyRecyclingBatch(tensors, ensemble_fn, no_cycles=4, seed=42)
+        batch.static_feats['use_clamped_fape'] = torch.tensor(0.)
+
+        assert len(batch) == 4
+        assert 'extra_msa' in batch
+        assert 'use_clamped_fape' in batch
+
+        first = batch.get_cycle(1)
+        assert batch.get_cycle(1) is first
+        assert first['msa'].shape == torch.Size((8, tensors['msa'].shape[1]))
+
+        # Regenerating an iteration must reproduce it exactly
+        batch.get_cycle(2)
+        assert torch.all(torch.eq(batch.get_cycle(1)['msa'], first['msa']))
+        assert torch.all(torch.eq(batch.last()['msa'], batch.get_cycle(3)['msa']))
+
+        with self.assertRaises(IndexError):
+            batch.get_cycle(4)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,163 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from openfold.config import model_config
+from openfold.data import data_pipeline, feature_pipeline
+from openfold.np import protein, residue_constants
+from openfold.utils.decoy_ranking import (
+    Decoy,
+    DecoyRanker,
+    decoy_template_features,
+)
+
+
+SEQUENCE = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTEN"
+
+
+def make_protein(seq, residue_index, seed=0):
+    rng = np.random.RandomState(seed)
+    n = len(seq)
+    ca = np.cumsum(rng.randn(n, 3), axis=0) * 2.
+    atom_mask = np.array([
+        residue_constants.STANDARD_ATOM_MASK[residue_constants.restype_order[a]]
+        for a in seq
+    ])
+    atom_positions = ca[:, None] + rng.randn(n, 37, 3) * atom_mask[..., None]
+    return protein.Protein(
+        atom_positions=atom_positions,
+        aatype=np.array([residue_constants.restype_order[a] for a in seq]),
+        atom_mask=atom_mask,
+        residue_index=np.array(residue_index),
+        b_factors=np.zeros_like(atom_mask),
+    )
+
+
+class TemplateCopier(torch.nn.Module):
+    """ Predicts the template's atom positions """
+    def __init__(self, config):
+        super().__init__()
+        self.config = config
+
+    def forward(self, batch):
+        pos = batch["template_all_atom_positions"][:, 0, ..., -1]
+        mask = batch["atom37_atom_exists"][..., -1]
+        return {
+            "final_atom_positions": pos,
+            "final_atom_mask": mask,
+            "plddt": torch.full(mask.shape[:-1], 80.),
+        }
+
+
+class TestDecoyRanking(unittest.TestCase):
+    def setUp(self):
+        self.config = model_config(
+            "model_1", use_deepspeed_evoformer_attention=False
+        )
+        self.feature_dict = {
+            **data_pipeline.make_sequence_features(
+                SEQUENCE, "target", len(SEQUENCE)
+            ),
+            **data_pipeline.make_dummy_msa_feats(SEQUENCE),
+        }
+        self.native = make_protein(SEQUENCE, range(1, len(SEQUENCE) + 1))
+
+    def test_template_features(self):
+        n = len(SEQUENCE)
+        feats, mismatch = decoy_template_features(SEQUENCE, self.native)
+        self.assertFalse(mismatch)
+        np.testing.assert_allclose(
+            feats["template_all_atom_positions"][0], self.native.atom_positions,
+            rtol=1e-6,
+        )
+
+        # A decoy missing residues 10-19
+        idx = list(range(10)) + list(range(20, n))
+        partial = make_protein(
+            "".join(SEQUENCE[i] for i in idx), [i + 1 for i in idx]
+        )
+        feats, mismatch = decoy_template_features(
+            SEQUENCE, partial, add_cb=True
+        )
+        self.assertTrue(mismatch)
+        mask = feats["template_all_atom_mask"][0]
+        self.assertEqual(mask[10:20].sum(), 0)
+        self.assertEqual(mask[:, 5:].sum(), 0)
+        # Glycines get a C-beta
+        gly = [i for i in idx if SEQUENCE[i] == "G"]
+        self.assertTrue(np.all(mask[gly, 3] == 1))
+
+        with self.assertRaises(ValueError):
+            decoy_template_features(SEQUENCE[::-1], self.native)
+
+    def test_rank(self):
+        model = TemplateCopier(self.config.model)
+        ranker = DecoyRanker(
+            model,
+            feature_pipeline.FeaturePipeline(self.config.data),
+            self.feature_dict,
+            native=self.native,
+            batch_size=2,
+        )
+
+        decoys = [Decoy("none.pdb", None), Decoy("native.pdb", self.native)]
+        decoys += [
+            Decoy(f"{i}.pdb", make_protein(SEQUENCE, self.native.residue_index, i))
+            for i in range(1, 4)
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results_path = os.path.join(tmp_dir, "results.jsonl")
+            results = list(ranker.rank(decoys[:3], results_path=results_path))
+            self.assertEqual(
+                [r["decoy_id"] for r in results],
+                ["none.pdb", "native.pdb", "1.pdb"],
+            )
+
+            native = results[1]
+            self.assertAlmostEqual(native["tm_decoy"], 1., places=4)
+            self.assertAlmostEqual(native["tm_native"], 1., places=4)
+            self.assertAlmostEqual(native["rmsd_native"], 0., places=2)
+            self.assertAlmostEqual(native["gdt_ts_native"], 1., places=4)
+            self.assertAlmostEqual(native["lddt_native"], 1., places=4)
+            self.assertAlmostEqual(native["plddt"], 80., places=4)
+            self.assertEqual(results[0]["tm_decoy"], -1)
+            self.assertLess(results[2]["tm_native"], 0.5)
+            self.assertIsInstance(results[2]["protein"], protein.Protein)
+
+            # A partially written result is discarded
+            with open(results_path, "a") as fp:
+                fp.write('{"decoy_id": "2.pdb"')
+
+            resumed = list(ranker.rank(decoys, results_path=results_path))
+            self.assertEqual(
+                [r["decoy_id"] for r in resumed], [d.decoy_id for d in decoys]
+            )
+            self.assertNotIn("protein", resumed[1])
+            self.assertIn("protein", resumed[3])
+
+            with open(results_path, "r") as fp:
+                ids = [json.loads(l)["decoy_id"] for l in fp]
+            self.assertEqual(ids, [d.decoy_id for d in decoys])
+
+
+if __name__ == "__main__":
+    unittest.main()
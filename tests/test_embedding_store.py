@@ -0,0 +1,69 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import torch
+
+from openfold.data.data_pipeline import DataPipeline
+from openfold.data.embedding_store import EmbeddingStore
+
+
+class TestEmbeddingStore(unittest.TestCase):
+    def test_add_and_get(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = EmbeddingStore(tmp_dir)
+            seqs = ["ACDE", "FGHIKL", "ACDE"]
+            embs = [torch.rand(len(s), 8) for s in seqs]
+            writer.add(seqs, embs)
+            self.assertEqual(len(writer), 2)
+
+            reader = EmbeddingStore(tmp_dir)
+            for seq, emb in zip(seqs[:2], embs[:2]):
+                stored = reader.get(seq)
+                self.assertEqual(stored.dtype, torch.float16)
+                self.assertTrue(torch.equal(stored, emb.half()))
+
+            self.assertEqual(reader.missing(["ACDE", "MNP", "MNP"]), ["MNP"])
+
+            # The reader picks up embeddings appended after it mapped the
+            # store
+            new_emb = torch.rand(3, 8)
+            writer.add(["MNP"], [new_emb])
+            self.assertTrue(torch.equal(reader.get("MNP"), new_emb.half()))
+
+            with self.assertRaises(ValueError):
+                writer.add(["QRS"], [torch.rand(3, 4)])
+
+            with self.assertRaises(KeyError):
+                reader.get("QRS")
+
+    def test_pipeline_loads_from_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = EmbeddingStore(os.path.join(tmp_dir, "store"))
+            emb = torch.rand(4, 8)
+            store.add(["ACDE"], [emb])
+
+            data_pipeline = DataPipeline(
+                template_featurizer=None, embedding_store=store,
+            )
+            feats = data_pipeline._process_seqemb_features(tmp_dir, "ACDE")
+            self.assertEqual(feats["seq_embedding"].dtype, torch.float32)
+            self.assertTrue(torch.equal(feats["seq_embedding"], emb.half().float()))
+
+
+if __name__ == "__main__":
+    unittest.main()
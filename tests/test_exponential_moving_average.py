@@ -0,0 +1,83 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+import torch
+import torch.nn as nn
+
+from openfold.utils.exponential_moving_average import ExponentialMovingAverage
+
+
+class TestExponentialMovingAverage(unittest.TestCase):
+    def _model(self):
+        model = nn.Sequential(nn.Linear(4, 4), nn.LayerNorm(4))
+        model.register_buffer("step", torch.zeros(3))
+        return model
+
+    def test_swap(self):
+        model = self._model()
+        ema = ExponentialMovingAverage(model, decay=0.5)
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(1.)
+        ema.update(model)
+
+        weights = {k: v.clone() for k, v in model.state_dict().items()}
+        averages = {k: v.clone() for k, v in ema.state_dict()["params"].items()}
+        param_ids = [id(p) for p in model.parameters()]
+
+        ema.swap(model)
+        for k, v in model.state_dict().items():
+            self.assertTrue(torch.equal(v, averages[k]))
+        # The EMA state still holds the averages while they're swapped out
+        for k, v in ema.state_dict()["params"].items():
+            self.assertTrue(torch.equal(v, averages[k]))
+        self.assertEqual([id(p) for p in model.parameters()], param_ids)
+
+        ema.swap(model)
+        for k, v in model.state_dict().items():
+            self.assertTrue(torch.equal(v, weights[k]))
+        for k, v in ema.state_dict()["params"].items():
+            self.assertTrue(torch.equal(v, averages[k]))
+
+        # Updates after swapping back still reach the averages
+        ema.update(model)
+        for k, v in ema.state_dict()["params"].items():
+            self.assertTrue(torch.allclose(v, (averages[k] + weights[k]) / 2))
+
+    def test_swap_mixed_precision(self):
+        model = self._model()
+        ema = ExponentialMovingAverage(model, decay=0.5)
+        averages = {k: v.clone() for k, v in ema.state_dict()["params"].items()}
+        model.half()
+        weights = {k: v.clone() for k, v in model.state_dict().items()}
+
+        for _ in range(2):
+            ema.swap(model)
+            for k, v in model.state_dict().items():
+                self.assertEqual(v.dtype, torch.float16)
+                self.assertTrue(torch.equal(v, averages[k].half()))
+
+            ema.swap(model)
+            for k, v in model.state_dict().items():
+                self.assertTrue(torch.equal(v, weights[k]))
+            for k, v in ema.state_dict()["params"].items():
+                self.assertEqual(v.dtype, torch.float32)
+                self.assertTrue(torch.equal(v, averages[k]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from openfold.config import model_config
+from openfold.utils.memory_planner import (
+    GB,
+    MemoryPlanner,
+    TargetDims,
+    apply_plan,
+)
+
+
+class TestMemoryPlanner(unittest.TestCase):
+    def setUp(self):
+        self.config = model_config(
+            "model_1_ptm", use_deepspeed_evoformer_attention=False
+        )
+        self.planner = MemoryPlanner(self.config, device="cpu")
+
+    def test_small_target_is_unchunked(self):
+        dims = TargetDims(n_res=64, n_seq=128, n_extra=1024, n_templ=4)
+        plan = self.planner.plan(dims, 80 * GB)
+        self.assertTrue(plan.fits)
+        self.assertIsNone(plan.chunk_size)
+        self.assertFalse(plan.offload_inference)
+
+    def test_plan_fits_budget(self):
+        dims = TargetDims(n_res=1500, n_seq=512, n_extra=5120, n_templ=4)
+        unconstrained = self.planner.plan(dims, 10 ** 6 * GB)
+        budget = unconstrained.peak_bytes // 2
+        plan = self.planner.plan(dims, budget)
+        self.assertTrue(plan.fits)
+        self.assertLessEqual(plan.peak_bytes, plan.budget_bytes)
+        self.assertGreaterEqual(
+            plan.relative_runtime, unconstrained.relative_runtime
+        )
+
+    def test_estimates_grow_with_n_res(self):
+        small = TargetDims(n_res=100, n_seq=128, n_extra=1024, n_templ=4)
+        large = TargetDims(n_res=400, n_seq=128, n_extra=1024, n_templ=4)
+        for chunk_size in [None, 4]:
+            s = self.planner.estimate(small, chunk_size, "default", False, "fp32")
+            l = self.planner.estimate(large, chunk_size, "default", False, "fp32")
+            self.assertGreater(l["evoformer"], s["evoformer"])
+
+    def test_attention_export_forces_default_attention(self):
+        planner = MemoryPlanner(
+            self.config, device="cpu", doctor_exports=["attention"]
+        )
+        attention = set(c[1] for c in planner.candidates())
+        self.assertEqual(attention, {"default"})
+
+    def test_apply_plan(self):
+        dims = TargetDims(n_res=2000, n_seq=512, n_extra=5120, n_templ=4)
+        plan = self.planner.plan(dims, 4 * GB)
+        apply_plan(self.config, plan)
+        self.assertEqual(self.config.globals.chunk_size, plan.chunk_size)
+        self.assertEqual(
+            self.config.globals.use_lma, plan.attention == "lma"
+        )
+        self.assertEqual(
+            self.config.globals.offload_inference, plan.offload_inference
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from openfold.data import parsers
+from openfold.data.data_pipeline import DataPipeline, make_msa_features
+from openfold.data.msa_parsing import MsaParser
+
+
+A3M = """>query
+ACDEFGH
+>hit_1 description
+AC-aaEFGH
+>hit_2
+-CDEFcGH
+"""
+
+STO = """# STOCKHOLM 1.0
+
+#=GS query DE query
+query          ACD-EFGH
+hit_1/1-7      ACDKE-GH
+hit_2/2-8      -CD-EFGW
+//
+"""
+
+
+class TestMsaParsing(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.alignment_dir = self.tmp_dir.name
+        for name, msa in [
+            ("bfd_uniref_hits.a3m", A3M),
+            ("uniref90_hits.sto", STO),
+            ("mgnify_hits.sto", STO),
+            ("uniprot_hits.sto", STO),
+        ]:
+            with open(os.path.join(self.alignment_dir, name), "w") as fp:
+                fp.write(msa)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assertMsaEqual(self, msa, ref):
+        self.assertEqual(list(msa.sequences), list(ref.sequences))
+        self.assertEqual(list(msa.descriptions), list(ref.descriptions))
+        self.assertEqual(msa.deletion_matrix, ref.deletion_matrix)
+
+    def test_parser_matches_serial_parsing(self):
+        parser = MsaParser(2)
+        try:
+            a3m = parser.submit(
+                os.path.join(self.alignment_dir, "bfd_uniref_hits.a3m"), "a3m"
+            )
+            sto = parser.submit(
+                os.path.join(self.alignment_dir, "uniref90_hits.sto"), "sto"
+            )
+            self.assertMsaEqual(a3m.result(), parsers.parse_a3m(A3M))
+            self.assertMsaEqual(sto.result(), parsers.parse_stockholm(STO))
+        finally:
+            parser.shutdown()
+
+    def test_random_msas(self):
+        rng = np.random.RandomState(0)
+        upper = list("ACDEFGHIKLMNPQRSTVWY-")
+        lower = list("acdefghiklmnpqrstvwy")
+
+        a3m = []
+        sto = []
+        for i in range(50):
+            seq = rng.choice(upper, 30)
+            a3m_seq = "".join(
+                c + "".join(rng.choice(lower, rng.randint(3)))
+                if rng.rand() < 0.2 else c
+                for c in seq
+            )
+            a3m.append(f">seq_{i}\n{a3m_seq}")
+
+            # Columns 3 and 7 are gaps in the query
+            sto_seq = "".join(rng.choice(upper, 34))
+            if i == 0:
+                sto_seq = sto_seq[:3] + "-" + sto_seq[4:7] + "-" + sto_seq[8:]
+            sto.append(f"seq_{i} {sto_seq}")
+
+        a3m = "\n".join(a3m) + "\n"
+        sto = "# STOCKHOLM 1.0\n\n" + "\n".join(sto) + "\n//\n"
+        for name, msa in [("random.a3m", a3m), ("random.sto", sto)]:
+            with open(os.path.join(self.alignment_dir, name), "w") as fp:
+                fp.write(msa)
+
+        parser = MsaParser(2)
+        try:
+            self.assertMsaEqual(
+                parser.submit(
+                    os.path.join(self.alignment_dir, "random.a3m"), "a3m"
+                ).result(),
+                parsers.parse_a3m(a3m),
+            )
+            self.assertMsaEqual(
+                parser.submit(
+                    os.path.join(self.alignment_dir, "random.sto"), "sto"
+                ).result(),
+                parsers.parse_stockholm(sto),
+            )
+        finally:
+            parser.shutdown()
+
+    def test_alignment_db(self):
+        db_path = os.path.join(self.alignment_dir, "alignments.db")
+        with open(db_path, "wb") as fp:
+            fp.write(STO.encode("utf-8") + A3M.encode("utf-8"))
+
+        parser = MsaParser(2)
+        try:
+            msa = parser.submit(db_path, "a3m", len(STO), len(A3M)).result()
+            self.assertMsaEqual(msa, parsers.parse_a3m(A3M))
+        finally:
+            parser.shutdown()
+
+    def test_pipeline_features(self):
+        serial = DataPipeline(template_featurizer=None)
+        parallel = DataPipeline(template_featurizer=None, msa_parsing_workers=2)
+        try:
+            feats = [
+                make_msa_features(p._get_msas(self.alignment_dir))
+                for p in [serial, parallel]
+            ]
+        finally:
+            parallel.msa_parser.shutdown()
+
+        for k in ["msa", "deletion_matrix_int", "msa_species_identifiers"]:
+            np.testing.assert_array_equal(feats[0][k], feats[1][k])
+
+
+if __name__ == "__main__":
+    unittest.main()
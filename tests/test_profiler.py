@@ -0,0 +1,152 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import torch
+import torch.nn as nn
+import unittest
+
+from openfold.utils.profiler import (
+    Profiler,
+    profile_stage,
+    profiled,
+    set_profiler,
+    suspend_module_stages,
+)
+
+
+class ToyEvoformer(nn.Module):
+    def __init__(self, no_blocks):
+        super().__init__()
+        self.blocks = nn.ModuleList([nn.Linear(4, 4) for _ in range(no_blocks)])
+
+    def forward(self, x):
+        for b in self.blocks:
+            x = b(x)
+        return x
+
+
+class ToyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.input_embedder = nn.Linear(4, 4)
+        self.evoformer = ToyEvoformer(2)
+        self.aux_heads = nn.Linear(4, 1)
+
+    def forward(self, x):
+        return self.aux_heads(self.evoformer(self.input_embedder(x)))
+
+
+class TestProfiler(unittest.TestCase):
+    def test_disabled_profiler_is_noop(self):
+        set_profiler(None)
+        with profile_stage("noop"):
+            pass
+
+        @profiled("noop")
+        def f(x):
+            return x + 1
+
+        self.assertEqual(f(1), 2)
+
+    def test_model_stages(self):
+        model = ToyModel()
+        profiler = Profiler("cpu")
+        set_profiler(profiler)
+        try:
+            profiler.set_target("target")
+            profiler.attach(model)
+            with profile_stage("inference"):
+                model(torch.rand(3, 4))
+            profiler.detach()
+
+            # Hooks are gone after detaching
+            model(torch.rand(3, 4))
+        finally:
+            set_profiler(None)
+
+        events = profiler.events()
+        names = [e["name"] for e in events]
+        self.assertEqual(names, [
+            "inference",
+            "input_embedder",
+            "evoformer_block_0",
+            "evoformer_block_1",
+            "aux_heads",
+        ])
+        self.assertTrue(all(e["target"] == "target" for e in events))
+        self.assertEqual([e["depth"] for e in events], [0, 1, 1, 1, 1])
+
+        inference = events[0]
+        self.assertLessEqual(inference["self_wall"], inference["wall"])
+        self.assertAlmostEqual(
+            inference["wall"],
+            inference["self_wall"] + sum(e["wall"] for e in events[1:]),
+        )
+
+        summary = profiler.summary()
+        self.assertEqual(summary["evoformer_block_0"]["count"], 1)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace_path = os.path.join(tmp_dir, "trace.json")
+            profiler.write(trace_path)
+            with open(trace_path) as fp:
+                trace = json.load(fp)
+            self.assertEqual(len(trace["traceEvents"]), len(events))
+
+            jsonl_path = os.path.join(tmp_dir, "trace.jsonl")
+            profiler.write(jsonl_path)
+            with open(jsonl_path) as fp:
+                self.assertEqual(len(fp.readlines()), len(events))
+
+    def test_raising_module(self):
+        model = ToyModel()
+        profiler = Profiler("cpu")
+        set_profiler(profiler)
+        try:
+            profiler.attach(model)
+            block = model.evoformer.blocks[0]
+            with profile_stage("inference"):
+                # The stage of a module that raises, like a chunk size that
+                # runs out of memory, still ends
+                with self.assertRaises(RuntimeError):
+                    block(torch.rand(3, 5))
+
+                # Trial runs aren't recorded
+                with suspend_module_stages():
+                    with self.assertRaises(RuntimeError):
+                        block(torch.rand(3, 5))
+                    block(torch.rand(3, 4))
+
+                model(torch.rand(3, 4))
+            profiler.detach()
+        finally:
+            set_profiler(None)
+
+        events = profiler.events()
+        self.assertEqual([e["name"] for e in events], [
+            "inference",
+            "evoformer_block_0",
+            "input_embedder",
+            "evoformer_block_0",
+            "evoformer_block_1",
+            "aux_heads",
+        ])
+        self.assertEqual([e["depth"] for e in events], [0, 1, 1, 1, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import unittest
+from unittest import mock
+
+from openfold.np import protein, residue_constants
+
+
+def random_protein(n_res, n_chains=1):
+    aatype = np.random.randint(0, 20, (n_res,))
+    atom_mask = residue_constants.STANDARD_ATOM_MASK[aatype].astype(np.float32)
+    return protein.Protein(
+        atom_positions=(
+            np.random.randn(n_res, residue_constants.atom_type_num, 3) * 30
+        ).astype(np.float32),
+        aatype=aatype,
+        atom_mask=atom_mask,
+        residue_index=np.arange(n_res) + 1,
+        b_factors=(
+            np.random.rand(n_res, residue_constants.atom_type_num) * 100
+        ).astype(np.float32),
+        chain_index=np.sort(np.random.randint(0, n_chains, (n_res,))),
+        remark="test",
+    )
+
+
+class TestProtein(unittest.TestCase):
+    def test_format_fixed_width(self):
+        values = np.concatenate([
+            np.random.randn(1000) * 100,
+            [0., -0., 0.0005, -0.0005, 0.0015, 1.2345, -999.9994],
+        ]).astype(np.float32)
+        formatted = protein._format_fixed_width(values, 8, 3)
+        for v, f in zip(values, formatted):
+            self.assertEqual(f.tobytes().decode("ascii"), f"{v:>8.3f}")
+
+        ints = np.array([0, 7, -7, 12345, -1234])
+        formatted = protein._format_fixed_width(ints, 5)
+        for v, f in zip(ints, formatted):
+            self.assertEqual(f.tobytes().decode("ascii"), f"{v:>5}")
+
+        self.assertIsNone(protein._format_fixed_width(np.array([1e5]), 8, 3))
+
+    def test_to_pdb_round_trip(self):
+        prot = random_protein(50, n_chains=3)
+        pdb_str = protein.to_pdb(prot)
+
+        lines = pdb_str.split("\n")[:-1]
+        self.assertTrue(all(len(l) == 80 for l in lines))
+
+        atom_lines = [l for l in lines if l.startswith("ATOM")]
+        self.assertEqual(len(atom_lines), int(np.sum(prot.atom_mask)))
+
+        x = np.array([float(l[30:38]) for l in atom_lines])
+        expected = prot.atom_positions[prot.atom_mask > 0.5][:, 0]
+        self.assertTrue(np.allclose(x, expected, atol=1e-3))
+
+    def test_to_pdb_matches_per_atom_writer(self):
+        edge_values = np.array([
+            0., -0., 0.0004, -0.0004, 0.0005, -0.0005, 0.0015, -0.0015,
+            1.2345, -1.2345, 0.9995, -0.9995, 99.9995, -99.9995, 999.9994,
+            -999.9994,
+        ], dtype=np.float32)
+        edge_b_factors = np.array([
+            0., -0., 0.005, -0.005, 0.015, 99.995, 99.994, -9.995, 999.99,
+        ], dtype=np.float32)
+
+        for n_chains in [1, 2, 5]:
+            prot = random_protein(60, n_chains=n_chains)
+            positions = prot.atom_positions.reshape(-1)
+            idx = np.random.choice(positions.shape[0], 200, replace=False)
+            positions[idx] = np.random.choice(edge_values, 200)
+            b_factors = prot.b_factors.reshape(-1)
+            idx = np.random.choice(b_factors.shape[0], 200, replace=False)
+            b_factors[idx] = np.random.choice(edge_b_factors, 200)
+
+            vectorized = protein.to_pdb(prot)
+
+            # Records that don't fit their columns fall back to formatting
+            # one atom at a time
+            with mock.patch.object(
+                protein, "_pdb_atom_records", return_value=None
+            ):
+                per_atom = protein.to_pdb(prot)
+
+            self.assertEqual(vectorized, per_atom)
+
+    def test_to_mmcif_atom_site(self):
+        prot = random_protein(30, n_chains=2)
+        cif_str = protein.to_mmcif_atom_site(prot)
+
+        atom_lines = [l for l in cif_str.split("\n") if l.startswith("ATOM")]
+        self.assertEqual(len(atom_lines), int(np.sum(prot.atom_mask)))
+        no_fields = len([l for l in cif_str.split("\n") if l.startswith("_")])
+        self.assertTrue(all(len(l.split()) == no_fields for l in atom_lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
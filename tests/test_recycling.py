@@ -0,0 +1,96 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import torch
+import unittest
+
+from openfold.config import model_config
+from openfold.np import residue_constants
+from openfold.utils.recycling import RecyclingMonitor, ca_drmsd
+from openfold.utils.rigid_utils import Rotation
+from openfold.utils.superimposition import kabsch_rmsd, superimpose
+
+
+def random_rotation():
+    q = torch.randn(4)
+    return Rotation(quats=q / torch.linalg.norm(q), normalize_quats=False)
+
+
+class TestRecycling(unittest.TestCase):
+    def test_kabsch_rmsd(self):
+        n = 30
+        reference = torch.randn(2, n, 3) * 10
+        coords = reference + torch.randn(2, n, 3)
+        coords = random_rotation().apply(coords) + torch.randn(3)
+        mask = torch.ones(2, n)
+        mask[1, -5:] = 0
+
+        _, expected = superimpose(reference, coords, mask)
+        rmsd = kabsch_rmsd(reference, coords, mask)
+        self.assertTrue(torch.allclose(rmsd, expected.float(), atol=1e-4))
+
+    def test_ca_drmsd(self):
+        n = 40
+        prev_pos = torch.randn(n, 37, 3) * 10
+        next_pos = prev_pos + torch.randn(n, 37, 3)
+        mask = torch.ones(n)
+        mask[-3:] = 0
+
+        ca_idx = residue_constants.atom_order["CA"]
+        d_prev = torch.cdist(prev_pos[:, ca_idx], prev_pos[:, ca_idx])
+        d_next = torch.cdist(next_pos[:, ca_idx], next_pos[:, ca_idx])
+        pair_mask = mask[:, None] * mask[None, :]
+        expected = torch.sqrt(
+            torch.sum(pair_mask * (d_prev - d_next) ** 2) /
+            (torch.sum(pair_mask) + 1e-4)
+        )
+
+        drmsd = ca_drmsd(prev_pos, next_pos, mask, block_size=16)
+        self.assertTrue(torch.allclose(drmsd, expected, atol=1e-4))
+
+    def test_recycling_monitor(self):
+        c = model_config("model_1", use_deepspeed_evoformer_attention=False)
+        c.model.recycle_early_stop.ca_rmsd_tolerance = 0.1
+        c.model.recycle_early_stop.record_metrics = True
+        monitor = RecyclingMonitor(c.model)
+
+        n = 20
+        pos = torch.randn(n, 37, 3) * 10
+        seq_mask = torch.ones(n)
+        outputs = {
+            "final_atom_positions": pos,
+            "pair": torch.randn(n, n, 8),
+        }
+        plddt_fn = lambda o: torch.full((n,), 50.)
+
+        self.assertFalse(monitor.update(outputs, seq_mask, plddt_fn))
+
+        # A rigid motion of the same structure has converged
+        outputs["final_atom_positions"] = random_rotation().apply(pos)
+        self.assertTrue(monitor.update(outputs, seq_mask, plddt_fn))
+
+        trajectory = monitor.trajectory()
+        self.assertEqual(
+            set(trajectory),
+            {"ca_drmsd", "ca_rmsd", "mean_plddt", "plddt_delta", "pair_delta"}
+        )
+        self.assertTrue(math.isnan(trajectory["ca_rmsd"][0].item()))
+        self.assertLess(trajectory["ca_drmsd"][1].item(), 1e-2)
+        self.assertEqual(trajectory["mean_plddt"].tolist(), [50., 50.])
+        self.assertEqual(trajectory["pair_delta"][1].item(), 0.)
+
+
+if __name__ == "__main__":
+    unittest.main()
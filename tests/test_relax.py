@@ -0,0 +1,92 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import importlib.util
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from openfold.np import protein
+from tests.data_utils import load_test_protein
+
+openmm_is_installed = importlib.util.find_spec("openmm") is not None
+if openmm_is_installed:
+    from openfold.np.relax import amber_minimize, relax
+
+
+@unittest.skipUnless(openmm_is_installed, "Requires OpenMM")
+class TestAmberRelaxation(unittest.TestCase):
+    def setUp(self):
+        self.prot = load_test_protein()
+
+    def _relaxer(self, **kwargs):
+        return relax.AmberRelaxation(
+            max_iterations=0,
+            tolerance=2.39,
+            stiffness=10.,
+            exclude_residues=[],
+            max_outer_iterations=20,
+            use_gpu=False,
+            **kwargs,
+        )
+
+    def _find_violations(self, violating_residues):
+        mask = np.zeros(self.prot.aatype.shape[0], dtype=bool)
+        mask[violating_residues] = True
+        return mock.patch.object(
+            amber_minimize,
+            "find_violations",
+            return_value=({"total_per_residue_violations_mask": mask}, None),
+        )
+
+    def test_relax_if_needed_skips_structures_without_violations(self):
+        with self._find_violations([]), mock.patch.object(
+            amber_minimize, "run_pipeline"
+        ) as run_pipeline:
+            pdb_str, debug_data, violations = self._relaxer(
+                relax_if_needed=True
+            ).process(prot=self.prot)
+
+        run_pipeline.assert_not_called()
+        self.assertEqual(pdb_str, protein.to_pdb(self.prot))
+        self.assertEqual(debug_data["attempts"], 0)
+        self.assertEqual(debug_data["relaxed_residues"], 0)
+        self.assertFalse(np.any(violations))
+
+    def test_relax_if_needed_relaxes_structures_with_violations(self):
+        with self._find_violations([5]), mock.patch.object(
+            amber_minimize, "run_pipeline", side_effect=RuntimeError
+        ) as run_pipeline:
+            with self.assertRaises(RuntimeError):
+                self._relaxer(relax_if_needed=True).process(prot=self.prot)
+
+        run_pipeline.assert_called_once()
+        self.assertIsNone(run_pipeline.call_args.kwargs["mobile_residues"])
+
+    def test_local_radius(self):
+        with self._find_violations([5]), mock.patch.object(
+            amber_minimize, "run_pipeline", side_effect=RuntimeError
+        ) as run_pipeline:
+            with self.assertRaises(RuntimeError):
+                self._relaxer(local_radius=8.).process(prot=self.prot)
+
+        mobile_residues = run_pipeline.call_args.kwargs["mobile_residues"]
+        self.assertIn(5, mobile_residues)
+        self.assertLess(len(mobile_residues), self.prot.aatype.shape[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,9 +13,12 @@
 # limitations under the License.
 
 import math
+import os
+import tempfile
 import numpy as np
 import torch
 import unittest
+from unittest import mock
 
 from openfold.utils.rigid_utils import (
     Rotation,
@@ -23,7 +26,12 @@ from openfold.utils.rigid_utils import (
     quat_to_rot,
     rot_to_quat,
 )
-from openfold.utils.chunk_utils import chunk_layer, _chunk_slice
+from openfold.utils.chunk_utils import (
+    chunk_layer, 
+    _chunk_slice,
+    ChunkSizeTuner,
+)
+from openfold.utils.trace_utils import TraceCache, trace_block
 import tests.compare_utils as compare_utils
 from tests.config import consts
 
@@ -221,6 +229,55 @@ class TestUtils(unittest.TestCase):
 
                 self.assertTrue(torch.all(chunked == chunked_flattened))
 
+    def test_chunk_size_tuner_disk_cache(self):
+        calls = []
+        def fn(x, chunk_size):
+            calls.append(chunk_size)
+            if chunk_size > 64:
+                raise RuntimeError("Out of memory")
+
+        args = (torch.rand(100, 16),)
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch(
+            "openfold.utils.chunk_utils._device_key", 
+            return_value=("cpu", 0),
+        ):
+            cache_path = os.path.join(tmp_dir, "chunk_sizes.json")
+
+            tuner = ChunkSizeTuner(cache_path=cache_path, module_id="fn")
+            chunk_size = tuner.tune_chunk_size(fn, args, min_chunk_size=4)
+            self.assertEqual(chunk_size, 64)
+            self.assertTrue(len(calls) > 0)
+
+            # A fresh tuner, as in a new run, reuses the persisted result
+            calls.clear()
+            tuner = ChunkSizeTuner(cache_path=cache_path, module_id="fn")
+            chunk_size = tuner.tune_chunk_size(fn, args, min_chunk_size=4)
+            self.assertEqual(chunk_size, 64)
+            self.assertEqual(len(calls), 0)
+
+            # Other modules are tuned separately
+            tuner = ChunkSizeTuner(cache_path=cache_path, module_id="other")
+            tuner.tune_chunk_size(fn, args, min_chunk_size=4)
+            self.assertTrue(len(calls) > 0)
+
+    def test_trace_cache(self):
+        linear = torch.nn.Linear(8, 8).eval()
+        x = torch.rand(4, 8)
+        with torch.no_grad():
+            traced = trace_block(linear, (x,))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = TraceCache(tmp_dir)
+            key = cache.key(model="abc", n=4)
+            self.assertNotEqual(key, cache.key(model="abc", n=8))
+            self.assertIsNone(cache.load(key, "linear", "cpu"))
+
+            cache.save(key, "linear", traced)
+            loaded = cache.load(key, "linear", "cpu")
+            self.assertIsNotNone(loaded)
+            with torch.no_grad():
+                self.assertTrue(torch.allclose(loaded(x), linear(x)))
+
     @compare_utils.skip_unless_alphafold_installed()
     def test_pre_compose_compare(self):
         quat = np.random.rand(20, 4)
@@ -0,0 +1,177 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import numpy as np
+import torch
+
+from openfold.utils.rigid_utils import Rotation
+from openfold.utils.superimposition import kabsch, kabsch_rmsd, superimpose
+from openfold.utils.validation_metrics import (
+    compare_structures,
+    compare_structures_np,
+    drmsd,
+    gdt_search,
+    gdt_ts,
+    tm_score,
+)
+
+
+def random_rotation():
+    q = torch.randn(4)
+    return Rotation(
+        quats=q / torch.linalg.norm(q), normalize_quats=False
+    ).get_rot_mats()
+
+
+def random_chain(n):
+    # A random walk with CA-CA distances
+    steps = torch.nn.functional.normalize(torch.randn(n, 3), dim=-1) * 3.8
+    return torch.cumsum(steps, dim=0)
+
+
+class TestValidationMetrics(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_kabsch(self):
+        x = random_chain(50)
+        y = x @ random_rotation() + torch.randn(3) * 10
+        mask = torch.ones(50)
+        mask[:5] = 0
+        y[:5] = torch.randn(5, 3) * 100
+
+        rotation, translation = kabsch(x, y, mask)
+        superimposed = y.double() @ rotation + translation
+        self.assertTrue(torch.allclose(superimposed[5:], x[5:].double(), atol=1e-4))
+
+        self.assertTrue(
+            torch.allclose(kabsch_rmsd(x, y, mask), torch.tensor(0.), atol=1e-3)
+        )
+
+    def test_drmsd_masked(self):
+        p1 = torch.rand(2, 10, 3)
+        p2 = torch.rand(2, 10, 3)
+        mask = torch.ones(2, 10)
+        mask[0, 7:] = 0
+
+        m = mask[0].bool()
+        d1 = torch.cdist(p1[0, m], p1[0, m])
+        d2 = torch.cdist(p2[0, m], p2[0, m])
+        expected = torch.sqrt(torch.sum((d1 - d2) ** 2) / (7 * 6))
+        self.assertTrue(
+            torch.allclose(drmsd(p1, p2, mask)[0], expected, atol=1e-5)
+        )
+
+        self.assertTrue(torch.equal(
+            drmsd(p1, p2, torch.zeros(2, 10)), torch.zeros(2)
+        ))
+
+    def test_tm_score(self):
+        n = 100
+        x = random_chain(n)
+        mask = torch.ones(n)
+
+        # Invariant to rigid motions
+        y = x @ random_rotation() + 10
+        self.assertAlmostEqual(tm_score(y, x, mask).item(), 1., places=4)
+
+        # When half of the structure moves, the search finds the
+        # superposition of the other half
+        z = x.clone()
+        z[n // 2:] = z[n // 2:] @ random_rotation() + 20
+        score = tm_score(z, x, mask).item()
+        self.assertGreater(score, 0.49)
+        self.assertLess(score, 0.7)
+
+        # Masked residues only count towards the normalization length
+        half = torch.arange(n) < n // 2
+        self.assertAlmostEqual(tm_score(z, x, half).item(), 1., places=4)
+        self.assertAlmostEqual(
+            tm_score(z, x, half, length=n).item(), 0.5, places=4
+        )
+
+        # Batched scores match the unbatched ones
+        p1 = torch.stack([z, y, x + torch.randn(n, 3)])
+        p2 = x.expand(p1.shape)
+        batched = tm_score(p1, p2, mask.expand(p1.shape[:-1]))
+        self.assertEqual(batched.shape, (3,))
+        for b, s in zip(p1, batched):
+            self.assertAlmostEqual(tm_score(b, x, mask).item(), s.item(), places=5)
+
+    def test_superimpose(self):
+        x = random_chain(30).expand(4, -1, -1)
+        y = x @ random_rotation() + torch.randn(4, 1, 3)
+        mask = torch.ones(4, 30)
+        mask[1, :10] = 0
+
+        superimposed, rmsd = superimpose(x, y, mask)
+        self.assertEqual(superimposed.shape, (4, 30, 3))
+        self.assertTrue(torch.all(superimposed[1, :10] == 0))
+        self.assertTrue(torch.allclose(superimposed, x * mask[..., None], atol=1e-4))
+        self.assertTrue(torch.allclose(rmsd, torch.zeros(4), atol=1e-3))
+
+    def test_gdt_search(self):
+        n = 80
+        x = random_chain(n)
+        mask = torch.ones(n)
+        noisy = x + torch.randn(n, 3)
+
+        # Searching superpositions does at least as well as the RMSD
+        # superposition
+        superimposed, _ = superimpose(x, noisy, mask)
+        self.assertGreaterEqual(
+            gdt_search(noisy, x, mask).item() + 1e-6,
+            gdt_ts(superimposed, x, mask).item(),
+        )
+
+        z = x.clone()
+        z[n // 2:] = z[n // 2:] @ random_rotation() + 20
+        self.assertAlmostEqual(
+            gdt_search(z @ random_rotation(), x, mask).item(), 0.5, places=1
+        )
+
+    def test_compare_structures(self):
+        n = 60
+        p2 = random_chain(n).expand(5, -1, -1)
+        p1 = p2 @ random_rotation() + torch.randn(5, n, 3) * torch.arange(5)[:, None, None]
+        mask = torch.ones(5, n)
+
+        metrics = compare_structures(p1, p2, mask)
+        for k in ["rmsd", "tm_score", "gdt_ts", "gdt_ha", "lddt"]:
+            self.assertEqual(metrics[k].shape, (5,))
+        self.assertAlmostEqual(metrics["tm_score"][0].item(), 1., places=4)
+        self.assertAlmostEqual(metrics["gdt_ha"][0].item(), 1., places=4)
+        self.assertAlmostEqual(metrics["lddt"][0].item(), 1., places=4)
+        # More noise, worse scores
+        for k in ["tm_score", "gdt_ts", "lddt"]:
+            self.assertTrue(torch.all(metrics[k][1:] < metrics[k][:-1]))
+        self.assertTrue(torch.all(metrics["rmsd"][1:] > metrics["rmsd"][:-1]))
+
+        # The shared search matches separate ones
+        torch.testing.assert_close(
+            metrics["gdt_ts"], gdt_search(p1, p2, mask, [1., 2., 4., 8.])
+        )
+        torch.testing.assert_close(
+            metrics["gdt_ha"], gdt_search(p1, p2, mask, [0.5, 1., 2., 4.])
+        )
+
+        metrics_np = compare_structures_np(p1.numpy(), p2.numpy(), mask.numpy())
+        for k, v in metrics.items():
+            np.testing.assert_allclose(metrics_np[k], v.numpy(), rtol=1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
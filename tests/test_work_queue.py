@@ -0,0 +1,179 @@
+# Copyright 2021 AlQuraishi Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from openfold.data.alignment_store import merge_seq_group
+from openfold.utils.work_queue import WorkQueue
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "queue.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_add_is_idempotent(self):
+        queue = WorkQueue(self.path)
+        self.assertEqual(queue.add([("a", 1), ("b", 2)]), 2)
+
+        # A second worker seeding the same queue adds nothing
+        queue = WorkQueue(self.path)
+        self.assertEqual(queue.add([("a", 1), ("c", 3)]), 1)
+        self.assertEqual(queue.counts()["pending"], 3)
+
+    def test_add_merges_names(self):
+        queue = WorkQueue(self.path)
+        queue.add([("s", {"seq": "AC", "names": ["a"]})])
+
+        # New names for a queued sequence are merged into its item
+        self.assertEqual(
+            queue.add(
+                [("s", {"seq": "AC", "names": ["a", "b"]})],
+                merge=merge_seq_group,
+            ),
+            0,
+        )
+        item = queue.claim("w")
+        self.assertEqual(item.payload, {"seq": "AC", "names": ["a", "b"]})
+        queue.complete(item.key, "w", payload=item.payload)
+        self.assertEqual(queue.counts()["done"], 1)
+
+        # Known names leave a finished item alone
+        queue.add(
+            [("s", {"seq": "AC", "names": ["b"]})], merge=merge_seq_group
+        )
+        self.assertEqual(queue.counts()["done"], 1)
+
+        # New names requeue it, to be linked to the existing alignments
+        queue.add(
+            [("s", {"seq": "AC", "names": ["c"]})], merge=merge_seq_group
+        )
+        item = queue.claim("w")
+        self.assertEqual(
+            item.payload,
+            {"seq": "AC", "names": ["a", "b", "c"], "linked": ["a", "b"]},
+        )
+        self.assertEqual(item.attempt, 1)
+
+    def test_add_file_items_with_merge(self):
+        queue = WorkQueue(self.path)
+        queue.add([("a.cif", {"file": "a.cif"})], merge=merge_seq_group)
+        item = queue.claim("w")
+        queue.complete(item.key, "w", payload=item.payload)
+
+        # Re-seeding the queue leaves file items alone
+        self.assertEqual(
+            queue.add(
+                [("a.cif", {"file": "a.cif"}), ("b.cif", {"file": "b.cif"})],
+                merge=merge_seq_group,
+            ),
+            1,
+        )
+        self.assertEqual(queue.counts()["done"], 1)
+        self.assertEqual(queue.claim("w").key, "b.cif")
+
+    def test_merge_while_running(self):
+        queue = WorkQueue(self.path)
+        queue.add([("s", {"seq": "AC", "names": ["a"]})])
+        item = queue.claim("w")
+
+        queue.add(
+            [("s", {"seq": "AC", "names": ["b"]})], merge=merge_seq_group
+        )
+
+        # The worker didn't see the new name, so the item is queued again
+        queue.complete(item.key, "w", payload=item.payload)
+        self.assertEqual(queue.counts()["done"], 0)
+        item = queue.claim("w")
+        self.assertEqual(item.payload["names"], ["a", "b"])
+        queue.complete(item.key, "w", payload=item.payload)
+        self.assertEqual(queue.counts()["done"], 1)
+
+    def test_retries(self):
+        queue = WorkQueue(self.path, max_attempts=2)
+        queue.add([("a", {"x": 1})])
+
+        for attempt in [1, 2]:
+            item = queue.claim("w")
+            self.assertEqual(item.payload, {"x": 1})
+            self.assertEqual(item.attempt, attempt)
+            self.assertIsNone(queue.claim("w"))
+            queue.fail(item.key, "w", "error")
+
+        self.assertIsNone(queue.claim("w"))
+        self.assertEqual(queue.counts()["failed"], 1)
+
+        self.assertEqual(queue.reset_failed(), 1)
+        self.assertEqual(queue.claim("w").attempt, 1)
+
+    def test_expired_lease(self):
+        queue = WorkQueue(self.path, lease_seconds=0.1)
+        queue.add([("a", None)])
+
+        item = queue.claim("preempted")
+        self.assertIsNone(queue.claim("w"))
+        time.sleep(0.2)
+
+        self.assertEqual(queue.claim("w").key, item.key)
+
+        # The preempted worker no longer holds the lease
+        self.assertFalse(queue.heartbeat(item.key, "preempted"))
+        queue.complete(item.key, "preempted")
+        self.assertEqual(queue.counts()["running"], 1)
+
+        queue.complete(item.key, "w")
+        self.assertEqual(queue.counts()["done"], 1)
+
+    def test_heartbeats_keep_lease(self):
+        queue = WorkQueue(self.path, lease_seconds=0.3)
+        queue.add([("a", None)])
+
+        item = queue.claim("w")
+        with queue.lease(item.key, "w"):
+            time.sleep(0.6)
+            self.assertIsNone(queue.claim("other"))
+
+    def test_concurrent_workers(self):
+        queue = WorkQueue(self.path)
+        queue.add([(str(i), i) for i in range(20)])
+
+        seen = []
+        lock = threading.Lock()
+        def fn(payload):
+            with lock:
+                seen.append(payload)
+            return {"t": 0.}
+
+        threads = [
+            threading.Thread(target=queue.work, args=(fn, f"w{i}"))
+            for i in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(seen), list(range(20)))
+        self.assertEqual(queue.counts()["done"], 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
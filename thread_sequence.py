@@ -7,8 +7,10 @@ import numpy
 import torch
 from openfold.config import model_config
 from openfold.data import feature_pipeline
-from openfold.data.data_pipeline import make_sequence_features_with_custom_template
+from openfold.data.data_pipeline import CustomTemplateDataPipeline, make_sequence_features_with_custom_template
+from openfold.data.templates import CustomTemplateFeaturizer
 from openfold.np import protein
+from openfold.utils.batch_utils import bucket_targets, stack_features, unbatch_outputs
 from openfold.utils.script_utils import load_models_from_command_line, parse_fasta, run_model, prep_output, \
     relax_protein
 from openfold.utils.tensor_utils import (
@@ -33,6 +35,114 @@ if(
 torch.set_grad_enabled(False)
 
 
+def write_scan_results(results, output_path):
+    """
+    Writes the per-variant results of a scan to one .npz file. Per-variant
+    values are arrays with one entry per variant. Per-residue values are
+    concatenated across variants, and those of variant i start at
+    residue_offset[i].
+    """
+    num_res = numpy.array([len(r["plddt"]) for r in results], dtype=numpy.int64)
+    numpy.savez(
+        output_path,
+        tag=numpy.array([r["tag"] for r in results]),
+        sequence=numpy.array([r["sequence"] for r in results]),
+        num_res=num_res,
+        residue_offset=numpy.cumsum(num_res) - num_res,
+        mean_plddt=numpy.array(
+            [numpy.mean(r["plddt"]) for r in results], dtype=numpy.float32
+        ),
+        ptm=numpy.array([r["ptm"] for r in results], dtype=numpy.float32),
+        mean_pae=numpy.array([r["mean_pae"] for r in results], dtype=numpy.float32),
+        max_pae=numpy.array([r["max_pae"] for r in results], dtype=numpy.float32),
+        plddt=numpy.concatenate([r["plddt"] for r in results]).astype(numpy.float32),
+        final_atom_positions=numpy.concatenate(
+            [r["final_atom_positions"] for r in results]
+        ).astype(numpy.float32),
+        final_atom_mask=numpy.concatenate(
+            [r["final_atom_mask"] for r in results]
+        ).astype(bool),
+    )
+    return output_path
+
+
+def scan_result(tag, sequence, out):
+    """ Extracts the compact per-variant results of one variant's outputs """
+    nan = float("nan")
+    pae = out.get("predicted_aligned_error")
+    return {
+        "tag": tag,
+        "sequence": sequence,
+        "plddt": out["plddt"],
+        "ptm": float(out["ptm_score"]) if "ptm_score" in out else nan,
+        "mean_pae": float(numpy.mean(pae)) if pae is not None else nan,
+        "max_pae": float(numpy.max(pae)) if pae is not None else nan,
+        "final_atom_positions": out["final_atom_positions"],
+        "final_atom_mask": out["final_atom_mask"],
+    }
+
+
+def run_scan(args, config, feature_processor, tags, sequences):
+    """
+    Threads many sequences, e.g. the variants of a mutational scan, onto the
+    same template. The template is parsed once, the features of each
+    variant are derived from those of the previous one of the same length,
+    variants of equal length are run through the model together, up to
+    args.batch_size at a time, and the results of all variants are written
+    to one file per model. Outputs aren't relaxed.
+    """
+    data_pipeline = CustomTemplateDataPipeline(
+        CustomTemplateFeaturizer(
+            args.input_mmcif, args.template_id, args.chain_id
+        )
+    )
+    feature_dicts = [data_pipeline.process_sequence(seq) for seq in sequences]
+
+    lengths = [len(seq) for seq in sequences]
+    batches = bucket_targets(lengths, args.batch_size, lambda l: l)
+
+    scan_name = os.path.splitext(os.path.basename(args.input_fasta))[0]
+    model_generator = load_models_from_command_line(
+        config,
+        args.model_device,
+        args.openfold_checkpoint_path,
+        args.jax_param_path,
+        args.output_dir)
+    for model, output_directory in model_generator:
+        results = [None for _ in sequences]
+        for batch_idx in batches:
+            batch = stack_features([
+                {
+                    k: torch.as_tensor(v)
+                    for k, v in feature_processor.process_features(
+                        feature_dicts[i], mode='predict',
+                    ).items()
+                }
+                for i in batch_idx
+            ])
+            batch = tensor_tree_map(
+                lambda t: t.to(args.model_device), batch
+            )
+
+            batch_tags = [tags[i] for i in batch_idx]
+            out = run_model(model, batch, batch_tags, args.output_dir)
+
+            for j, i in enumerate(batch_idx):
+                target_out = unbatch_outputs(
+                    out, j, lengths[i], model.config.heads.tm
+                )
+                target_out = tensor_tree_map(
+                    lambda x: numpy.array(x.cpu()), target_out
+                )
+                results[i] = scan_result(tags[i], sequences[i], target_out)
+
+        output_path = os.path.join(
+            output_directory, f'{scan_name}_{args.config_preset}_scan.npz'
+        )
+        write_scan_results(results, output_path)
+        logger.info(f"Scan results written to {output_path}...")
+
+
 def main(args):
     os.makedirs(args.output_dir, exist_ok=True)
 
@@ -49,8 +159,9 @@ def main(args):
     with open(args.input_fasta) as fasta_file:
         tags, sequences = parse_fasta(fasta_file.read())
 
-    if len(sequences) != 1:
-        raise ValueError("the threading script can only process a single sequence")
+    if len(sequences) > 1:
+        run_scan(args, config, feature_processor, tags, sequences)
+        return
 
     query_sequence = sequences[0]
     query_tag = tags[0]
@@ -106,11 +217,18 @@ def main(args):
         logger.info(f"Output written to {unrelaxed_output_path}...")
 
         logger.info(f"Running relaxation on {unrelaxed_output_path}...")
-        relax_protein(config, args.model_device, unrelaxed_protein, output_directory, output_name, False)
+        relax_protein(config, args.model_device, unrelaxed_protein, output_directory, output_name, False,
+                      query_tag, args.output_dir)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("input_fasta", type=str, help="the path to a fasta file containing a single sequence to thread")
+    parser.add_argument(
+        "input_fasta", type=str,
+        help="""the path to a fasta file containing the sequence to thread. If
+             it contains several sequences, e.g. the variants of a mutational
+             scan, they're run in batches and the pLDDT, PAE summary and
+             coordinates of all of them are written to one .npz file"""
+    )
     parser.add_argument("input_mmcif", type=str, help="the path to an mmcif file to thread the sequence on to")
 
     parser.add_argument("--template_id", type=str, help="a PDB id or other identifier for the template")
@@ -153,6 +271,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--data_random_seed", type=str, default=None
     )
+    parser.add_argument(
+        "--batch_size", type=int, default=1,
+        help="""Maximum number of sequences of equal length threaded in one
+             forward pass when the fasta file contains several sequences"""
+    )
 
     add_data_args(parser)
 
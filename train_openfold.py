@@ -55,7 +55,7 @@ class OpenFoldWrapper(pl.LightningModule):
             model=self.model, decay=config.ema.decay
         )
 
-        self.cached_weights = None
+        self.ema_swapped = False
         self.last_lr_step = -1
         self.save_hyperparameters()
 
@@ -94,10 +94,12 @@ class OpenFoldWrapper(pl.LightningModule):
                 on_step=False, on_epoch=True, logger=True, sync_dist=False,
             )
 
-    def training_step(self, batch, batch_idx):
-        if (self.ema.device != batch["aatype"].device):
-            self.ema.to(batch["aatype"].device)
+    def on_fit_start(self):
+        # The model is on its device by now. The EMA follows it once, rather
+        # than being checked on every step
+        self.ema.to(self.device)
 
+    def training_step(self, batch, batch_idx):
         ground_truth = batch.pop('gt_features', None)
 
         # Run the model
@@ -124,17 +126,32 @@ class OpenFoldWrapper(pl.LightningModule):
     def on_before_zero_grad(self, *args, **kwargs):
         self.ema.update(self.model)
 
-    def validation_step(self, batch, batch_idx):
-        # At the start of validation, load the EMA weights
-        if (self.cached_weights is None):
-            # model.state_dict() contains references to model weights rather
-            # than copies. Therefore, we need to clone them before calling
-            # load_state_dict().
-            def clone_param(t): return t.detach().clone()
-            self.cached_weights = tensor_tree_map(
-                clone_param, self.model.state_dict())
-            self.model.load_state_dict(self.ema.state_dict()["params"])
+    def on_validation_epoch_start(self):
+        # Validate with the EMA weights. They're swapped in by reference,
+        # without copying the model's weights
+        if (self.ema.device != self.device):
+            # Validation runs outside of fit
+            self.ema.to(self.device)
+
+        if (not self.ema_swapped):
+            self.ema.swap(self.model)
+            self.ema_swapped = True
 
+    def _restore_weights(self):
+        if (self.ema_swapped):
+            self.ema.swap(self.model)
+            self.ema_swapped = False
+
+    def validation_step(self, batch, batch_idx):
+        try:
+            self._validation_step(batch)
+        except BaseException:
+            # Don't leave the EMA weights in the model, e.g. for the
+            # checkpoint saved on interruption
+            self._restore_weights()
+            raise
+
+    def _validation_step(self, batch):
         ground_truth = batch.pop('gt_features', None)
 
         # Run the model
@@ -157,8 +174,7 @@ class OpenFoldWrapper(pl.LightningModule):
         
     def on_validation_epoch_end(self):
         # Restore the model weights to normal
-        self.model.load_state_dict(self.cached_weights)
-        self.cached_weights = None
+        self._restore_weights()
 
     def _compute_validation_metrics(self,
                                     batch,
@@ -171,13 +187,15 @@ class OpenFoldWrapper(pl.LightningModule):
         pred_coords = outputs["final_atom_positions"]
         all_atom_mask = batch["all_atom_mask"]
 
-        # This is super janky for superimposition. Fix later
-        gt_coords_masked = gt_coords * all_atom_mask[..., None]
-        pred_coords_masked = pred_coords * all_atom_mask[..., None]
+        # All metrics below are batched and stay on the device
         ca_pos = residue_constants.atom_order["CA"]
-        gt_coords_masked_ca = gt_coords_masked[..., ca_pos, :]
-        pred_coords_masked_ca = pred_coords_masked[..., ca_pos, :]
         all_atom_mask_ca = all_atom_mask[..., ca_pos]
+        gt_coords_masked_ca = (
+            gt_coords[..., ca_pos, :] * all_atom_mask_ca[..., None]
+        )
+        pred_coords_masked_ca = (
+            pred_coords[..., ca_pos, :] * all_atom_mask_ca[..., None]
+        )
 
         lddt_ca_score = lddt_ca(
             pred_coords,